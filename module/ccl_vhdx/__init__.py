@@ -1 +1,20 @@
-from .ccl_vhdx import *
\ No newline at end of file
+from .ccl_vhdx import *
+from .progress import *
+from .hashing import *
+from .partitions import *
+from .compression import *
+from .export import *
+from .parallel import *
+from .occupancy import *
+from .geometry import *
+from .recovery import *
+from .search import *
+from .reports import *
+from .sidecar import *
+from .diff import *
+from .sources import *
+from .verification import *
+from .qcow2 import *
+from .triage import *
+from .loghistory import *
+from .scheduler import *
@@ -18,9 +18,17 @@ OTHERWISE, ARISING FROM, OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR
 import struct
 import os
 import io
+import sys
+import mmap
+import errno
+import threading
+import array
+import bisect
+import collections
 import typing
 import enum
 import pathlib
+import re
 
 import ccl_log
 
@@ -38,6 +46,7 @@ CREATOR_LENGTH = 512
 HEAD_MAGIC = b"head"
 
 REGION_TABLE_MAGIC = b"regi"
+REGION_TABLE_OFFSETS = (192 * 1024, 256 * 1024)
 
 REGION_GUID_BAT = "2DC27766-F623-4200-9D64-115E9BFD4A08"
 REGION_GUID_METADATA = "8B7CA206-4790-4B9A-B8FE-575F050F886E"
@@ -52,6 +61,12 @@ METADATA_PHYSICAL_SECTOR_SIZE = "CDA348C7-445D-4471-9CC9-E9885251C556"
 METADATA_PARENT_LOCATOR = "A8D35F2D-B30B-454D-ABF7-D3D84834AB0C"
 
 LOG_HEADER_MAGIC = b"loge"
+LOG_DATA_DESCRIPTOR_MAGIC = b"desc"
+LOG_ZERO_DESCRIPTOR_MAGIC = b"zero"
+LOG_DATA_SECTOR_MAGIC = b"data"
+LOG_SECTOR_SIZE = 4096
+LOG_ENTRY_HEADER_LENGTH = 64
+LOG_DESCRIPTOR_LENGTH = 32
 
 SENSIBLE_FALLBACK_METAS = {
     "LogicalSectorSize": 512,
@@ -66,6 +81,14 @@ BAT_SB_BLOCK_PRESENT = 6
 
 MAX_INFERRED_SIZE = 0x8000000000
 
+SECTOR_BITMAP_CACHE_SIZE = 16 << 20  # bytes of sector bitmap runs each VhdxFile keeps
+MIN_LINEAR_RUN_BLOCKS = 2  # shorter runs of consecutively stored payload blocks are read block by block
+BULK_READ_SIZE = 1 << 24  # bytes of consecutive payload blocks which iter_blocks reads at once
+
+DIRECT_IO_MIN_ALIGNMENT = 4096
+DIRECT_IO_MIN_READ = 1 << 16  # smaller reads (metadata, single sectors) go through the page cache even in direct mode
+DIRECT_IO_BUFFER_SIZE = 1 << 23
+
 
 def guid_to_blob(guid_string: str):
     x = bytes.fromhex(guid_string.replace("-", ""))
@@ -97,6 +120,251 @@ def read_guid(f: typing.BinaryIO) -> bytes:
     return read_raw(f, 16)  # TODO: return something sensible
 
 
+def _make_crc32c_table():
+    table = []
+    for i in range(256):
+        crc = i
+        for _ in range(8):
+            crc = (crc >> 1) ^ 0x82f63b78 if crc & 1 else crc >> 1
+        table.append(crc)
+    return table
+
+
+_CRC32C_TABLE = _make_crc32c_table()
+
+
+def crc32c(data: bytes) -> int:
+    """The CRC-32C (Castagnoli) checksum used by the headers, region tables and log entries"""
+    crc = 0xffffffff
+    table = _CRC32C_TABLE
+    for b in data:
+        crc = table[(crc ^ b) & 0xff] ^ (crc >> 8)
+    return crc ^ 0xffffffff
+
+
+_ZERO_CHECK_CHUNK = bytes(1 << 16)
+
+
+def is_zero_buffer(data) -> bool:
+    """
+    Returns True if the buffer contains only zeros. The buffer is compared against a shared zero buffer a chunk at a
+    time (a memcmp for each chunk) so that data which is not zero is usually rejected after the first chunk.
+    """
+    chunk_size = len(_ZERO_CHECK_CHUNK)
+    if isinstance(data, memoryview):
+        # bytes.startswith takes the memoryview slice as it is, so each chunk is a memcmp without a copy (memoryview
+        # equality would compare element by element)
+        data = data.cast("B")
+        for offset in range(0, len(data), chunk_size):
+            if not _ZERO_CHECK_CHUNK.startswith(data[offset:offset + chunk_size]):
+                return False
+        return True
+
+    full_chunks_end = len(data) - (len(data) % chunk_size)
+    for offset in range(0, full_chunks_end, chunk_size):
+        if not data.startswith(_ZERO_CHECK_CHUNK, offset):
+            return False
+    return data.count(0, full_chunks_end) == len(data) - full_chunks_end
+
+
+def zero_fill(view: memoryview):
+    """Zeros a writable buffer in place from the shared zero chunk, so that nothing as large as the buffer is allocated"""
+    chunk_size = len(_ZERO_CHECK_CHUNK)
+    zeros = memoryview(_ZERO_CHECK_CHUNK)
+    for offset in range(0, len(view), chunk_size):
+        end = min(offset + chunk_size, len(view))
+        view[offset:end] = zeros[:end - offset]
+
+
+def _make_byte_runs():
+    # the (first_bit, bit_count, bit) runs within each byte value, least significant bit first
+    table = []
+    for value in range(256):
+        runs = []
+        for bit in range(8):
+            bit_value = (value >> bit) & 1
+            if runs and runs[-1][2] == bit_value:
+                runs[-1][1] += 1
+            else:
+                runs.append([bit, 1, bit_value])
+        table.append(tuple(tuple(x) for x in runs))
+    return tuple(table)
+
+
+_BYTE_RUNS = _make_byte_runs()
+_FIND_NOT_CLEAR_BYTE = re.compile(b"[^\\x00]")
+_FIND_NOT_SET_BYTE = re.compile(b"[^\\xff]")
+
+
+def iter_bitmap_runs(bitmap: typing.Optional[bytes], bit_count: int):
+    """
+    Yields runs of (first_bit, bit_count, is_set) from a bitmap which is read least significant bit first. A bitmap of
+    None is treated as entirely clear.
+    """
+    if bit_count <= 0:
+        return
+    if bitmap is None:
+        yield 0, bit_count, False
+        return
+
+    # whole bytes which continue the current run (0x00 or 0xff) are skipped by a regex search, which scans in C; only
+    # the bytes where the run may change are looked at, through the runs of bits within each byte value
+    byte_count = min(len(bitmap), -(-bit_count // 8))
+    run_start = 0
+    run_value = bitmap[0] & 1
+    byte_index = 0
+    while byte_index < byte_count:
+        finder = _FIND_NOT_SET_BYTE if run_value else _FIND_NOT_CLEAR_BYTE
+        match = finder.search(bitmap, byte_index, byte_count)
+        if match is None:
+            break
+        byte_index = match.start()
+        for first_bit, _, bit_value in _BYTE_RUNS[bitmap[byte_index]]:
+            if bit_value != run_value:
+                position = byte_index * 8 + first_bit
+                if position >= bit_count:
+                    break
+                yield run_start, position - run_start, run_value == 1
+                run_start = position
+                run_value = bit_value
+        byte_index += 1
+
+    yield run_start, bit_count - run_start, run_value == 1
+
+
+class SectorBitmap:
+    """
+    A sector bitmap page (one bit per sector for 2**23 sectors) held as the sorted runs of set bits rather than as its
+    raw 1 MiB, so a page costs 8 bytes per run. Pages which are entirely clear or entirely set share the EMPTY and FULL
+    instances. Lookups are binary searches over the runs.
+    """
+    BIT_COUNT = 1 << 23
+    EMPTY: "SectorBitmap"
+    FULL: "SectorBitmap"
+
+    def __init__(self, starts: array.array, ends: array.array):
+        self._starts = starts
+        self._ends = ends  # exclusive
+
+    @classmethod
+    def from_runs(cls, runs: typing.Iterable[typing.Tuple[int, int]]) -> "SectorBitmap":
+        """Builds a page from (first_bit, bit_count) runs of set bits, which must be sorted and not overlap"""
+        starts = array.array("I")
+        ends = array.array("I")
+        for first, count in runs:
+            if count <= 0:
+                continue
+            if ends and ends[-1] == first:
+                ends[-1] = first + count
+            else:
+                starts.append(first)
+                ends.append(first + count)
+        if not starts:
+            return cls.EMPTY
+        if len(starts) == 1 and starts[0] == 0 and ends[0] >= cls.BIT_COUNT:
+            return cls.FULL
+        return cls(starts, ends)
+
+    @classmethod
+    def from_bytes(cls, raw: bytes) -> "SectorBitmap":
+        """Builds a page from the raw bitmap (bits beyond the end of a short read are clear)"""
+        if is_zero_buffer(raw):
+            return cls.EMPTY
+        bit_count = min(len(raw) * 8, cls.BIT_COUNT)
+        return cls.from_runs((first, count) for first, count, is_set in iter_bitmap_runs(raw, bit_count) if is_set)
+
+    @property
+    def run_count(self) -> int:
+        return len(self._starts)
+
+    @property
+    def memory_size(self) -> int:
+        """The approximate number of bytes used by the runs"""
+        return (len(self._starts) + len(self._ends)) * self._starts.itemsize
+
+    def is_set(self, bit: int) -> bool:
+        run_index = bisect.bisect_right(self._starts, bit) - 1
+        return run_index >= 0 and bit < self._ends[run_index]
+
+    def any_set(self, first_bit: int, bit_count: int) -> bool:
+        run_index = bisect.bisect_right(self._ends, first_bit)  # the first run ending after first_bit
+        return run_index < len(self._starts) and self._starts[run_index] < first_bit + bit_count
+
+    def count_set(self, first_bit: int, bit_count: int) -> int:
+        total = 0
+        for first, count, is_set in self.iter_runs(first_bit, bit_count):
+            if is_set:
+                total += count
+        return total
+
+    def iter_runs(self, first_bit: int, bit_count: int):
+        """Yields (first_bit, bit_count, is_set) runs covering a range of the page, relative to first_bit"""
+        end_bit = first_bit + bit_count
+        position = first_bit
+        run_index = bisect.bisect_right(self._ends, first_bit)
+        while position < end_bit:
+            if run_index >= len(self._starts) or self._starts[run_index] >= end_bit:
+                yield position - first_bit, end_bit - position, False
+                return
+            run_start = max(self._starts[run_index], first_bit)
+            run_end = min(self._ends[run_index], end_bit)
+            if run_start > position:
+                yield position - first_bit, run_start - position, False
+            yield run_start - first_bit, run_end - run_start, True
+            position = run_end
+            run_index += 1
+
+    def iter_set_runs(self):
+        """Yields (first_bit, bit_count) for each run of set bits"""
+        for start, end in zip(self._starts, self._ends):
+            yield start, end - start
+
+
+SectorBitmap.EMPTY = SectorBitmap(array.array("I"), array.array("I"))
+SectorBitmap.FULL = SectorBitmap(array.array("I", [0]), array.array("I", [SectorBitmap.BIT_COUNT]))
+
+
+class _SectorBitmapCache:
+    """
+    Sector bitmap pages by chunk index. Once the pages held use more than max_size bytes the least recently used are
+    dropped (to be read again if needed); each entry is counted as at least _ENTRY_OVERHEAD bytes so that the number of
+    EMPTY and FULL entries is bounded too.
+    """
+    _ENTRY_OVERHEAD = 64
+
+    def __init__(self, max_size: int):
+        self._max_size = max_size
+        self._pages = collections.OrderedDict()
+        self._size = 0
+
+    def get(self, chunk_index: int) -> typing.Optional[SectorBitmap]:
+        page = self._pages.get(chunk_index)
+        if page is not None:
+            self._pages.move_to_end(chunk_index)
+        return page
+
+    def put(self, chunk_index: int, page: SectorBitmap):
+        if chunk_index in self._pages:
+            self._size -= self._pages[chunk_index].memory_size + _SectorBitmapCache._ENTRY_OVERHEAD
+        self._pages[chunk_index] = page
+        self._size += page.memory_size + _SectorBitmapCache._ENTRY_OVERHEAD
+        while self._size > self._max_size and len(self._pages) > 1:
+            _, evicted = self._pages.popitem(last=False)
+            self._size -= evicted.memory_size + _SectorBitmapCache._ENTRY_OVERHEAD
+
+    def clear(self):
+        self._pages.clear()
+        self._size = 0
+
+    @property
+    def size(self) -> int:
+        return self._size
+
+    @property
+    def max_size(self) -> int:
+        return self._max_size
+
+
 class VhdxError(Exception):
     pass
 
@@ -105,10 +373,18 @@ class VhdxHeaderError(VhdxError):
     pass
 
 
+class ByteSourceError(VhdxError):
+    pass
+
+
 class VhdxMetadataError(VhdxError):
     pass
 
 
+class VhdxLogError(VhdxError):
+    pass
+
+
 class Header:
     def __init__(self, checksum: int, seq_number: int, file_write_guid: bytes, data_write_guid: bytes,
                  log_guid: bytes, log_version: int, version: int, log_length: int, log_offset: int):
@@ -206,6 +482,10 @@ class RegionTableEntry:
     def length(self):
         return self._length
 
+    @property
+    def required(self):
+        return self._required
+
     @classmethod
     def from_stream(cls, f: typing.BinaryIO):
         guid = read_guid(f)
@@ -257,6 +537,7 @@ class RegionTable:
             if ignore_faults:
                 _l("WARNING: Region table entry count over 2047, setting to 2047 - expect invalid data",
                    to_stdout=DEBUG_TO_STDOUT)
+                entry_count = 2047
             else:
                 raise VhdxHeaderError("WARNING: Region table entry count over 2047")
         reserved = read_uint32(f)  # reserved. obviously.
@@ -454,20 +735,148 @@ class BatEntry:
         return self._file_offset
 
     @classmethod
-    def from_stream(cls, stream: typing.BinaryIO):
-        block_raw = read_uint64(stream)
+    def from_raw(cls, block_raw: int):
         state = block_raw & 0x07
         file_offset_mb = (block_raw >> 20) & 0xfffffffffff
         return cls(BatPayloadBlockState(state), file_offset_mb)
 
+    @classmethod
+    def from_stream(cls, stream: typing.BinaryIO):
+        return cls.from_raw(read_uint64(stream))
+
+
+class LogDescriptor:
+    """
+    A data or zero descriptor from a log entry. A data descriptor writes one 4096 byte sector (held in the entry's data
+    sector, apart from the leading 8 and trailing 4 bytes which are held here) at file_offset; a zero descriptor zeroes
+    length bytes from file_offset.
+    """
+    def __init__(self, is_zero: bool, file_offset: int, length: int, sequence_number: int,
+                 leading_bytes: bytes = b"", trailing_bytes: bytes = b""):
+        self._is_zero = is_zero
+        self._file_offset = file_offset
+        self._length = length
+        self._sequence_number = sequence_number
+        self._leading_bytes = leading_bytes
+        self._trailing_bytes = trailing_bytes
+
+    @property
+    def is_zero(self) -> bool:
+        return self._is_zero
 
-class LogEntry:  # TODO
-    def __init__(self):
-        pass
+    @property
+    def file_offset(self) -> int:
+        return self._file_offset
+
+    @property
+    def length(self) -> int:
+        return self._length
+
+    @property
+    def sequence_number(self) -> int:
+        return self._sequence_number
+
+    @property
+    def leading_bytes(self) -> bytes:
+        return self._leading_bytes
+
+    @property
+    def trailing_bytes(self) -> bytes:
+        return self._trailing_bytes
+
+    def build_sector(self, data_sector: bytes) -> bytes:
+        """Reassembles the sector a data descriptor writes from its data sector"""
+        return self._leading_bytes + data_sector[8:LOG_SECTOR_SIZE - 4] + self._trailing_bytes
 
     @classmethod
     def from_stream(cls, stream: typing.BinaryIO):
-        pass
+        raw = read_raw(stream, LOG_DESCRIPTOR_LENGTH)
+        magic = raw[0:4]
+        if magic == LOG_ZERO_DESCRIPTOR_MAGIC:
+            length, file_offset, sequence_number = struct.unpack_from("<QQQ", raw, 8)
+            return cls(True, file_offset, length, sequence_number)
+        elif magic == LOG_DATA_DESCRIPTOR_MAGIC:
+            file_offset, sequence_number = struct.unpack_from("<QQ", raw, 16)
+            return cls(False, file_offset, LOG_SECTOR_SIZE, sequence_number, raw[8:16], raw[4:8])
+        raise VhdxLogError(f"Invalid log descriptor magic (got: {magic.hex()})")
+
+
+class LogEntry:
+    """
+    The header and descriptors of an entry in the log. The header and descriptors take up the first
+    descriptor_area_length bytes of the entry, followed by one data sector for each data descriptor in order.
+    """
+    def __init__(self, checksum: int, entry_length: int, tail: int, sequence_number: int, log_guid: bytes,
+                 flushed_file_offset: int, last_file_offset: int, descriptors: typing.Sequence[LogDescriptor]):
+        self._checksum = checksum
+        self._entry_length = entry_length
+        self._tail = tail
+        self._sequence_number = sequence_number
+        self._log_guid = log_guid
+        self._flushed_file_offset = flushed_file_offset
+        self._last_file_offset = last_file_offset
+        self._descriptors = tuple(descriptors)
+
+    @property
+    def checksum(self) -> int:
+        return self._checksum
+
+    @property
+    def entry_length(self) -> int:
+        return self._entry_length
+
+    @property
+    def tail(self) -> int:
+        """Offset into the log of the first entry of the sequence this entry belongs to"""
+        return self._tail
+
+    @property
+    def sequence_number(self) -> int:
+        return self._sequence_number
+
+    @property
+    def log_guid(self) -> bytes:
+        return self._log_guid
+
+    @property
+    def flushed_file_offset(self) -> int:
+        return self._flushed_file_offset
+
+    @property
+    def last_file_offset(self) -> int:
+        return self._last_file_offset
+
+    @property
+    def descriptors(self) -> typing.Tuple[LogDescriptor, ...]:
+        return self._descriptors
+
+    @property
+    def data_descriptors(self) -> typing.List[LogDescriptor]:
+        return [x for x in self._descriptors if not x.is_zero]
+
+    @property
+    def descriptor_area_length(self) -> int:
+        used = LOG_ENTRY_HEADER_LENGTH + len(self._descriptors) * LOG_DESCRIPTOR_LENGTH
+        return -(-used // LOG_SECTOR_SIZE) * LOG_SECTOR_SIZE
+
+    @classmethod
+    def from_stream(cls, stream: typing.BinaryIO):
+        # the stream is left at the end of the descriptors, not the end of the descriptor area
+        raw = read_raw(stream, LOG_ENTRY_HEADER_LENGTH)
+        magic = raw[0:4]
+        if magic != LOG_HEADER_MAGIC:
+            raise VhdxLogError(f"Invalid log entry magic (Expected: {LOG_HEADER_MAGIC.hex()}; got: {magic.hex()})")
+        checksum, entry_length, tail, sequence_number, descriptor_count = struct.unpack_from("<IIIQI", raw, 4)
+        log_guid = raw[32:48]
+        flushed_file_offset, last_file_offset = struct.unpack_from("<QQ", raw, 48)
+        if entry_length % LOG_SECTOR_SIZE != 0 or \
+                LOG_ENTRY_HEADER_LENGTH + descriptor_count * LOG_DESCRIPTOR_LENGTH > entry_length:
+            raise VhdxLogError(
+                f"Log entry length {entry_length} is invalid for {descriptor_count} descriptors")
+        descriptors = [LogDescriptor.from_stream(stream) for _ in range(descriptor_count)]
+
+        return cls(checksum, entry_length, tail, sequence_number, log_guid, flushed_file_offset, last_file_offset,
+                   descriptors)
 
 
 class FileIdentifier:
@@ -487,18 +896,562 @@ class FileIdentifier:
         return cls(creator)
 
 
+class ByteSource:
+    """
+    Random access to the bytes of a VHDX file, wherever they are held. Subclasses provide size, name and readinto_at;
+    open gives a buffered, seekable file-like object over the source for the stream based parsing.
+    """
+    def readinto_at(self, offset: int, view: memoryview) -> int:
+        """Fills view from offset, returning the number of bytes filled (fewer at the end of the source)"""
+        raise NotImplementedError()
+
+    def read_at(self, offset: int, length: int) -> bytes:
+        buffer = bytearray(max(0, min(length, self.size - offset)))
+        filled = self.readinto_at(offset, memoryview(buffer))
+        return bytes(buffer[:filled])
+
+    def open(self) -> typing.BinaryIO:
+        return io.BufferedReader(_ByteSourceStream(self), 1 << 16)
+
+    def close(self):
+        pass
+
+    def __repr__(self):
+        return f"<{type(self).__name__} {self.name}>"
+
+    @property
+    def size(self) -> int:
+        raise NotImplementedError()
+
+    @property
+    def name(self) -> str:
+        raise NotImplementedError()
+
+    @property
+    def local_path(self) -> typing.Optional[pathlib.Path]:
+        """The path of the source if it is a single local file, otherwise None"""
+        return None
+
+
+class _ByteSourceStream(io.RawIOBase):
+    def __init__(self, source: ByteSource):
+        super().__init__()
+        self._source = source
+        self._position = 0
+
+    def readable(self):
+        return True
+
+    def seekable(self):
+        return True
+
+    def tell(self):
+        return self._position
+
+    def seek(self, offset, whence=os.SEEK_SET):
+        if whence == os.SEEK_SET:
+            position = offset
+        elif whence == os.SEEK_CUR:
+            position = self._position + offset
+        elif whence == os.SEEK_END:
+            position = self._source.size + offset
+        else:
+            raise ValueError(f"Invalid whence ({whence})")
+        if position < 0:
+            raise ValueError("Negative seek position")
+        self._position = position
+        return self._position
+
+    def readinto(self, buffer):
+        filled = self._source.readinto_at(self._position, memoryview(buffer).cast("B"))
+        self._position += filled
+        return filled
+
+
+class FileByteSource(ByteSource):
+    def __init__(self, path: os.PathLike):
+        self._path = pathlib.Path(path)
+
+    def readinto_at(self, offset: int, view: memoryview) -> int:
+        with self._path.open("rb") as f:
+            f.seek(offset, os.SEEK_SET)
+            return f.readinto(view)
+
+    def open(self) -> typing.BinaryIO:
+        return self._path.open("rb")
+
+    @property
+    def size(self) -> int:
+        return self._path.stat().st_size
+
+    @property
+    def name(self) -> str:
+        return str(self._path)
+
+    @property
+    def local_path(self) -> typing.Optional[pathlib.Path]:
+        return self._path
+
+
+def _pread_into(fd: int, view: memoryview, offset: int) -> int:
+    filled = 0
+    while filled < len(view):
+        count = os.preadv(fd, [view[filled:]], offset + filled)
+        if not count:
+            break
+        filled += count
+    return filled
+
+
+class DirectFileByteSource(FileByteSource):
+    """
+    A local file whose bulk reads bypass the page cache, so that streaming a whole disk doesn't evict everything else
+    from it. Reads of DIRECT_IO_MIN_READ bytes or more are made with O_DIRECT, widened to the alignment and passed
+    through a page aligned buffer; smaller reads, and the streams from open() used to parse the metadata, stay cached.
+    Where O_DIRECT isn't available, or the filesystem refuses it, bulk reads are made normally and then dropped from
+    the cache with posix_fadvise(POSIX_FADV_DONTNEED). Without os.preadv (Windows) every read is cached.
+    """
+    def __init__(self, path: os.PathLike, alignment=DIRECT_IO_MIN_ALIGNMENT):
+        super().__init__(path)
+        if alignment <= 0 or alignment & (alignment - 1):
+            raise ValueError("alignment must be a power of two")
+        self._alignment = max(DIRECT_IO_MIN_ALIGNMENT, alignment)
+        self._init_state()
+
+    def _init_state(self):
+        self._lock = threading.Lock()
+        self._fd = None
+        self._is_direct = False
+        self._allow_direct = hasattr(os, "O_DIRECT")
+        self._retired_fds = []  # O_DIRECT descriptors given up on, which other threads may still be reading from
+        self._buffers = threading.local()  # each thread has its own aligned buffer
+
+    def __getstate__(self):
+        # the descriptor and buffers stay with this process
+        state = self.__dict__.copy()
+        for key in ("_lock", "_fd", "_is_direct", "_allow_direct", "_retired_fds", "_buffers"):
+            del state[key]
+        return state
+
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+        self._init_state()
+
+    def _get_fd(self) -> typing.Tuple[int, bool]:
+        # returns the descriptor along with whether it is O_DIRECT, read together so a fall back can't come between
+        with self._lock:
+            if self._fd is None and self._allow_direct:
+                try:
+                    self._fd = os.open(self._path, os.O_RDONLY | os.O_DIRECT)
+                    self._is_direct = True
+                except OSError as ex:
+                    if ex.errno != errno.EINVAL:
+                        raise
+                    self._allow_direct = False
+                    _l(f"O_DIRECT isn't supported for {self._path}; dropping pages from the cache after reading "
+                       f"instead", to_stdout=DEBUG_TO_STDOUT)
+            if self._fd is None:
+                self._fd = os.open(self._path, os.O_RDONLY | getattr(os, "O_BINARY", 0))
+            return self._fd, self._is_direct
+
+    def _fall_back_to_cached(self, fd: int):
+        # the filesystem accepted O_DIRECT when opening but not for reading. Other threads may be part way through a
+        # read of the O_DIRECT descriptor, so rather than being closed (and its number reused by the next open) it is
+        # kept until close()
+        with self._lock:
+            self._allow_direct = False
+            if self._is_direct and self._fd == fd:
+                _l(f"O_DIRECT reads failed for {self._path}; dropping pages from the cache after reading instead",
+                   to_stdout=DEBUG_TO_STDOUT)
+                self._retired_fds.append(self._fd)
+                self._fd = None
+                self._is_direct = False
+
+    def _get_buffer(self) -> mmap.mmap:
+        buffer = getattr(self._buffers, "buffer", None)
+        if buffer is None:
+            buffer = mmap.mmap(-1, DIRECT_IO_BUFFER_SIZE)  # anonymous maps are page aligned
+            self._buffers.buffer = buffer
+        return buffer
+
+    def readinto_at(self, offset: int, view: memoryview) -> int:
+        if len(view) < DIRECT_IO_MIN_READ or not hasattr(os, "preadv"):
+            return super().readinto_at(offset, view)
+        fd, is_direct = self._get_fd()
+        if not is_direct:
+            filled = _pread_into(fd, view, offset)
+            if hasattr(os, "posix_fadvise"):
+                os.posix_fadvise(fd, offset, filled, os.POSIX_FADV_DONTNEED)
+            return filled
+
+        buffer = memoryview(self._get_buffer())
+        alignment = self._alignment
+        filled = 0
+        while filled < len(view):
+            position = offset + filled
+            skip = position % alignment
+            aligned_length = min(len(buffer), -(-(skip + len(view) - filled) // alignment) * alignment)
+            try:
+                count = os.preadv(fd, [buffer[:aligned_length]], position - skip)
+            except OSError as ex:
+                if ex.errno != errno.EINVAL:
+                    raise
+                self._fall_back_to_cached(fd)
+                return filled + self.readinto_at(position, view[filled:])
+            part_length = min(max(0, count - skip), len(view) - filled)
+            view[filled:filled + part_length] = buffer[skip:skip + part_length]
+            filled += part_length
+            if count < aligned_length:
+                break  # end of the file
+        return filled
+
+    def close(self):
+        with self._lock:
+            if self._fd is not None:
+                os.close(self._fd)
+                self._fd = None
+                self._is_direct = False
+            for fd in self._retired_fds:
+                os.close(fd)
+            self._retired_fds.clear()
+
+    @property
+    def is_direct(self) -> bool:
+        """True once bulk reads are being made with O_DIRECT, False if they fall back to posix_fadvise"""
+        return self._is_direct
+
+
+class MemoryByteSource(ByteSource):
+    def __init__(self, data: typing.Union[bytes, bytearray, memoryview], name="<memory>"):
+        self._data = data
+        self._name = name
+
+    def readinto_at(self, offset: int, view: memoryview) -> int:
+        data = memoryview(self._data).cast("B")[offset:offset + len(view)]
+        view[:len(data)] = data
+        return len(data)
+
+    @property
+    def size(self) -> int:
+        return memoryview(self._data).nbytes
+
+    @property
+    def name(self) -> str:
+        return self._name
+
+
+# URL scheme : callable taking the location and returning a ByteSource, see register_byte_source_opener
+_BYTE_SOURCE_OPENERS: typing.Dict[str, typing.Callable[[str], ByteSource]] = {}
+
+
+# callables taking a location and returning a ByteSource if they recognise it, otherwise None
+_BYTE_SOURCE_PROBES: typing.List[typing.Callable[[typing.Union[str, os.PathLike]], typing.Optional[ByteSource]]] = []
+
+
+def register_byte_source_opener(scheme: str, opener: typing.Callable[[str], ByteSource]):
+    """Makes open_byte_source (and so VhdxFile) open locations starting with scheme:// using opener"""
+    _BYTE_SOURCE_OPENERS[scheme.lower()] = opener
+
+
+def register_byte_source_probe(
+        probe: typing.Callable[[typing.Union[str, os.PathLike]], typing.Optional[ByteSource]]):
+    """Makes open_byte_source try probe on each location before anything else"""
+    _BYTE_SOURCE_PROBES.append(probe)
+
+
+def open_byte_source(location: typing.Union[ByteSource, str, os.PathLike]) -> ByteSource:
+    """
+    Returns the ByteSource for a location: a ByteSource is returned as is, then each registered probe is tried (see
+    sources.py for split segments and zip members), then a URL with a registered scheme is passed to its opener (see
+    sources.py for http and https), and anything else is taken to be the path of a local file.
+    """
+    if isinstance(location, ByteSource):
+        return location
+    for probe in _BYTE_SOURCE_PROBES:
+        source = probe(location)
+        if source is not None:
+            return source
+    if isinstance(location, str):
+        scheme, separator, _ = location.partition("://")
+        if separator and scheme.lower() in _BYTE_SOURCE_OPENERS:
+            return _BYTE_SOURCE_OPENERS[scheme.lower()](location)
+    return FileByteSource(location)
+
+
+def location_exists(location: typing.Union[ByteSource, str, os.PathLike]) -> bool:
+    """Returns True if open_byte_source can open the location and get its size"""
+    try:
+        source = open_byte_source(location)
+        if source.local_path is not None:
+            return source.local_path.is_file()
+        source.size
+    except (OSError, ValueError, VhdxError):
+        return False
+    return True
+
+
+class VirtualDiskStream(io.RawIOBase):
+    """A read-only, seekable file-like view of a range of a virtual disk (for example a single partition)"""
+    def __init__(self, disk: "_VirtualDisk", offset: int = 0, length: typing.Optional[int] = None):
+        super().__init__()
+        if length is None:
+            length = disk.virtual_disk_size - offset
+        if offset < 0 or length < 0 or offset + length > disk.virtual_disk_size:
+            raise ValueError("Range is outside of the virtual disk")
+        self._disk = disk
+        self._origin = offset
+        self._length = length
+        self._position = 0
+
+    def readable(self):
+        return True
+
+    def seekable(self):
+        return True
+
+    def tell(self):
+        return self._position
+
+    def seek(self, offset, whence=os.SEEK_SET):
+        if whence == os.SEEK_SET:
+            position = offset
+        elif whence == os.SEEK_CUR:
+            position = self._position + offset
+        elif whence == os.SEEK_END:
+            position = self._length + offset
+        else:
+            raise ValueError(f"Invalid whence ({whence})")
+        if position < 0:
+            raise ValueError("Negative seek position")
+        self._position = position
+        return self._position
+
+    def read(self, size=-1):
+        if size is None or size < 0:
+            size = self._length - self._position
+        buffer = bytearray(max(0, min(size, self._length - self._position)))
+        self.readinto(buffer)
+        return bytes(buffer)
+
+    def readall(self):
+        return self.read()
+
+    def readinto(self, buffer):
+        view = memoryview(buffer).cast("B")
+        size = max(0, min(len(view), self._length - self._position))
+        filled = self._disk.readinto(view[:size], self._origin + self._position)
+        self._position += filled
+        return filled
+
+    @property
+    def length(self):
+        return self._length
+
+
+class _VirtualDisk:
+    """
+    Block level reading of a virtual disk shared by VhdxFile and VhdxChain. Subclasses provide block_size,
+    virtual_disk_size, is_block_sparse and _readinto_block.
+    """
+    _ZERO_TAG_UNKNOWN = 0
+    _ZERO_TAG_DATA = 1
+    _ZERO_TAG_ZERO = 2
+
+    _zero_tags = None  # one byte per payload block, created on first use
+
+    def _readinto_block(self, block_index: int, offset_in_block: int, view: memoryview):
+        """Fills view with the data of a payload block which is not sparse, starting from offset_in_block"""
+        raise NotImplementedError()
+
+    def is_block_sparse(self, block_index: int) -> bool:
+        raise NotImplementedError()
+
+    def _readinto_linear(self, block_index: int, offset_in_block: int, view: memoryview) -> int:
+        """
+        If the payload block is in a run of blocks laid out consecutively in the file, fills as much of view as the run
+        covers with a single read and returns the number of bytes filled; otherwise returns 0
+        """
+        return 0
+
+    def locate(self, offset: int) -> typing.Tuple["VhdxFile", typing.Optional[int]]:
+        """
+        Returns the VHDX file which the byte at a virtual disk offset is read from, and its offset in that file (None
+        where it reads as zeros without being stored)
+        """
+        raise NotImplementedError()
+
+    def _get_zero_tags(self) -> bytearray:
+        if self._zero_tags is None:
+            self._zero_tags = bytearray(self.payload_block_count)
+        return self._zero_tags
+
+    def get_virtual_block(self, block_index: int) -> bytearray:
+        """
+        Returns the payload block as it appears on the virtual disk (the final block is truncated to the end of the
+        disk), in a new bytearray which the caller owns. Blocks which are read from the file are checked for being
+        entirely zero and tagged accordingly.
+        """
+        block = bytearray(self.get_block_length(block_index))
+        if not self.is_block_sparse(block_index):
+            self.readinto(block, block_index * self.block_size)
+        return block
+
+    def is_block_zero(self, block_index: int, *, check=True) -> bool:
+        """
+        Returns True if the payload block reads as zeros, either because it is sparse or because it is allocated but
+        its data is all zeros. If check is False only blocks already tagged (by a previous read) are reported as zero,
+        so no data is read.
+        """
+        if self.is_block_sparse(block_index):
+            return True
+        zero_tags = self._get_zero_tags()
+        if zero_tags[block_index] == _VirtualDisk._ZERO_TAG_UNKNOWN and check:
+            self.get_virtual_block(block_index)
+        return zero_tags[block_index] == _VirtualDisk._ZERO_TAG_ZERO
+
+    def get_block_length(self, block_index: int) -> int:
+        if block_index < 0 or block_index >= self.payload_block_count:
+            raise ValueError("Block index out of range")
+        return min(self.block_size, self.virtual_disk_size - (block_index * self.block_size))
+
+    def readinto(self, buffer, virtual_offset: int) -> int:
+        """
+        Fills a caller-owned writable buffer with data from the virtual disk starting at virtual_offset, returning the
+        number of bytes filled (fewer than the length of the buffer at the end of the disk). Sparse areas are zeroed in
+        place and data is read from the file straight into the buffer. Whole blocks are tagged as zero or not as they
+        are read.
+        """
+        if virtual_offset < 0:
+            raise ValueError("Offset cannot be negative")
+        view = memoryview(buffer).cast("B")
+        end = min(virtual_offset + len(view), self.virtual_disk_size)
+        position = virtual_offset
+        while position < end:
+            block_index = position // self.block_size
+            offset_in_block = position % self.block_size
+            remaining = view[position - virtual_offset:end - virtual_offset]
+            part_length = self._readinto_linear(block_index, offset_in_block, remaining)
+            if part_length:
+                self._tag_zero_blocks(position, remaining[:part_length])
+                position += part_length
+                continue
+
+            part_length = min(self.block_size - offset_in_block, end - position)
+            part = remaining[:part_length]
+            if self.is_block_sparse(block_index):
+                zero_fill(part)
+            else:
+                self._readinto_block(block_index, offset_in_block, part)
+                self._tag_zero_blocks(position, part)
+            position += part_length
+
+        return max(end - virtual_offset, 0)
+
+    def iter_blocks(self, offset: int = 0, length: typing.Optional[int] = None, *, read_size=BULK_READ_SIZE):
+        """
+        Yields (virtual_offset, length, data) for each payload block in a range of the virtual disk (or the part of it
+        inside the range) in order. data is None for sparse blocks, which are not read at all, and otherwise a
+        memoryview of the block which is only valid until the next block is yielded. Runs of blocks which aren't sparse
+        are read with a single readinto of up to read_size bytes (or one block, if larger), so blocks stored one after
+        another in the file are read with a few large reads rather than one read per block.
+        """
+        if length is None:
+            length = self.virtual_disk_size - offset
+        if offset < 0 or length < 0 or offset + length > self.virtual_disk_size:
+            raise ValueError("Range is outside of the virtual disk")
+        end = offset + length
+        buffer_length = min(max(read_size, self.block_size), length)
+        buffer = None
+        position = offset
+        while position < end:
+            block_index = position // self.block_size
+            block_end = min((block_index + 1) * self.block_size, end)
+            if self.is_block_sparse(block_index):
+                yield position, block_end - position, None
+                position = block_end
+                continue
+
+            span_end = block_end
+            while span_end < end and not self.is_block_sparse(span_end // self.block_size):
+                next_end = min(span_end + self.block_size, end)
+                if next_end - position > buffer_length:
+                    break
+                span_end = next_end
+            if buffer is None:
+                buffer = memoryview(bytearray(buffer_length))
+            view = buffer[:span_end - position]
+            self.readinto(view, position)
+            span_start = position
+            while position < span_end:
+                block_end = min((position // self.block_size + 1) * self.block_size, span_end)
+                yield position, block_end - position, view[position - span_start:block_end - span_start]
+                position = block_end
+
+    def _tag_zero_blocks(self, virtual_offset: int, view: memoryview):
+        # tags each whole block in view (read from the file, starting at virtual_offset) which is not yet tagged
+        zero_tags = self._get_zero_tags()
+        block_index = -(-virtual_offset // self.block_size)
+        while block_index < len(zero_tags):
+            start = block_index * self.block_size - virtual_offset
+            end = start + self.get_block_length(block_index)
+            if end > len(view):
+                break
+            if zero_tags[block_index] == _VirtualDisk._ZERO_TAG_UNKNOWN:
+                zero_tags[block_index] = \
+                    _VirtualDisk._ZERO_TAG_ZERO if is_zero_buffer(view[start:end]) else _VirtualDisk._ZERO_TAG_DATA
+            block_index += 1
+
+    def read(self, offset: int, length: int) -> bytearray:
+        """
+        Reads length bytes from the virtual disk starting at offset into a new bytearray which the caller owns (reads
+        are truncated at the end of the disk)
+        """
+        if offset < 0 or length < 0:
+            raise ValueError("Offset and length cannot be negative")
+        buffer = bytearray(max(0, min(offset + length, self.virtual_disk_size) - offset))
+        self.readinto(buffer, offset)
+        return buffer
+
+    def open_stream(self, offset: int = 0, length: typing.Optional[int] = None) -> VirtualDiskStream:
+        return VirtualDiskStream(self, offset, length)
+
+    @property
+    def allocated_zero_block_count(self) -> int:
+        """The number of payload blocks read so far which were allocated in the file but contained only zeros"""
+        return self._get_zero_tags().count(_VirtualDisk._ZERO_TAG_ZERO)
+
+    @property
+    def block_size(self) -> int:
+        raise NotImplementedError()
+
+    @property
+    def virtual_disk_size(self) -> int:
+        raise NotImplementedError()
+
+    @property
+    def payload_block_count(self) -> int:
+        return -(-self.virtual_disk_size // self.block_size)
+
+
 """
 fallback_metas must define keys for;
     LogicalSectorSize
     PhysicalSectorSize
     BlockSize
 A sensible fallback metas object is provided in SENSIBLE_FALLBACK_METAS
+bat_region and metadata_region can be (offset, length) tuples to use in place of the region table's entries, for
+example those found by recovery.locate_bat_candidates when both region tables are damaged
+in_path can be a local path, a ByteSource or a URL which open_byte_source recognises
+direct_io makes bulk payload reads of a local file bypass the page cache (see DirectFileByteSource)
 """
-class VhdxFile:
-    def __init__(self, in_path, *, ignore_faults=False, fallback_metas=None):
-        self._file_path = pathlib.Path(in_path)
+class VhdxFile(_VirtualDisk):
+    def __init__(self, in_path, *, ignore_faults=False, fallback_metas=None, bat_region=None, metadata_region=None,
+                 sector_bitmap_cache_size=SECTOR_BITMAP_CACHE_SIZE, direct_io=False):
+        self._source = open_byte_source(in_path)
+        self._file_path = self._source.local_path or pathlib.Path(self._source.name)
+        self._ignore_faults = ignore_faults
         # TODO: If fallback_metas present check that the required keys are there
-        with self._file_path.open("rb") as f:
+        with self._source.open() as f:
 
             file_identifier = FileIdentifier.from_stream(f, ignore_faults=ignore_faults)
 
@@ -510,17 +1463,50 @@ class VhdxFile:
                to_stdout=DEBUG_TO_STDOUT)
 
             # TODO: which one is current? should we consult the log?
-            region_table_a = RegionTable.from_stream(f)
-            region_table_b = RegionTable.from_stream(f)
+            region_tables = []
+            for region_table_offset in REGION_TABLE_OFFSETS:
+                f.seek(region_table_offset)
+                try:
+                    region_tables.append(RegionTable.from_stream(f, ignore_faults=ignore_faults))
+                except (VhdxHeaderError, ValueError) as e:
+                    if not ignore_faults:
+                        raise
+                    _l(f"WARNING: Could not read the region table at offset {region_table_offset}: {e}",
+                       to_stdout=DEBUG_TO_STDOUT)
+
             # for now we'll just compare...
-            if len(region_table_a) != len(region_table_b):
-                raise ValueError("region tables do not match")
-            for key in region_table_a:
-                if region_table_a[key] != region_table_b[key]:
-                    raise ValueError("region tables do not match")
+            if len(region_tables) == 2:
+                region_table_a, region_table_b = region_tables
+                tables_match = len(region_table_a) == len(region_table_b) and all(
+                    key in region_table_b and region_table_a[key] == region_table_b[key] for key in region_table_a)
+                if not tables_match:
+                    if ignore_faults:
+                        _l("WARNING: region tables do not match, using the first", to_stdout=DEBUG_TO_STDOUT)
+                    else:
+                        raise ValueError("region tables do not match")
 
             # if they match just use the first
-            region_table = region_table_a
+            if region_tables:
+                region_table = region_tables[0]
+            elif bat_region is not None:
+                _l("WARNING: No usable region table, continuing with the provided regions",
+                   to_stdout=DEBUG_TO_STDOUT)
+                region_table = RegionTable({})
+            else:
+                raise VhdxHeaderError("Neither region table could be read")
+
+            region_overrides = [(guid, region) for guid, region in
+                                ((REGION_GUID_BAT, bat_region), (REGION_GUID_METADATA, metadata_region))
+                                if region is not None]
+            if region_overrides:
+                region_entries = {key: region_table[key] for key in region_table}
+                for guid, (region_offset, region_length) in region_overrides:
+                    _l(f"Using provided region for {guid} at offset {region_offset} (length {region_length})",
+                       to_stdout=DEBUG_TO_STDOUT)
+                    region_entries[guid_to_blob(guid)] = RegionTableEntry(
+                        guid_to_blob(guid), region_offset, region_length, True)
+                region_table = RegionTable(region_entries)
+
             self._header = current_header
             self._region_table = region_table
 
@@ -529,12 +1515,22 @@ class VhdxFile:
                 meta_info = self._region_table[guid_to_blob(REGION_GUID_METADATA)]
                 _l(f"Metadata region at offset {meta_info.offset}", to_stdout=DEBUG_TO_STDOUT)
                 f.seek(meta_info.offset)
-                metas = MetadataTable.from_stream(f, ignore_faults=ignore_faults)
+                try:
+                    metas = MetadataTable.from_stream(f, ignore_faults=ignore_faults)
+                except (VhdxError, ValueError, KeyError) as e:
+                    # a damaged table: an unknown item id, or an entry count or item offset running off the region
+                    if not (ignore_faults and fallback_metas):
+                        raise
+                    _l(f"WARNING: Could not parse the metadata table: {e}", to_stdout=DEBUG_TO_STDOUT)
+                if metas and ignore_faults and fallback_metas and \
+                        any(key not in metas for key in ("BlockSize", "LogicalSectorSize", "PhysicalSectorSize")):
+                    _l("WARNING: The metadata table is missing required items", to_stdout=DEBUG_TO_STDOUT)
+                    metas = None
             else:
                 if ignore_faults and fallback_metas:
                     _l("WARNING: No metadata block defined, falling back to provided metadata",
                        to_stdout=DEBUG_TO_STDOUT)
-                    metas = fallback_metas
+                    # metas is left as None, so is filled in from the fallback below
                 else:
                     raise VhdxHeaderError("No metadata block defined")
 
@@ -558,6 +1554,9 @@ class VhdxFile:
                                          f"{MAX_INFERRED_SIZE} (increase MAX_INFERRED_SIZE if required)")
                     metas["VirtualDiskSize"] = inferred_size
                     _l(f"VirtualDiskSize inferred size: {inferred_size}")
+                if "HasParent" not in metas:
+                    _l("WARNING: HasParent not in fallback metadata, assuming not differencing")
+                    metas["HasParent"] = False
                 self._using_fallback_metas = True
 
             # TODO: "user" should have to define defaults for more stuff if things fail
@@ -570,14 +1569,26 @@ class VhdxFile:
             self._physical_sector_size = self._metas["PhysicalSectorSize"]
             self._block_size = self._metas["BlockSize"]
 
+            if direct_io:
+                # payload reads bypass the page cache from here on; the metadata parsed above stayed cached
+                if self._source.local_path is not None:
+                    alignment = self._physical_sector_size if self._physical_sector_size in (512, 4096) \
+                        else DIRECT_IO_MIN_ALIGNMENT
+                    self._source = DirectFileByteSource(self._source.local_path, alignment)
+                else:
+                    _l(f"WARNING: direct I/O is only possible for local files, {self._source.name} will be read "
+                       f"through the cache", to_stdout=DEBUG_TO_STDOUT)
+
             self._chunk_ratio = ((1 << 23) * self._logical_sector_size) // self._block_size
             _l(f"Chunk Ratio = (2**23 * LogicalSectorSize) / BlockSize", debug_only=True, to_stdout=DEBUG_TO_STDOUT)
             _l(f"Chunk Ratio = (2**23 * {self._logical_sector_size}) / {self._block_size} = {self._chunk_ratio}",
                to_stdout=DEBUG_TO_STDOUT)
 
-            self._sector_bitmap_cache = {}  # chunk number : sector bitmap page
-            self._empty_block = b"\x00" * self._block_size  # this could actually be up to 256 MB
-            self._empty_sector = b"\x00" * self._logical_sector_size
+            self._sector_bitmap_cache = _SectorBitmapCache(sector_bitmap_cache_size)
+            self._raw_bat = None  # decoded on first use, see _get_raw_bat
+            self._allocated_sector_runs = None  # flat (first sector, sector count) pairs, see _use_index
+            self._linear_runs = None  # built from the BAT on first use, see _get_linear_runs
+            self._index_mmap = None
 
     def _get_bat_index_for_logical_sector(self, sector_number: int):
         if sector_number > self.metas["VirtualDiskSize"] // self.metas["LogicalSectorSize"] or sector_number < 0:
@@ -588,7 +1599,7 @@ class VhdxFile:
         return actual_index
 
     def get_bat_entry_for_logical_sector(self, sector_number: int):
-        with self._file_path.open("rb") as f:
+        with self._source.open() as f:
             if sector_number > self.metas["VirtualDiskSize"] // self.metas["LogicalSectorSize"] or sector_number < 0:
                 raise ValueError("Sector number out of range")
             bat_offset = self._region_table[guid_to_blob(REGION_GUID_BAT)].offset
@@ -598,25 +1609,171 @@ class VhdxFile:
 
     def get_block(self, bat_entry: BatEntry):
         if bat_entry.state == BatPayloadBlockState.BAT_PAYLOAD_BLOCK_ZERO:
-            return self._empty_block
+            return bytes(self._block_size)
         elif bat_entry.state in (BatPayloadBlockState.BAT_PAYLOAD_BLOCK_NOT_PRESENT,
                                  BatPayloadBlockState.BAT_PAYLOAD_BLOCK_UNDEFINED,
                                  BatPayloadBlockState.BAT_PAYLOAD_BLOCK_UNMAPPED) and bat_entry.offset == 0:
-            return self._empty_block
-        with self._file_path.open("rb") as f:
-            f.seek(bat_entry.offset, os.SEEK_SET)
-            return f.read(self.metas["BlockSize"])
+            return bytes(self._block_size)
+        return self._source.read_at(bat_entry.offset, self.metas["BlockSize"])
 
     def iter_bat_payload_entries(self):
-        with self._file_path.open("rb") as f:
-            f.seek(self._region_table[guid_to_blob(REGION_GUID_BAT)].offset)
-            # the below value is based on the size of the region
-            # TODO: should I use the equations for the different vhdx types?
-            raw_entry_count = self._region_table[guid_to_blob(REGION_GUID_BAT)].length // 8
-            for i in range(raw_entry_count):
-                if i > 0 and i % (self._chunk_ratio + 1) == 0:
-                    BatEntry.from_stream(f)  # skip sector bitmap
-                yield BatEntry.from_stream(f)
+        # only the entries the disk needs are read; a BAT region can be longer than that (and one given by hand may run
+        # on into whatever follows it)
+        sector_bitmap_period = self._chunk_ratio + 1
+        bat = self._get_raw_bat()
+        for i in range(min(len(bat), self.bat_entry_count)):
+            raw_entry = bat[i]
+            if (i + 1) % sector_bitmap_period == 0:
+                continue  # skip sector bitmap
+            yield BatEntry.from_raw(raw_entry)
+
+    def _get_raw_bat(self) -> typing.Sequence[int]:
+        # The whole BAT (sector bitmap entries included) is read in one go and kept as raw 64-bit values, which is far
+        # cheaper than a seek and read per entry when walking the disk.
+        if self._raw_bat is None:
+            bat_region = self._region_table[guid_to_blob(REGION_GUID_BAT)]
+            raw = self._source.read_at(bat_region.offset, bat_region.length)
+            if len(raw) < bat_region.length:
+                if self._ignore_faults:
+                    _l(f"WARNING: BAT region truncated (Expected: {bat_region.length} bytes; got: {len(raw)})",
+                       to_stdout=DEBUG_TO_STDOUT)
+                else:
+                    raise VhdxError(
+                        f"BAT region truncated (Expected: {bat_region.length} bytes; got: {len(raw)})")
+            bat = array.array("Q")
+            bat.frombytes(raw[:len(raw) - (len(raw) % 8)])
+            if sys.byteorder != "little":
+                bat.byteswap()
+            self._raw_bat = bat
+
+        return self._raw_bat
+
+    def get_payload_bat_entry(self, block_index: int) -> BatEntry:
+        if block_index < 0 or block_index >= self.payload_block_count:
+            raise ValueError("Block index out of range")
+        bat = self._get_raw_bat()
+        bat_index = block_index + (block_index // self._chunk_ratio)
+        if bat_index >= len(bat):
+            if self._ignore_faults:
+                _l(f"WARNING: BAT entry {bat_index} is beyond the end of the BAT, treating as not present",
+                   to_stdout=DEBUG_TO_STDOUT)
+                return BatEntry(BatPayloadBlockState.BAT_PAYLOAD_BLOCK_NOT_PRESENT, 0)
+            raise VhdxError(f"BAT entry {bat_index} is beyond the end of the BAT")
+        return BatEntry.from_raw(bat[bat_index])
+
+    def _use_index(self, raw_bat: typing.Sequence[int], allocated_sector_runs: typing.Sequence[int], index_mmap=None):
+        """
+        Takes the BAT and the runs of allocated sectors (flattened (first sector, sector count) pairs in sector order)
+        from a sidecar index (see sidecar.py) rather than reading them from the file. Either may be a memoryview onto
+        index_mmap, which is kept open for as long as the VhdxFile is.
+        """
+        self._raw_bat = raw_bat
+        self._allocated_sector_runs = allocated_sector_runs if self.is_differencing else None
+        self._sector_bitmap_cache.clear()
+        self._linear_runs = None
+        self._index_mmap = index_mmap
+
+    def _sector_bitmap_from_runs(self, chunk_index: int) -> SectorBitmap:
+        chunk_start = chunk_index * SectorBitmap.BIT_COUNT
+        chunk_end = chunk_start + SectorBitmap.BIT_COUNT
+        runs = self._allocated_sector_runs
+        run_starts = runs[0::2]
+        run_index = max(bisect.bisect_right(run_starts, chunk_start) - 1, 0)
+        chunk_runs = []
+        while run_index < len(run_starts) and run_starts[run_index] < chunk_end:
+            first = max(runs[run_index * 2], chunk_start)
+            end = min(runs[run_index * 2] + runs[run_index * 2 + 1], chunk_end)
+            if end > first:
+                chunk_runs.append((first - chunk_start, end - first))
+            run_index += 1
+        return SectorBitmap.from_runs(chunk_runs)
+
+    def iter_allocated_sector_runs(self):
+        """
+        Yields (first_sector, sector_count) for each run of sectors allocated in this file, in order. Every sector of
+        a file which isn't differencing is allocated.
+        """
+        sector_count = -(-self.virtual_disk_size // self._logical_sector_size)
+        if not self.is_differencing:
+            if sector_count:
+                yield 0, sector_count
+            return
+        if self._allocated_sector_runs is not None:
+            runs = self._allocated_sector_runs
+            for i in range(0, len(runs), 2):
+                yield runs[i], runs[i + 1]
+            return
+
+        sectors_per_bitmap = SectorBitmap.BIT_COUNT
+        run_first = run_end = None
+        for chunk_index in range(-(-sector_count // sectors_per_bitmap)):
+            sector_bitmap = self._get_sector_bitmap(chunk_index)
+            chunk_start = chunk_index * sectors_per_bitmap
+            bit_count = min(sectors_per_bitmap, sector_count - chunk_start)
+            for first, count, is_set in sector_bitmap.iter_runs(0, bit_count):
+                if not is_set:
+                    continue
+                if run_end == chunk_start + first:
+                    run_end += count  # carries on from the end of the previous chunk
+                    continue
+                if run_first is not None:
+                    yield run_first, run_end - run_first
+                run_first, run_end = chunk_start + first, chunk_start + first + count
+        if run_first is not None:
+            yield run_first, run_end - run_first
+
+    def _get_sector_bitmap(self, chunk_index: int) -> SectorBitmap:
+        # sector bitmaps which are not present are EMPTY
+        sector_bitmap = self._sector_bitmap_cache.get(chunk_index)
+        if sector_bitmap is not None:
+            return sector_bitmap
+        if self._allocated_sector_runs is not None:
+            sector_bitmap = self._sector_bitmap_from_runs(chunk_index)
+            self._sector_bitmap_cache.put(chunk_index, sector_bitmap)
+            return sector_bitmap
+
+        bat_index_for_sector_bitmap = chunk_index + ((1 + chunk_index) * self._chunk_ratio)
+        bat = self._get_raw_bat()
+        if bat_index_for_sector_bitmap < len(bat):
+            sector_bitmap_bat_entry = BatEntry.from_raw(bat[bat_index_for_sector_bitmap])
+        elif self._ignore_faults:
+            _l(f"WARNING: Sector bitmap BAT entry {bat_index_for_sector_bitmap} is beyond the end of the BAT, "
+               f"treating as not present", to_stdout=DEBUG_TO_STDOUT)
+            sector_bitmap_bat_entry = BatEntry(BatPayloadBlockState(BAT_SB_BLOCK_NOT_PRESENT), 0)
+        else:
+            raise VhdxError(f"Sector bitmap BAT entry {bat_index_for_sector_bitmap} is beyond the end of the BAT")
+
+        if sector_bitmap_bat_entry.state == BAT_SB_BLOCK_NOT_PRESENT:
+            sector_bitmap = SectorBitmap.EMPTY
+        elif sector_bitmap_bat_entry.state == BAT_SB_BLOCK_PRESENT:
+            # always a microsoft megabyte
+            sector_bitmap = SectorBitmap.from_bytes(self._source.read_at(sector_bitmap_bat_entry.offset, 1 << 20))
+        else:
+            raise ValueError(f"Invalid Sector Bitmap BAT entry state {sector_bitmap_bat_entry.state}")
+
+        self._sector_bitmap_cache.put(chunk_index, sector_bitmap)
+        return sector_bitmap
+
+    def _iter_sector_allocation(self, first_sector: int, sector_count: int):
+        """
+        Yields (first_sector, sector_count, is_allocated) runs, relative to first_sector, covering a range of sectors
+        which must not cross a chunk boundary (which always holds within a payload block).
+        """
+        chunk_index = first_sector // SectorBitmap.BIT_COUNT
+        index_in_sb = first_sector % SectorBitmap.BIT_COUNT
+        if index_in_sb + sector_count > SectorBitmap.BIT_COUNT:
+            raise ValueError("Sector range crosses a sector bitmap boundary")
+        if not self.is_differencing:
+            yield 0, sector_count, True
+            return
+        yield from self._get_sector_bitmap(chunk_index).iter_runs(index_in_sb, sector_count)
+
+    def has_allocated_sectors(self, first_sector: int, sector_count: int) -> bool:
+        """Returns True if any of the sectors in the (payload block aligned) range are allocated in this file"""
+        if not self.is_differencing:
+            return True
+        return self._get_sector_bitmap(first_sector // SectorBitmap.BIT_COUNT).any_set(
+            first_sector % SectorBitmap.BIT_COUNT, sector_count)
 
     def is_sector_allocated(self, sector_number):
         if sector_number > self.metas["VirtualDiskSize"] // self.metas["LogicalSectorSize"] or sector_number < 0:
@@ -627,52 +1784,126 @@ class VhdxFile:
 
         bat_index = (sector_number * self._logical_sector_size) // self._block_size
         chunk_index = bat_index // self._chunk_ratio
-        bat_index_for_sector_bitmap = chunk_index + ((1 + chunk_index) * self._chunk_ratio)
-
-        if chunk_index in self._sector_bitmap_cache:
-            sector_bitmap = self._sector_bitmap_cache[chunk_index]
-        else:
-            with self._file_path.open("rb") as f:
-                f.seek(self._region_table[guid_to_blob(REGION_GUID_BAT)].offset + (bat_index_for_sector_bitmap * 8))
-                sector_bitmap_bat_entry = BatEntry.from_stream(f)
-
-            if sector_bitmap_bat_entry.state == BAT_SB_BLOCK_NOT_PRESENT:
-                self._sector_bitmap_cache[chunk_index] = None
-                sector_bitmap = None
-            elif sector_bitmap_bat_entry.state == BAT_SB_BLOCK_PRESENT:
-                with self._file_path.open("rb") as f:
-                    f.seek(sector_bitmap_bat_entry.offset,  os.SEEK_SET)
-                    sector_bitmap = f.read(1 << 23)  # always a microsoft megabyte
-                self._sector_bitmap_cache[chunk_index] = sector_bitmap
-            else:
-                raise ValueError(f"Invalid Sector Bitmap BAT entry state {sector_bitmap_bat_entry.state}")
-
-        if sector_bitmap is None:
-            return False
-        else:
-            sectors_per_bitmap = 1 << 23
-            index_in_sb = sector_number % sectors_per_bitmap
-            byte_offset = index_in_sb // 8
-            bit_offset = index_in_sb % 8
+        return self._get_sector_bitmap(chunk_index).is_set(sector_number % SectorBitmap.BIT_COUNT)
 
-            return (sector_bitmap[byte_offset] >> bit_offset) & 1 != 0
+    def is_block_sparse(self, block_index: int) -> bool:
+        """
+        Returns True if the payload block reads as zeros without any payload data needing to be read from the file
+        """
+        bat_entry = self.get_payload_bat_entry(block_index)
+        if bat_entry.state == BatPayloadBlockState.BAT_PAYLOAD_BLOCK_ZERO:
+            return True
+        elif bat_entry.state in (BatPayloadBlockState.BAT_PAYLOAD_BLOCK_NOT_PRESENT,
+                                 BatPayloadBlockState.BAT_PAYLOAD_BLOCK_UNDEFINED,
+                                 BatPayloadBlockState.BAT_PAYLOAD_BLOCK_UNMAPPED) and bat_entry.offset == 0:
+            return True
+        sectors_per_block = self._block_size // self._logical_sector_size
+        return not self.has_allocated_sectors(block_index * sectors_per_block, sectors_per_block)
+
+    def locate(self, offset: int) -> typing.Tuple["VhdxFile", typing.Optional[int]]:
+        if offset < 0 or offset >= self.virtual_disk_size:
+            raise ValueError("Offset is outside of the virtual disk")
+        bat_entry = self.get_payload_bat_entry(offset // self._block_size)
+        if bat_entry.state == BatPayloadBlockState.BAT_PAYLOAD_BLOCK_ZERO or bat_entry.offset == 0:
+            return self, None
+        if self.is_differencing and not self.is_sector_allocated(offset // self._logical_sector_size):
+            return self, None
+        return self, bat_entry.offset + (offset % self._block_size)
+
+    def __getstate__(self):
+        # caches are rebuilt on demand, so are left out when sending the file to another process
+        state = self.__dict__.copy()
+        state["_sector_bitmap_cache"] = _SectorBitmapCache(self._sector_bitmap_cache.max_size)
+        state["_raw_bat"] = None
+        state["_allocated_sector_runs"] = None
+        state["_index_mmap"] = None
+        state.pop("_zero_tags", None)
+        return state
+
+    def _get_linear_runs(self) -> typing.Tuple[array.array, array.array, array.array]:
+        """
+        Returns the offset translation table of a file which isn't differencing: (first block, end block, file offset
+        of first block) for each run of at least MIN_LINEAR_RUN_BLOCKS present payload blocks which are stored one after
+        another in the file. A fixed disk is a single run.
+        """
+        if self._linear_runs is None:
+            first_blocks, end_blocks, file_offsets = array.array("Q"), array.array("Q"), array.array("Q")
+            if not self.is_differencing:
+                bat = self._get_raw_bat()
+                mb = 1 << 20
+                live_states = (BatPayloadBlockState.BAT_PAYLOAD_BLOCK_FULLY_PRESENT,
+                               BatPayloadBlockState.BAT_PAYLOAD_BLOCK_PARTIALLY_PRESENT)
+                run_first = run_offset = None
+                block_count = self.payload_block_count
+                for block_index in range(block_count + 1):
+                    bat_index = block_index + (block_index // self._chunk_ratio)
+                    file_offset = None
+                    if block_index < block_count and bat_index < len(bat) and (bat[bat_index] & 0x07) in live_states:
+                        file_offset = ((bat[bat_index] >> 20) & 0xfffffffffff) * mb or None
+                    if run_first is not None and \
+                            file_offset == run_offset + (block_index - run_first) * self._block_size:
+                        continue
+                    if run_first is not None and block_index - run_first >= MIN_LINEAR_RUN_BLOCKS:
+                        first_blocks.append(run_first)
+                        end_blocks.append(block_index)
+                        file_offsets.append(run_offset)
+                    run_first, run_offset = (block_index, file_offset) if file_offset is not None else (None, None)
+            self._linear_runs = first_blocks, end_blocks, file_offsets
+            _l(f"{len(first_blocks)} runs of linearly stored payload blocks", debug_only=True,
+               to_stdout=DEBUG_TO_STDOUT)
 
-    def get_sector(self, sector_number: int):
+        return self._linear_runs
+
+    def iter_linear_runs(self):
+        """
+        Yields (virtual_offset, length, file_offset) for each run of payload blocks which is stored in virtual order at
+        consecutive offsets in the file (always empty for differencing files)
+        """
+        for first_block, end_block, file_offset in zip(*self._get_linear_runs()):
+            virtual_offset = first_block * self._block_size
+            yield virtual_offset, min(end_block * self._block_size, self.virtual_disk_size) - virtual_offset, file_offset
+
+    def _readinto_linear(self, block_index: int, offset_in_block: int, view: memoryview) -> int:
+        first_blocks, end_blocks, file_offsets = self._get_linear_runs()
+        run_index = bisect.bisect_right(first_blocks, block_index) - 1
+        if run_index < 0 or block_index >= end_blocks[run_index]:
+            return 0
+        offset_in_run = (block_index - first_blocks[run_index]) * self._block_size + offset_in_block
+        length = min(len(view), (end_blocks[run_index] - block_index) * self._block_size - offset_in_block)
+        self._readinto_from_file(file_offsets[run_index] + offset_in_run, view[:length], block_index)
+        return length
+
+    def _readinto_from_file(self, file_offset: int, view: memoryview, block_index: int):
+        filled = self._source.readinto_at(file_offset, view)
+        if filled < len(view):
+            if self._ignore_faults:
+                _l(f"WARNING: Payload block {block_index} truncated, padding with zeros", to_stdout=DEBUG_TO_STDOUT)
+                zero_fill(view[filled:])
+            else:
+                raise VhdxError(f"Payload block {block_index} truncated")
+
+    def _readinto_block(self, block_index: int, offset_in_block: int, view: memoryview):
+        bat_entry = self.get_payload_bat_entry(block_index)
+        self._readinto_from_file(bat_entry.offset + offset_in_block, view, block_index)
+
+        if self.is_differencing:
+            # sectors not allocated in a differencing file read as zeros
+            sector_size = self._logical_sector_size
+            sectors_per_block = self._block_size // sector_size
+            view_end = offset_in_block + len(view)
+            for first, count, is_set in self._iter_sector_allocation(
+                    block_index * sectors_per_block, -(-view_end // sector_size)):
+                start = max(first * sector_size, offset_in_block)
+                end = min((first + count) * sector_size, view_end)
+                if not is_set and end > start:
+                    zero_fill(view[start - offset_in_block:end - offset_in_block])
+
+    def get_sector(self, sector_number: int) -> bytearray:
         if sector_number > self.metas["VirtualDiskSize"] // self.metas["LogicalSectorSize"] or sector_number < 0:
             raise ValueError("Sector number out of range")
-        bat_entry = self.get_bat_entry_for_logical_sector(sector_number)
-        if self.is_sector_allocated(sector_number):
-            block = self.get_block(bat_entry)
-            sectors_per_block = self.block_size // self.logical_sector_size
-            sector_index_in_block = sector_number % sectors_per_block
-            sector_data = block[sector_index_in_block * self.metas["LogicalSectorSize"]:
-                                (1 + sector_index_in_block) * self.metas["LogicalSectorSize"]:]
-            if len(sector_data) != self.metas["LogicalSectorSize"]:
-                raise ValueError("Couldn't get full sector from block")  # should never happen. hence exception.
-
-            return sector_data
-        else:
-            return self._empty_sector
+        sector = bytearray(self._logical_sector_size)
+        self.readinto(sector, sector_number * self._logical_sector_size)
+        return sector
 
     def get_meta_entry(self, key):
         return self._metas[key]
@@ -713,6 +1944,136 @@ class VhdxFile:
     def virtual_disk_size(self):
         return self.metas["VirtualDiskSize"]
 
+    @property
+    def file_path(self):
+        return self._file_path
+
+    @property
+    def source(self) -> ByteSource:
+        return self._source
+
+    @property
+    def file_size(self):
+        return self._source.size
+
+    @property
+    def chunk_ratio(self):
+        return self._chunk_ratio
+
+    @property
+    def raw_bat(self) -> typing.Sequence[int]:
+        """Every BAT entry (sector bitmap entries included) as raw 64-bit values; treat as read-only"""
+        return self._get_raw_bat()
+
+    @property
+    def bat_entry_count(self) -> int:
+        """The number of BAT entries (payload and sector bitmap) the disk needs, whatever the size of the BAT region"""
+        block_count = self.payload_block_count
+        if self.is_differencing:
+            return -(-block_count // self._chunk_ratio) * (self._chunk_ratio + 1)
+        return block_count + ((block_count - 1) // self._chunk_ratio)
+
+
+class VhdxChain(_VirtualDisk):
+    """
+    A base VHDX and its differencing children, ordered parent first, read as a single virtual disk. Each sector is read
+    from the most derived file which has it allocated (as vhdx_dump_chain.py does).
+    """
+    def __init__(self, layers: typing.Iterable[VhdxFile]):
+        self._layers = tuple(layers)
+        if not self._layers:
+            raise VhdxError("A chain must contain at least one VHDX file")
+        if self._layers[0].is_differencing:
+            raise VhdxError("The first VHDX in a chain cannot be differencing")
+        for layer in self._layers[1:]:
+            if layer.logical_sector_size != self.logical_sector_size:
+                raise VhdxError(f"Logical sector size of {layer.file_path} does not match the base VHDX")
+
+    @classmethod
+    def from_paths(cls, paths: typing.Iterable[os.PathLike], *, ignore_faults=False, fallback_metas=None,
+                   direct_io=False):
+        layers = []
+        for i, path in enumerate(paths):
+            layer_fallback_metas = None
+            if fallback_metas is not None:
+                layer_fallback_metas = dict(fallback_metas)
+                layer_fallback_metas["HasParent"] = i != 0
+            layers.append(VhdxFile(path, ignore_faults=ignore_faults, fallback_metas=layer_fallback_metas,
+                                   direct_io=direct_io))
+
+        return cls(layers)
+
+    def _get_block_sectors(self, block_index: int):
+        sectors_per_block = self.block_size // self.logical_sector_size
+        return block_index * sectors_per_block, sectors_per_block
+
+    def is_block_sparse(self, block_index: int) -> bool:
+        first_sector, sector_count = self._get_block_sectors(block_index)
+        for layer in self._layers[1:]:
+            if layer.has_allocated_sectors(first_sector, sector_count):
+                return False
+        return self.base.is_block_sparse(block_index)
+
+    def locate(self, offset: int) -> typing.Tuple[VhdxFile, typing.Optional[int]]:
+        if offset < 0 or offset >= self.virtual_disk_size:
+            raise ValueError("Offset is outside of the virtual disk")
+        sector_number = offset // self.logical_sector_size
+        for layer in reversed(self._layers[1:]):
+            if layer.is_sector_allocated(sector_number):
+                return layer.locate(offset)
+        return self.base.locate(offset)
+
+    def __getstate__(self):
+        state = self.__dict__.copy()
+        state.pop("_zero_tags", None)
+        return state
+
+    def _readinto_layers(self, layer_index: int, first_sector: int, end_sector: int, view_start: int,
+                         view: memoryview):
+        # fills the part of view (which starts at virtual offset view_start) covering sectors first_sector to
+        # end_sector: runs allocated in this layer are read from it and only the runs missing from it go further down
+        layer = self._layers[layer_index]
+        if layer_index == 0:
+            # base is always allocated so always ends the search
+            run_start = max(first_sector * self.logical_sector_size, view_start)
+            run_end = min(end_sector * self.logical_sector_size, view_start + len(view))
+            layer.readinto(view[run_start - view_start:run_end - view_start], run_start)
+            return
+        for first, count, is_allocated in layer._iter_sector_allocation(first_sector, end_sector - first_sector):
+            run_first_sector = first_sector + first
+            if is_allocated:
+                run_start = max(run_first_sector * self.logical_sector_size, view_start)
+                run_end = min((run_first_sector + count) * self.logical_sector_size, view_start + len(view))
+                layer.readinto(view[run_start - view_start:run_end - view_start], run_start)
+            else:
+                self._readinto_layers(layer_index - 1, run_first_sector, run_first_sector + count, view_start, view)
+
+    def _readinto_block(self, block_index: int, offset_in_block: int, view: memoryview):
+        start = block_index * self.block_size + offset_in_block
+        end = start + len(view)
+        self._readinto_layers(len(self._layers) - 1, start // self.logical_sector_size,
+                              -(-end // self.logical_sector_size), start, view)
+
+    @property
+    def layers(self):
+        return self._layers
+
+    @property
+    def base(self):
+        return self._layers[0]
+
+    @property
+    def logical_sector_size(self):
+        return self.base.logical_sector_size
+
+    @property
+    def block_size(self):
+        return self.base.block_size
+
+    @property
+    def virtual_disk_size(self):
+        return self.base.virtual_disk_size
+
 
 def main(args):
     pass
@@ -0,0 +1,249 @@
+"""
+Copyright 2019, CCL (SOLUTIONS) Group Ltd.
+
+Permission is hereby granted, free of charge, to any person obtaining a copy of this software and associated
+documentation files (the "Software"), to deal in the Software without restriction, including without limitation the
+rights to use, copy, modify, merge, publish, distribute, sublicense, and/or sell copies of the Software, and to permit
+persons to whom the Software is furnished to do so, subject to the following conditions:
+
+The above copyright notice and this permission notice shall be included in all copies or substantial portions of the
+Software.
+
+THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR IMPLIED, INCLUDING BUT NOT LIMITED TO THE
+WARRANTIES OF MERCHANTABILITY, FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE AUTHORS OR
+COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR
+OTHERWISE, ARISING FROM, OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE SOFTWARE.
+"""
+
+import bisect
+import collections
+import concurrent.futures
+import gzip
+import json
+import lzma
+import os
+import pathlib
+import typing
+import zlib
+
+from .ccl_vhdx import VhdxError
+
+__all__ = ["COMPRESSION_FORMATS", "DEFAULT_COMPRESSION_CHUNK_SIZE", "CompressedImageWriter", "CompressedImageReader",
+           "open_export_output"]
+
+COMPRESSION_FORMATS = ("gzip", "xz")
+DEFAULT_COMPRESSION_CHUNK_SIZE = 1 << 24
+INDEX_SUFFIX = ".idx.json"
+
+
+def _compress_member(data, compression_format: str, level: int) -> bytes:
+    # zlib and lzma both release the GIL while compressing, so members compress in parallel on a thread pool
+    if compression_format == "gzip":
+        return gzip.compress(data, compresslevel=level, mtime=0)
+    elif compression_format == "xz":
+        return lzma.compress(data, format=lzma.FORMAT_XZ, preset=level)
+    raise ValueError(f"Unknown compression format {compression_format}")
+
+
+def _decompress_member(data: bytes, compression_format: str) -> bytes:
+    if compression_format == "gzip":
+        return zlib.decompress(data, wbits=31)
+    elif compression_format == "xz":
+        return lzma.decompress(data, format=lzma.FORMAT_XZ)
+    raise ValueError(f"Unknown compression format {compression_format}")
+
+
+class CompressedImageWriter:
+    """
+    A write-only file object which compresses what is written to it as a series of independent gzip or xz members
+    (a valid multi-member .gz or multi-stream .xz file). Each chunk_size piece of input is compressed on a thread pool
+    and the members are written in order. Whole chunks of zeros reuse a single cached member. If index_path is given,
+    a JSON index of (uncompressed offset, compressed offset, compressed length) for each member is written on close so
+    that the output can be read at random with CompressedImageReader.
+    """
+    def __init__(self, out: typing.BinaryIO, compression_format="gzip", *, level: typing.Optional[int] = None,
+                 chunk_size=DEFAULT_COMPRESSION_CHUNK_SIZE, threads: typing.Optional[int] = None,
+                 index_path: typing.Optional[os.PathLike] = None, close_out=False):
+        if compression_format not in COMPRESSION_FORMATS:
+            raise ValueError(f"Unknown compression format {compression_format}")
+        if chunk_size <= 0:
+            raise ValueError("chunk_size must be positive")
+        self._out = out
+        self._format = compression_format
+        self._level = level if level is not None else (6 if compression_format == "gzip" else 3)
+        self._chunk_size = chunk_size
+        self._threads = threads or os.cpu_count() or 1
+        self._executor = concurrent.futures.ThreadPoolExecutor(self._threads)
+        self._pending = collections.deque()  # (uncompressed length, future) in output order
+        self._buffer = bytearray()
+        self._zero_member = None
+        self._index_path = pathlib.Path(index_path) if index_path is not None else None
+        self._index = []
+        self._uncompressed_position = 0
+        self._compressed_position = 0
+        self._close_out = close_out
+        self._closed = False
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        self.close()
+
+    def seekable(self):
+        return False
+
+    def writable(self):
+        return True
+
+    def tell(self):
+        """The uncompressed position"""
+        return self._uncompressed_position + sum(length for length, _ in self._pending) + len(self._buffer)
+
+    def _submit(self, length: int, future: concurrent.futures.Future):
+        self._pending.append((length, future))
+        # don't let finished members pile up in memory
+        while len(self._pending) > self._threads * 2 or (self._pending and self._pending[0][1].done()):
+            self._write_next()
+
+    def _write_next(self):
+        length, future = self._pending.popleft()
+        member = future.result()
+        self._out.write(member)
+        self._index.append((self._uncompressed_position, self._compressed_position, len(member)))
+        self._uncompressed_position += length
+        self._compressed_position += len(member)
+
+    def _submit_buffer(self):
+        data = bytes(self._buffer)
+        self._buffer.clear()
+        self._submit(len(data), self._executor.submit(_compress_member, data, self._format, self._level))
+
+    def _get_zero_member(self) -> concurrent.futures.Future:
+        if self._zero_member is None:
+            self._zero_member = self._executor.submit(
+                _compress_member, bytes(self._chunk_size), self._format, self._level)
+        return self._zero_member
+
+    def write(self, data) -> int:
+        if self._closed:
+            raise ValueError("Write to closed CompressedImageWriter")
+        view = memoryview(data).cast("B")
+        written = len(view)
+        while view:
+            take = min(self._chunk_size - len(self._buffer), len(view))
+            self._buffer += view[:take]
+            view = view[take:]
+            if len(self._buffer) == self._chunk_size:
+                self._submit_buffer()
+        return written
+
+    def write_zeros(self, length: int):
+        """Writes length zeros without building them in memory where a whole chunk of zeros can be used"""
+        while length:
+            if not self._buffer and length >= self._chunk_size:
+                self._submit(self._chunk_size, self._get_zero_member())
+                length -= self._chunk_size
+            else:
+                take = min(self._chunk_size - len(self._buffer), length)
+                self._buffer += bytes(take)
+                length -= take
+                if len(self._buffer) == self._chunk_size:
+                    self._submit_buffer()
+
+    def close(self):
+        if self._closed:
+            return
+        try:
+            if self._buffer:
+                self._submit_buffer()
+            while self._pending:
+                self._write_next()
+            self._out.flush()
+            if self._index_path is not None:
+                with self._index_path.open("w") as index_out:
+                    json.dump({
+                        "format": self._format,
+                        "chunk_size": self._chunk_size,
+                        "uncompressed_length": self._uncompressed_position,
+                        "members": self._index
+                    }, index_out)
+        finally:
+            self._closed = True
+            self._executor.shutdown(wait=True)
+            if self._close_out:
+                self._out.close()
+
+    @property
+    def closed(self):
+        return self._closed
+
+    @property
+    def compressed_length(self):
+        return self._compressed_position
+
+
+class CompressedImageReader:
+    """Random access reads from the output of CompressedImageWriter using the index written alongside it"""
+    def __init__(self, path: os.PathLike, index_path: typing.Optional[os.PathLike] = None, *, cache_members=4):
+        self._path = pathlib.Path(path)
+        index_path = pathlib.Path(index_path) if index_path is not None else \
+            self._path.with_name(self._path.name + INDEX_SUFFIX)
+        with index_path.open("r") as f:
+            index = json.load(f)
+        self._format = index["format"]
+        self._length = index["uncompressed_length"]
+        self._members = [tuple(x) for x in index["members"]]
+        self._member_offsets = [x[0] for x in self._members]
+        self._cache = collections.OrderedDict()
+        self._cache_members = cache_members
+
+    def _get_member(self, member_index: int) -> bytes:
+        if member_index in self._cache:
+            self._cache.move_to_end(member_index)
+            return self._cache[member_index]
+        _, compressed_offset, compressed_length = self._members[member_index]
+        with self._path.open("rb") as f:
+            f.seek(compressed_offset)
+            raw = f.read(compressed_length)
+        if len(raw) != compressed_length:
+            raise VhdxError(f"Compressed image is truncated at member {member_index}")
+        data = _decompress_member(raw, self._format)
+        self._cache[member_index] = data
+        while len(self._cache) > self._cache_members:
+            self._cache.popitem(last=False)
+        return data
+
+    def read(self, offset: int, length: int) -> bytes:
+        if offset < 0 or length < 0:
+            raise ValueError("Offset and length cannot be negative")
+        end = min(offset + length, self._length)
+        parts = []
+        while offset < end:
+            member_index = bisect.bisect_right(self._member_offsets, offset) - 1
+            member = self._get_member(member_index)
+            offset_in_member = offset - self._members[member_index][0]
+            part = member[offset_in_member:offset_in_member + (end - offset)]
+            if not part:
+                raise VhdxError(f"Compressed image member {member_index} is shorter than the index records")
+            parts.append(part)
+            offset += len(part)
+        return b"".join(parts)
+
+    @property
+    def length(self):
+        return self._length
+
+
+def open_export_output(out_path: os.PathLike, compression_format: typing.Optional[str] = None, *, write_index=False,
+                       overwrite=False, **kwargs):
+    """
+    Opens an output file for an export; a plain file if compression_format is None, otherwise a
+    CompressedImageWriter (with its index alongside as <out_path>.idx.json if write_index is True).
+    """
+    out_path = pathlib.Path(out_path)
+    out = out_path.open("wb" if overwrite else "xb")
+    if compression_format is None:
+        return out
+    index_path = out_path.with_name(out_path.name + INDEX_SUFFIX) if write_index else None
+    return CompressedImageWriter(out, compression_format, index_path=index_path, close_out=True, **kwargs)
@@ -0,0 +1,136 @@
+"""
+Copyright 2019, CCL (SOLUTIONS) Group Ltd.
+
+Permission is hereby granted, free of charge, to any person obtaining a copy of this software and associated
+documentation files (the "Software"), to deal in the Software without restriction, including without limitation the
+rights to use, copy, modify, merge, publish, distribute, sublicense, and/or sell copies of the Software, and to permit
+persons to whom the Software is furnished to do so, subject to the following conditions:
+
+The above copyright notice and this permission notice shall be included in all copies or substantial portions of the
+Software.
+
+THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR IMPLIED, INCLUDING BUT NOT LIMITED TO THE
+WARRANTIES OF MERCHANTABILITY, FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE AUTHORS OR
+COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR
+OTHERWISE, ARISING FROM, OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE SOFTWARE.
+"""
+
+import typing
+
+from .ccl_vhdx import VhdxFile, VhdxChain
+from .occupancy import IntervalSet
+
+__all__ = ["ChangedRange", "get_present_ranges", "diff_disks", "diff_layers"]
+
+DIFF_CONFIRM_PIECE_SIZE = 1 << 20
+
+Disk = typing.Union[VhdxFile, VhdxChain]
+
+
+class ChangedRange(typing.NamedTuple):
+    offset: int
+    length: int
+
+    @property
+    def end(self) -> int:
+        return self.offset + self.length
+
+
+def _get_layers(disk: Disk) -> typing.Tuple[VhdxFile, ...]:
+    return disk.layers if isinstance(disk, VhdxChain) else (disk,)
+
+
+def _is_same_layer(a: VhdxFile, b: VhdxFile) -> bool:
+    # the DataWriteGuid changes whenever the user data changes, so layers sharing one hold the same data
+    if a.source.local_path is not None and b.source.local_path is not None:
+        if a.source.local_path.resolve() == b.source.local_path.resolve():
+            return True
+    elif a.source.name == b.source.name:
+        return True
+    return any(a.header.data_write_guid) and a.header.data_write_guid == b.header.data_write_guid
+
+
+def get_present_ranges(vhdx: VhdxFile) -> IntervalSet:
+    """
+    The virtual disk ranges which a file holds data for, found from the BAT and sector bitmaps alone: the allocated
+    sectors of a differencing file, otherwise the blocks which are not sparse
+    """
+    present = IntervalSet()
+    if vhdx.is_differencing:
+        for first_sector, sector_count in vhdx.iter_allocated_sector_runs():
+            present.add(first_sector * vhdx.logical_sector_size,
+                        min((first_sector + sector_count) * vhdx.logical_sector_size, vhdx.virtual_disk_size))
+        return present
+
+    for block_index in range(vhdx.payload_block_count):
+        if not vhdx.is_block_sparse(block_index):
+            start = block_index * vhdx.block_size
+            present.add(start, start + vhdx.get_block_length(block_index))
+    return present
+
+
+def _confirm(old: Disk, new: Disk, candidates: IntervalSet, sector_size: int) -> IntervalSet:
+    # reads only the candidate ranges, narrowing each piece which differs down to the sectors which differ
+    changed = IntervalSet()
+    for start, end in candidates:
+        for piece_start in range(start, end, DIFF_CONFIRM_PIECE_SIZE):
+            piece_end = min(piece_start + DIFF_CONFIRM_PIECE_SIZE, end)
+            old_data = old.read(piece_start, piece_end - piece_start)
+            new_data = new.read(piece_start, piece_end - piece_start)
+            if old_data == new_data:
+                continue
+            for offset in range(0, len(old_data), sector_size):
+                if old_data[offset:offset + sector_size] != new_data[offset:offset + sector_size]:
+                    changed.add(piece_start + offset, min(piece_start + offset + sector_size, piece_end))
+    return changed
+
+
+def _to_changed_ranges(intervals: IntervalSet) -> typing.List[ChangedRange]:
+    return [ChangedRange(start, end - start) for start, end in intervals]
+
+
+def diff_disks(old: Disk, new: Disk, *, confirm=False) -> typing.List[ChangedRange]:
+    """
+    Returns the ranges of the virtual disk which may differ between two VhdxFiles or VhdxChains (for example two
+    checkpoints of the same machine), in order. Only the BATs and sector bitmaps are read: layers which the two share
+    (the same file, or the same DataWriteGuid) are skipped and the ranges which any other layer holds data for are the
+    candidates. If confirm is True the candidate ranges (and only those) are read from both disks and narrowed down
+    to the sectors which actually differ.
+    """
+    if old.logical_sector_size != new.logical_sector_size:
+        raise ValueError("The disks have different logical sector sizes")
+    old_layers = _get_layers(old)
+    new_layers = _get_layers(new)
+    shared = 0
+    while shared < min(len(old_layers), len(new_layers)) and \
+            _is_same_layer(old_layers[shared], new_layers[shared]):
+        shared += 1
+
+    common_size = min(old.virtual_disk_size, new.virtual_disk_size)
+    candidates = IntervalSet()
+    for layer in old_layers[shared:] + new_layers[shared:]:
+        for start, end in get_present_ranges(layer):
+            candidates.add(start, min(end, common_size))
+    if confirm:
+        candidates = _confirm(old, new, candidates, old.logical_sector_size)
+
+    # anything beyond the end of the smaller disk has changed, however it reads
+    candidates.add(common_size, max(old.virtual_disk_size, new.virtual_disk_size))
+    return _to_changed_ranges(candidates)
+
+
+def diff_layers(chain: VhdxChain, *, confirm=False) -> typing.List[typing.Tuple[VhdxFile, typing.List[ChangedRange]]]:
+    """
+    Returns (layer, changed ranges) for each differencing layer of a chain, the changes being relative to the chain
+    beneath it. Without confirm these are the sectors allocated in the layer; with it, only those which differ from
+    what the layers beneath hold.
+    """
+    results = []
+    for layer_index in range(1, len(chain.layers)):
+        beneath = VhdxChain(chain.layers[:layer_index])
+        upto = VhdxChain(chain.layers[:layer_index + 1])
+        changed = get_present_ranges(chain.layers[layer_index])
+        if confirm:
+            changed = _confirm(beneath, upto, changed, chain.logical_sector_size)
+        results.append((chain.layers[layer_index], _to_changed_ranges(changed)))
+    return results
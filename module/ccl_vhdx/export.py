@@ -0,0 +1,397 @@
+"""
+Copyright 2019, CCL (SOLUTIONS) Group Ltd.
+
+Permission is hereby granted, free of charge, to any person obtaining a copy of this software and associated
+documentation files (the "Software"), to deal in the Software without restriction, including without limitation the
+rights to use, copy, modify, merge, publish, distribute, sublicense, and/or sell copies of the Software, and to permit
+persons to whom the Software is furnished to do so, subject to the following conditions:
+
+The above copyright notice and this permission notice shall be included in all copies or substantial portions of the
+Software.
+
+THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR IMPLIED, INCLUDING BUT NOT LIMITED TO THE
+WARRANTIES OF MERCHANTABILITY, FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE AUTHORS OR
+COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR
+OTHERWISE, ARISING FROM, OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE SOFTWARE.
+"""
+
+import json
+import os
+import pathlib
+import time
+import typing
+import zlib
+
+from . import ccl_vhdx as _vhdx
+from .ccl_vhdx import VhdxChain, VhdxError, is_zero_buffer
+from .compression import CompressedImageWriter, open_export_output
+from .progress import ProgressCallback, ProgressTracker, count_allocated_bytes
+
+__all__ = ["ExportResult", "ExportJournalError", "iter_virtual_extents", "export_range", "export_to_path",
+           "get_journal_path", "check_export_journal"]
+
+JOURNAL_SUFFIX = ".journal"
+JOURNAL_VERSION = 1
+JOURNAL_EXTENT_SIZE = 1 << 26
+JOURNAL_SYNC_INTERVAL = 5.0  # seconds between syncing the output and writing the completed extents to the journal
+
+_ZERO_WRITE_BUFFER = bytes(1 << 20)
+
+
+class ExportResult:
+    def __init__(self, offset: int, length: int, zero_bytes: int):
+        self._offset = offset
+        self._length = length
+        self._zero_bytes = zero_bytes
+
+    def __repr__(self):
+        return f"<ExportResult offset: {self._offset}; length: {self._length}; zero_bytes: {self._zero_bytes}>"
+
+    @property
+    def offset(self) -> int:
+        """Offset on the virtual disk that the export started at"""
+        return self._offset
+
+    @property
+    def length(self) -> int:
+        """Bytes exported (including zeros)"""
+        return self._length
+
+    @property
+    def zero_bytes(self) -> int:
+        """Bytes which were zeros, so were skipped over (in a sparse export) rather than written"""
+        return self._zero_bytes
+
+
+def _resolve_range(disk, offset: int, length: typing.Optional[int]):
+    if length is None:
+        length = disk.virtual_disk_size - offset
+    if offset < 0 or length < 0 or offset + length > disk.virtual_disk_size:
+        raise ValueError("Range is outside of the virtual disk")
+    return offset, length
+
+
+def iter_virtual_extents(disk, offset: int = 0, length: typing.Optional[int] = None, *,
+                         progress: typing.Optional[ProgressCallback] = None, operation="export"):
+    """
+    Yields (virtual_offset, length, data) covering a range of a VhdxFile or VhdxChain in order, a payload block (or
+    the part of one inside the range) at a time. data is None for runs which read as zeros - sparse blocks are not
+    read at all - and adjacent zero runs are merged. Consecutive blocks which aren't sparse are read together (see
+    VhdxFile.iter_blocks). progress (see ProgressTracker) is told of each block as it is read or skipped, with the ETA
+    based on the allocated bytes in the range.
+    """
+    offset, length = _resolve_range(disk, offset, length)
+    tracker = ProgressTracker(progress, operation, length,
+                              count_allocated_bytes(disk, offset, length) if progress is not None else None)
+    for extent_offset, extent_length, data in _iter_extents(disk, offset, length, tracker):
+        yield extent_offset, extent_length, None if data is None else bytes(data)
+    tracker.finish()
+
+
+def _iter_extents(disk, offset: int, length: int, tracker: ProgressTracker):
+    # iter_virtual_extents for a range already checked, reporting to a tracker which may cover several ranges. data is
+    # a memoryview which is only valid until the next extent is yielded
+    zero_start = None
+    for position, part_length, data in disk.iter_blocks(offset, length):
+        if data is None:
+            tracker.advance(skipped=part_length)
+        else:
+            tracker.advance(processed=part_length)
+            block_index = position // disk.block_size
+            if part_length == disk.get_block_length(block_index):
+                data = None if disk.is_block_zero(block_index, check=False) else data
+            else:
+                data = None if is_zero_buffer(data) else data
+
+        if data is None:
+            if zero_start is None:
+                zero_start = position
+        else:
+            if zero_start is not None:
+                yield zero_start, position - zero_start, None
+                zero_start = None
+            yield position, part_length, data
+
+    if zero_start is not None:
+        yield zero_start, offset + length - zero_start, None
+
+
+def export_range(disk, out: typing.BinaryIO, offset: int = 0, length: typing.Optional[int] = None, *,
+                 sparse=True, progress: typing.Optional[ProgressCallback] = None) -> ExportResult:
+    """
+    Writes a range of the virtual disk of a VhdxFile or VhdxChain to out, starting at out's current position. If
+    sparse is True and out is seekable, zero runs are seeked over (leaving holes on filesystems which support them)
+    rather than written. progress is a callback as for iter_virtual_extents.
+    """
+    offset, length = _resolve_range(disk, offset, length)
+    sparse = sparse and out.seekable()
+    start = out.tell() if sparse else None
+    zero_bytes = 0
+    for extent_offset, extent_length, data in iter_virtual_extents(disk, offset, length, progress=progress):
+        if data is not None:
+            out.write(data)
+            continue
+        zero_bytes += extent_length
+        if sparse:
+            out.seek(extent_length, os.SEEK_CUR)
+        elif isinstance(out, CompressedImageWriter):
+            out.write_zeros(extent_length)
+        else:
+            remaining = extent_length
+            while remaining:
+                chunk_length = min(remaining, len(_ZERO_WRITE_BUFFER))
+                out.write(memoryview(_ZERO_WRITE_BUFFER)[:chunk_length])
+                remaining -= chunk_length
+
+    if sparse:
+        # seeking past the end does not extend the file, so make sure a trailing zero run is accounted for
+        end = start + length
+        if out.seek(0, os.SEEK_END) < end:
+            out.truncate(end)
+        out.seek(end)
+
+    return ExportResult(offset, length, zero_bytes)
+
+
+def _make_crc32_zero_operators() -> typing.List[typing.List[int]]:
+    # operators[k] advances a raw CRC-32 register over 2**k zero bytes, as 32 columns over GF(2)
+    operator = [0xedb88320] + [1 << n for n in range(31)]  # one zero bit
+    for _ in range(3):
+        operator = [_apply_crc32_operator(operator, x) for x in operator]
+    operators = []
+    for _ in range(64):
+        operators.append(operator)
+        operator = [_apply_crc32_operator(operator, x) for x in operator]
+    return operators
+
+
+def _apply_crc32_operator(operator: typing.List[int], value: int) -> int:
+    result = 0
+    column = 0
+    while value:
+        if value & 1:
+            result ^= operator[column]
+        value >>= 1
+        column += 1
+    return result
+
+
+_crc32_zero_operators = None
+
+
+def _crc32_zeros(crc: int, length: int) -> int:
+    """Continues a zlib.crc32 value over length zero bytes without feeding them through, so sparse runs cost nothing"""
+    global _crc32_zero_operators
+    if _crc32_zero_operators is None:
+        _crc32_zero_operators = _make_crc32_zero_operators()
+    register = crc ^ 0xffffffff
+    power = 0
+    while length:
+        if length & 1:
+            register = _apply_crc32_operator(_crc32_zero_operators[power], register)
+        length >>= 1
+        power += 1
+    return register ^ 0xffffffff
+
+
+class ExportJournalError(VhdxError):
+    pass
+
+
+def get_journal_path(out_path: os.PathLike) -> pathlib.Path:
+    out_path = pathlib.Path(out_path)
+    return out_path.with_name(out_path.name + JOURNAL_SUFFIX)
+
+
+def _describe_export(disk, offset: int, length: int, extent_size: int) -> dict:
+    # what a journal is only valid for: the range, and the identity and state of every file it comes from (but not
+    # their paths, which may well differ between runs)
+    layers = disk.layers if isinstance(disk, VhdxChain) else (disk,)
+    return {
+        "journal_version": JOURNAL_VERSION,
+        "offset": offset,
+        "length": length,
+        "extent_size": extent_size,
+        "layers": [{
+            "file_size": layer.file_size,
+            "sequence_number": layer.header.sequence_number,
+            "file_write_guid": layer.header.file_write_guid.hex(),
+            "data_write_guid": layer.header.data_write_guid.hex(),
+        } for layer in layers]
+    }
+
+
+def _read_journal(journal_path: pathlib.Path) -> typing.Tuple[dict, typing.Dict[int, int], bool]:
+    # returns (description, {extent index: crc32}, is_complete); a line torn by a crash is ignored
+    with journal_path.open("r", encoding="utf-8") as f:
+        lines = f.read().splitlines()
+    try:
+        description = json.loads(lines[0])
+    except (IndexError, json.JSONDecodeError):
+        raise ExportJournalError(f"{journal_path} is not an export journal")
+    if not isinstance(description, dict) or description.get("journal_version") != JOURNAL_VERSION:
+        raise ExportJournalError(f"{journal_path} is not a version {JOURNAL_VERSION} export journal")
+    extents = {}
+    is_complete = False
+    for line in lines[1:]:
+        try:
+            record = json.loads(line)
+        except json.JSONDecodeError:
+            _vhdx._l(f"WARNING: ignoring a damaged line in {journal_path}", to_stdout=_vhdx.DEBUG_TO_STDOUT)
+            continue
+        if record.get("complete"):
+            is_complete = True
+        elif "extent" in record:
+            extents[record["extent"]] = record["crc32"]
+    return description, extents, is_complete
+
+
+class _JournalWriter:
+    """
+    Appends completed extents to the journal. Lines are held back until the output has been flushed and synced, so
+    that the journal never lists an extent which could have been lost from the output.
+    """
+    def __init__(self, out: typing.BinaryIO, journal: typing.TextIO):
+        self._out = out
+        self._journal = journal
+        self._pending = []
+        self._last_sync = time.monotonic()
+
+    def add(self, record: dict):
+        self._pending.append(json.dumps(record))
+        if time.monotonic() - self._last_sync >= JOURNAL_SYNC_INTERVAL:
+            self.sync()
+
+    def sync(self):
+        self._out.flush()
+        os.fsync(self._out.fileno())
+        if self._pending:
+            self._journal.write("".join(x + "\n" for x in self._pending))
+            self._pending = []
+        self._journal.flush()
+        os.fsync(self._journal.fileno())
+        self._last_sync = time.monotonic()
+
+
+def _export_journalled(disk, out_path: pathlib.Path, offset: int, length: int, *, overwrite: bool, resume: bool,
+                       extent_size: int, progress: typing.Optional[ProgressCallback]) -> ExportResult:
+    journal_path = get_journal_path(out_path)
+    description = _describe_export(disk, offset, length, extent_size)
+    completed = {}
+    if resume and journal_path.exists() and out_path.exists():
+        journal_description, completed, is_complete = _read_journal(journal_path)
+        if journal_description != description:
+            raise ExportJournalError(f"{journal_path} was written for a different range, or source files which have "
+                                     f"since changed, so {out_path} can't be resumed")
+        output_size = out_path.stat().st_size
+        if is_complete and output_size >= length:
+            return ExportResult(offset, length, 0)
+        # every extent is extended to its end as it completes, so any which end past the output's end have been lost
+        # since (the output was truncated or replaced) and are exported again
+        lost = [x for x in completed if min((x + 1) * extent_size, length) > output_size]
+        if lost:
+            _vhdx._l(f"WARNING: {out_path} is shorter than its journal records, re-exporting {len(lost)} extents",
+                     to_stdout=_vhdx.DEBUG_TO_STDOUT)
+            for extent_index in lost:
+                del completed[extent_index]
+        out = out_path.open("r+b")
+        journal = journal_path.open("a", encoding="utf-8")
+    else:
+        if resume and out_path.exists() and not overwrite:
+            raise ExportJournalError(f"{out_path} has no journal ({journal_path}) to resume from")
+        if resume:
+            _vhdx._l(f"No journal to resume {out_path} from, starting from the beginning",
+                     to_stdout=_vhdx.DEBUG_TO_STDOUT)
+        out = out_path.open("wb" if overwrite else "xb")
+        journal = journal_path.open("w", encoding="utf-8")
+        journal.write(json.dumps(description) + "\n")
+
+    extent_count = -(-length // extent_size)
+    missing = [x for x in range(extent_count) if x not in completed]
+    missing_ranges = [(offset + x * extent_size, min(extent_size, length - x * extent_size)) for x in missing]
+    tracker = ProgressTracker(
+        progress, "export", sum(x[1] for x in missing_ranges),
+        sum(count_allocated_bytes(disk, *x) for x in missing_ranges) if progress is not None else None)
+
+    zero_bytes = 0
+    output_size = out.seek(0, os.SEEK_END)
+    with out, journal:
+        writer = _JournalWriter(out, journal)
+        for extent_index, (extent_offset, extent_length) in zip(missing, missing_ranges):
+            crc = 0
+            out.seek(extent_offset - offset)
+            for _, part_length, data in _iter_extents(disk, extent_offset, extent_length, tracker):
+                if data is None:
+                    crc = _crc32_zeros(crc, part_length)
+                    zero_bytes += part_length
+                    out.seek(part_length, os.SEEK_CUR)
+                else:
+                    crc = zlib.crc32(data, crc)
+                    out.write(data)
+            extent_end = extent_offset - offset + extent_length
+            if output_size < extent_end:
+                # a trailing zero run is only seeked over, so the extent is made to reach its end in the output
+                out.truncate(extent_end)
+                output_size = extent_end
+            writer.add({"extent": extent_index, "crc32": crc})
+
+        writer.add({"complete": True})
+        writer.sync()
+    tracker.finish()
+
+    return ExportResult(offset, length, zero_bytes)
+
+
+def check_export_journal(out_path: os.PathLike) -> typing.List[int]:
+    """
+    Re-reads an export made with a journal and returns the indices of the extents whose data no longer matches the
+    checksum recorded for it (or which the journal doesn't list as done).
+    """
+    out_path = pathlib.Path(out_path)
+    description, extents, _ = _read_journal(get_journal_path(out_path))
+    extent_size = description["extent_size"]
+    length = description["length"]
+    bad = []
+    with out_path.open("rb") as f:
+        for extent_index in range(-(-length // extent_size)):
+            remaining = min(extent_size, length - extent_index * extent_size)
+            f.seek(extent_index * extent_size)
+            crc = 0
+            while remaining:
+                data = f.read(min(remaining, len(_ZERO_WRITE_BUFFER)))
+                if not data:
+                    break
+                crc = zlib.crc32(data, crc)
+                remaining -= len(data)
+            if remaining or extents.get(extent_index) != crc:
+                bad.append(extent_index)
+    return bad
+
+
+def export_to_path(disk, out_path: os.PathLike, offset: int = 0, length: typing.Optional[int] = None, *,
+                   sparse=True, overwrite=False, compression_format: typing.Optional[str] = None,
+                   write_index=False, progress: typing.Optional[ProgressCallback] = None, journal=False,
+                   resume=False, journal_extent_size=JOURNAL_EXTENT_SIZE) -> ExportResult:
+    """
+    Exports a range of the virtual disk to a new file, optionally compressed (see CompressedImageWriter); the
+    output must not already exist unless overwrite is True.
+
+    With journal (or resume) True, each journal_extent_size piece of a sparse, uncompressed export is recorded with
+    its CRC-32 in <out_path>.journal once it is safely written. If the export is interrupted, calling again with
+    resume=True checks that the journal matches the range and the source files' headers (raising
+    ExportJournalError if not, or if the output exists without a journal) and exports only the pieces which are
+    missing, including any which the output has since been truncated short of. check_export_journal re-checks the
+    output against the journal.
+    """
+    offset, length = _resolve_range(disk, offset, length)
+    if journal or resume:
+        if compression_format is not None or not sparse:
+            raise ValueError("Only sparse, uncompressed exports can be journalled")
+        if journal_extent_size <= 0:
+            raise ValueError("journal_extent_size must be positive")
+        return _export_journalled(disk, pathlib.Path(out_path), offset, length, overwrite=overwrite, resume=resume,
+                                  extent_size=journal_extent_size, progress=progress)
+
+    with open_export_output(pathlib.Path(out_path), compression_format, write_index=write_index,
+                            overwrite=overwrite) as out:
+        return export_range(disk, out, offset, length, sparse=sparse, progress=progress)
@@ -0,0 +1,278 @@
+"""
+Copyright 2019, CCL (SOLUTIONS) Group Ltd.
+
+Permission is hereby granted, free of charge, to any person obtaining a copy of this software and associated
+documentation files (the "Software"), to deal in the Software without restriction, including without limitation the
+rights to use, copy, modify, merge, publish, distribute, sublicense, and/or sell copies of the Software, and to permit
+persons to whom the Software is furnished to do so, subject to the following conditions:
+
+The above copyright notice and this permission notice shall be included in all copies or substantial portions of the
+Software.
+
+THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR IMPLIED, INCLUDING BUT NOT LIMITED TO THE
+WARRANTIES OF MERCHANTABILITY, FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE AUTHORS OR
+COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR
+OTHERWISE, ARISING FROM, OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE SOFTWARE.
+"""
+
+import array
+import bisect
+import collections
+import os
+import sys
+import typing
+
+from .ccl_vhdx import VhdxFile, BAT_SB_BLOCK_PRESENT, SENSIBLE_FALLBACK_METAS
+
+__all__ = ["SectorBitmapFit", "GeometryCandidate", "GeometryInference", "get_bat_states", "sector_bitmap_fit",
+           "infer_geometry", "infer_geometry_for_file"]
+
+BLOCK_SIZES = tuple(1 << x for x in range(20, 29))  # 1MB to 256MB
+LOGICAL_SECTOR_SIZES = (512, 4096)
+
+_STATE_PARTIALLY_PRESENT = 7
+_SECTOR_BITMAP_BLOCK_LENGTH = 1 << 20
+
+# translates the first byte of each little-endian BAT entry into the entry's state
+_STATE_OF_LANE_0 = bytes(b & 0x07 for b in range(256))
+_SECTOR_BITMAP_STATES = bytes((0, BAT_SB_BLOCK_PRESENT))
+
+
+class SectorBitmapFit(typing.NamedTuple):
+    informative: int  # chunks which have anything allocated
+    consistent: int  # informative chunks whose sector bitmap entry is allowed by their payload entries
+    exact: int  # informative chunks whose sector bitmap entry is PRESENT just when they have partially present blocks
+
+
+def get_bat_states(entries: array.array) -> bytes:
+    """The state of each BAT entry (as raw 64-bit entries, see VhdxFile.raw_bat), one per byte"""
+    if sys.byteorder != "little":
+        entries = array.array("Q", entries)
+        entries.byteswap()
+    return entries.tobytes()[0::8].translate(_STATE_OF_LANE_0)
+
+
+def sector_bitmap_fit(entries: array.array, states: bytes, chunk_ratio: int, has_parent: bool) -> \
+        typing.Optional[SectorBitmapFit]:
+    """
+    Checks the sector bitmap entries (every (chunk_ratio + 1)th entry) of a BAT for a chunk ratio; states is from
+    get_bat_states. Returns None if the BAT cannot be valid with this chunk ratio, otherwise a SectorBitmapFit.
+    Without a parent a sector bitmap entry must be zero and no payload block may be partially present; with one a
+    sector bitmap must be present for any chunk with partially present blocks (consistent). A sector bitmap which is
+    present for a chunk without partially present blocks is allowed, but the chunk doesn't count as exact, and
+    neither does a NOT_PRESENT entry with an offset.
+    """
+    period = chunk_ratio + 1
+    if states[chunk_ratio::period].translate(None, _SECTOR_BITMAP_STATES):
+        return None
+    if not has_parent and (any(entries[chunk_ratio::period]) or _STATE_PARTIALLY_PRESENT in states):
+        return None
+
+    informative = consistent = exact = 0
+    for slot in range(chunk_ratio, len(entries), period):
+        payload_states = states[slot - chunk_ratio:slot]
+        if payload_states.count(0) == chunk_ratio:
+            continue
+        informative += 1
+        has_partial = _STATE_PARTIALLY_PRESENT in payload_states
+        is_present = states[slot] == BAT_SB_BLOCK_PRESENT
+        if not has_partial or is_present:
+            consistent += 1
+        if is_present == has_partial and (has_partial or entries[slot] == 0):
+            exact += 1
+    return SectorBitmapFit(informative, consistent, exact)
+
+
+class GeometryCandidate:
+    def __init__(self, block_size: int, logical_sector_size: int, has_parent: bool, no_overlap_fraction: float,
+                 spacing_fraction: float, tight_fraction: float, in_file_fraction: float,
+                 sector_bitmap_consistency: typing.Optional[float], sector_bitmap_evidence: int):
+        self._block_size = block_size
+        self._logical_sector_size = logical_sector_size
+        self._has_parent = has_parent
+        self._no_overlap_fraction = no_overlap_fraction
+        self._spacing_fraction = spacing_fraction
+        self._tight_fraction = tight_fraction
+        self._in_file_fraction = in_file_fraction
+        self._sector_bitmap_consistency = sector_bitmap_consistency
+        self._sector_bitmap_evidence = sector_bitmap_evidence
+
+    def __repr__(self):
+        return (f"<GeometryCandidate BlockSize: {self._block_size}; LogicalSectorSize: {self._logical_sector_size}; "
+                f"HasParent: {self._has_parent}; score: {self.score:.3f}>")
+
+    @property
+    def block_size(self) -> int:
+        return self._block_size
+
+    @property
+    def logical_sector_size(self) -> int:
+        return self._logical_sector_size
+
+    @property
+    def has_parent(self) -> bool:
+        return self._has_parent
+
+    @property
+    def chunk_ratio(self) -> int:
+        return ((1 << 23) * self._logical_sector_size) // self._block_size
+
+    @property
+    def no_overlap_fraction(self) -> float:
+        """Fraction of blocks (in file offset order) which end at or before the next block starts"""
+        return self._no_overlap_fraction
+
+    @property
+    def spacing_fraction(self) -> float:
+        """Fraction of the gaps between consecutive payload block offsets which are a multiple of the block size"""
+        return self._spacing_fraction
+
+    @property
+    def tight_fraction(self) -> float:
+        """Fraction of payload blocks followed directly by the next block"""
+        return self._tight_fraction
+
+    @property
+    def in_file_fraction(self) -> float:
+        """Fraction of blocks which end within the file"""
+        return self._in_file_fraction
+
+    @property
+    def sector_bitmap_consistency(self) -> typing.Optional[float]:
+        """Fraction of allocated chunks whose sector bitmap entry fits, or None if no allocated chunk is whole"""
+        return self._sector_bitmap_consistency
+
+    @property
+    def sector_bitmap_evidence(self) -> int:
+        """The number of allocated chunks whose sector bitmap entry was checked"""
+        return self._sector_bitmap_evidence
+
+    @property
+    def score(self) -> float:
+        """0.0 to 1.0"""
+        # each sector bitmap entry that lines up is further evidence for the chunk ratio
+        sector_bitmap_score = 0.0
+        if self._sector_bitmap_consistency is not None:
+            sector_bitmap_score = self._sector_bitmap_consistency * (
+                self._sector_bitmap_evidence / (self._sector_bitmap_evidence + 1))
+        return (0.3 * self._no_overlap_fraction + 0.1 * self._spacing_fraction + 0.2 * self._tight_fraction +
+                0.1 * self._in_file_fraction + 0.3 * sector_bitmap_score)
+
+    def get_minimum_virtual_disk_size(self, entries: array.array) -> int:
+        """The size of the virtual disk up to the end of the last payload block with a non-zero BAT entry"""
+        period = self.chunk_ratio + 1
+        for bat_index in range(len(entries) - 1, -1, -1):
+            if entries[bat_index] and (bat_index + 1) % period != 0:
+                return (bat_index - (bat_index // period) + 1) * self._block_size
+        return 0
+
+    def to_metas(self, physical_sector_size: int = SENSIBLE_FALLBACK_METAS["PhysicalSectorSize"],
+                 virtual_disk_size: typing.Optional[int] = None) -> dict:
+        """
+        A fallback_metas dict for VhdxFile; if virtual_disk_size is None it is left for VhdxFile to infer from the
+        length of the BAT region
+        """
+        metas = {
+            "LogicalSectorSize": self._logical_sector_size,
+            "PhysicalSectorSize": physical_sector_size,
+            "BlockSize": self._block_size,
+            "HasParent": self._has_parent
+        }
+        if virtual_disk_size is not None:
+            metas["VirtualDiskSize"] = virtual_disk_size
+        return metas
+
+
+class GeometryInference:
+    def __init__(self, candidates: typing.List[GeometryCandidate]):
+        self._candidates = candidates
+
+    def __repr__(self):
+        return f"<GeometryInference best: {self.best}; confidence: {self.confidence:.3f}>"
+
+    @property
+    def candidates(self) -> typing.List[GeometryCandidate]:
+        """Every geometry the BAT could be valid with, most consistent first"""
+        return self._candidates
+
+    @property
+    def best(self) -> typing.Optional[GeometryCandidate]:
+        return self._candidates[0] if self._candidates else None
+
+    @property
+    def confidence(self) -> float:
+        """
+        0.0 to 1.0; the best candidate's score less that of the best with a different block or sector size, so a BAT
+        which fits several geometries equally well gives 0.0 however well it fits them. HasParent is not counted:
+        partially present blocks or sector bitmaps rule out False, and nothing in the BAT can rule out True.
+        """
+        best = self.best
+        if best is None:
+            return 0.0
+        for candidate in self._candidates[1:]:
+            if (candidate.block_size, candidate.logical_sector_size) != (best.block_size, best.logical_sector_size):
+                return best.score - candidate.score
+        return best.score
+
+
+def infer_geometry(entries: array.array, file_size: int) -> GeometryInference:
+    """
+    Tests every combination of BlockSize, LogicalSectorSize and HasParent against a BAT (as raw 64-bit entries, see
+    VhdxFile.raw_bat). Combinations the sector bitmap entries rule out are dropped; the rest are scored on how well
+    the sector bitmap entries line up with the chunk ratio, whether the blocks overlap, whether the offsets are
+    spaced by multiples of the block size (and packed one after another, as they are written), and whether the
+    blocks fit in the file.
+    """
+    states = get_bat_states(entries)
+    mb = 1 << 20
+    located = sorted((((raw >> 20) & 0xfffffffffff) * mb, index) for index, raw in enumerate(entries) if raw >> 20)
+    offsets = [offset for offset, _ in located]
+    # the gap from each located entry to the next in file order, which is what the block sizes are tested against
+    gaps_after = {index: located[i + 1][0] - offset for i, (offset, index) in enumerate(located[:-1])}
+    gap_counts = collections.Counter(gaps_after.values())
+    pair_count = len(gaps_after)
+
+    candidates = []
+    for block_size in BLOCK_SIZES:
+        for logical_sector_size in LOGICAL_SECTOR_SIZES:
+            chunk_ratio = ((1 << 23) * logical_sector_size) // block_size
+            period = chunk_ratio + 1
+            # sector bitmap blocks are always 1MB, so the gaps after them are left out of the block size tests
+            sector_bitmap_gaps = collections.Counter(
+                gaps_after[slot] for slot in range(chunk_ratio, len(entries), period) if slot in gaps_after)
+            payload_gaps = gap_counts - sector_bitmap_gaps
+            payload_pair_count = sum(payload_gaps.values())
+            overlaps = sum(count for gap, count in payload_gaps.items() if gap < block_size)
+            overlaps += sum(count for gap, count in sector_bitmap_gaps.items() if gap < _SECTOR_BITMAP_BLOCK_LENGTH)
+            spaced = sum(count for gap, count in payload_gaps.items() if gap % block_size == 0 and gap)
+            tight = payload_gaps.get(block_size, 0)
+
+            beyond_eof = len(offsets) - bisect.bisect_right(offsets, file_size - block_size)
+            no_overlap_fraction = 1.0 - (overlaps / pair_count) if pair_count else 1.0
+            spacing_fraction = spaced / payload_pair_count if payload_pair_count else 1.0
+            tight_fraction = tight / payload_pair_count if payload_pair_count else 0.0
+            in_file_fraction = 1.0 - (beyond_eof / len(offsets)) if offsets else 1.0
+
+            for has_parent in (False, True):
+                fit = sector_bitmap_fit(entries, states, chunk_ratio, has_parent)
+                if fit is None:
+                    continue
+                candidates.append(GeometryCandidate(
+                    block_size, logical_sector_size, has_parent, no_overlap_fraction, spacing_fraction,
+                    tight_fraction, in_file_fraction, fit.consistent / fit.informative if fit.informative else None,
+                    fit.informative))
+
+    # ties go to the larger block size (smaller block sizes always divide the spacing of larger ones), then to the
+    # commoner 512 byte sector and to not differencing, which a BAT without partially present blocks can't rule out
+    candidates.sort(key=lambda x: (-x.score, -x.tight_fraction, -x.block_size, x.logical_sector_size, x.has_parent))
+    return GeometryInference(candidates)
+
+
+def infer_geometry_for_file(in_path: os.PathLike, *, bat_region: typing.Optional[typing.Tuple[int, int]] = None) -> \
+        GeometryInference:
+    """
+    Infers the geometry of a VHDX file from its BAT (located through the region table unless bat_region is given),
+    without relying on its metadata: a metadata table which is missing or can't be parsed is passed over.
+    """
+    vhdx = VhdxFile(in_path, ignore_faults=True, fallback_metas=SENSIBLE_FALLBACK_METAS, bat_region=bat_region)
+    return infer_geometry(vhdx.raw_bat, vhdx.file_size)
@@ -0,0 +1,248 @@
+"""
+Copyright 2019, CCL (SOLUTIONS) Group Ltd.
+
+Permission is hereby granted, free of charge, to any person obtaining a copy of this software and associated
+documentation files (the "Software"), to deal in the Software without restriction, including without limitation the
+rights to use, copy, modify, merge, publish, distribute, sublicense, and/or sell copies of the Software, and to permit
+persons to whom the Software is furnished to do so, subject to the following conditions:
+
+The above copyright notice and this permission notice shall be included in all copies or substantial portions of the
+Software.
+
+THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR IMPLIED, INCLUDING BUT NOT LIMITED TO THE
+WARRANTIES OF MERCHANTABILITY, FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE AUTHORS OR
+COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR
+OTHERWISE, ARISING FROM, OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE SOFTWARE.
+"""
+
+import hashlib
+import queue
+import threading
+import typing
+
+from .progress import ProgressCallback, ProgressTracker, count_allocated_bytes
+
+__all__ = ["DEFAULT_HASH_ALGORITHMS", "DEFAULT_HASH_BUFFER_SIZE", "HashResult", "hash_virtual_disk"]
+
+DEFAULT_HASH_ALGORITHMS = ("md5", "sha1", "sha256")
+DEFAULT_HASH_BUFFER_SIZE = 1 << 24
+
+_QUEUE_DEPTH = 8  # buffers in flight per hashing thread
+_STOP = object()
+
+
+class _PiecewiseHasher:
+    def __init__(self, algorithm: str, piece_size: int, zero_buffer: bytes):
+        self._algorithm = algorithm
+        self._piece_size = piece_size
+        self._zero_buffer = zero_buffer
+        self._zero_digests = {}  # piece length : hex digest of that many zeros
+        self._pieces = []
+        self._current = None
+        self._current_offset = 0
+        self._current_length = 0
+
+    def _finish_piece(self):
+        self._pieces.append((self._current_offset, self._current_length, self._current.hexdigest()))
+        self._current_offset += self._current_length
+        self._current = None
+        self._current_length = 0
+
+    def update(self, data):
+        data = memoryview(data)
+        while data:
+            if self._current is None:
+                self._current = hashlib.new(self._algorithm)
+            take = min(self._piece_size - self._current_length, len(data))
+            self._current.update(data[:take])
+            self._current_length += take
+            data = data[take:]
+            if self._current_length == self._piece_size:
+                self._finish_piece()
+
+    def update_zeros(self, length: int):
+        while length:
+            if self._current is None and length >= self._piece_size:
+                # whole pieces of zeros all hash the same, so only hash them once
+                if self._piece_size not in self._zero_digests:
+                    zero_hash = hashlib.new(self._algorithm)
+                    _feed_zeros(zero_hash.update, self._piece_size, self._zero_buffer)
+                    self._zero_digests[self._piece_size] = zero_hash.hexdigest()
+                self._pieces.append((self._current_offset, self._piece_size, self._zero_digests[self._piece_size]))
+                self._current_offset += self._piece_size
+                length -= self._piece_size
+            else:
+                take = min(length, len(self._zero_buffer), self._piece_size - self._current_length)
+                self.update(memoryview(self._zero_buffer)[:take])
+                length -= take
+
+    def finish(self):
+        if self._current is not None:
+            self._finish_piece()
+        return self._pieces
+
+
+def _feed_zeros(update, length: int, zero_buffer: bytes):
+    zero_view = memoryview(zero_buffer)
+    while length:
+        take = min(length, len(zero_view))
+        update(zero_view[:take])
+        length -= take
+
+
+class _HashWorker(threading.Thread):
+    # hashlib releases the GIL for large updates, so each algorithm gets its own thread and they run side by side
+    def __init__(self, update, update_zeros):
+        super().__init__(daemon=True)
+        self._update = update
+        self._update_zeros = update_zeros
+        self._queue = queue.Queue(_QUEUE_DEPTH)
+        self._error = None
+
+    def submit(self, item):
+        self._queue.put(item)
+
+    def finish(self):
+        self._queue.put(_STOP)
+        self.join()
+        if self._error is not None:
+            raise self._error
+
+    def run(self):
+        while True:
+            item = self._queue.get()
+            if item is _STOP:
+                return
+            if self._error is not None:
+                continue  # keep draining so the producer never blocks
+            try:
+                if isinstance(item, int):
+                    self._update_zeros(item)
+                else:
+                    self._update(item)
+            except Exception as e:
+                self._error = e
+
+
+class HashResult:
+    def __init__(self, digests: dict, pieces: typing.Optional[list], piece_algorithm: typing.Optional[str],
+                 bytes_hashed: int, sparse_bytes: int, zero_bytes: int):
+        self._digests = digests
+        self._pieces = pieces
+        self._piece_algorithm = piece_algorithm
+        self._bytes_hashed = bytes_hashed
+        self._sparse_bytes = sparse_bytes
+        self._zero_bytes = zero_bytes
+
+    def __repr__(self):
+        return f"<HashResult bytes_hashed: {self._bytes_hashed}; digests: {self._digests}>"
+
+    @property
+    def digests(self) -> dict:
+        """algorithm name : hex digest of the whole virtual disk"""
+        return self._digests
+
+    @property
+    def pieces(self) -> typing.Optional[list]:
+        """(offset, length, hex digest) for each piece if piecewise hashing was requested, otherwise None"""
+        return self._pieces
+
+    @property
+    def piece_algorithm(self):
+        return self._piece_algorithm
+
+    @property
+    def bytes_hashed(self):
+        return self._bytes_hashed
+
+    @property
+    def sparse_bytes(self):
+        """Bytes which were hashed as zeros without being read from the file"""
+        return self._sparse_bytes
+
+    @property
+    def zero_bytes(self):
+        """Bytes which were read from allocated blocks but found to be all zeros"""
+        return self._zero_bytes
+
+
+def hash_virtual_disk(disk, algorithms: typing.Iterable[str] = DEFAULT_HASH_ALGORITHMS, *,
+                      piece_size: typing.Optional[int] = None, piece_algorithm="md5",
+                      buffer_size=DEFAULT_HASH_BUFFER_SIZE,
+                      progress: typing.Optional[ProgressCallback] = None) -> HashResult:
+    """
+    Hashes the virtual disk of a VhdxFile or VhdxChain with several algorithms in a single pass, optionally also
+    producing piecewise hashes of piece_size bytes. Runs of sparse payload blocks are hashed from a shared zero buffer
+    without reading anything from the file; allocated blocks which turn out to be all zeros are treated the same way
+    once read. progress is a callback as for ProgressTracker, with the ETA based on the allocated bytes.
+    """
+    algorithms = tuple(algorithms)
+    if not algorithms and not piece_size:
+        raise ValueError("No hashing requested")
+    if piece_size is not None and piece_size <= 0:
+        raise ValueError("piece_size must be positive")
+
+    zero_buffer = bytes(min(buffer_size, disk.block_size))
+    hashes = {name: hashlib.new(name) for name in algorithms}  # fails early on an unknown algorithm
+    workers = []
+    for hash_object in hashes.values():
+        workers.append(_HashWorker(
+            hash_object.update,
+            lambda length, update=hash_object.update: _feed_zeros(update, length, zero_buffer)))
+    piecewise = None
+    if piece_size:
+        piecewise = _PiecewiseHasher(piece_algorithm, piece_size, zero_buffer)
+        workers.append(_HashWorker(piecewise.update, piecewise.update_zeros))
+
+    for worker in workers:
+        worker.start()
+
+    tracker = ProgressTracker(progress, "hash", disk.virtual_disk_size,
+                              count_allocated_bytes(disk) if progress is not None else None)
+    bytes_hashed = 0
+    sparse_bytes = 0
+    zero_bytes = 0
+    pending_zeros = 0
+    try:
+        for position, block_length, block in disk.iter_blocks():
+            if block is None:
+                pending_zeros += block_length
+                sparse_bytes += block_length
+                tracker.advance(skipped=block_length)
+                continue
+            tracker.advance(processed=block_length)
+            if disk.is_block_zero(position // disk.block_size, check=False):
+                pending_zeros += len(block)
+                zero_bytes += len(block)
+                continue
+            if pending_zeros:
+                for worker in workers:
+                    worker.submit(pending_zeros)
+                bytes_hashed += pending_zeros
+                pending_zeros = 0
+            # the workers hash on their own threads, so get a copy which outlives the read buffer
+            block = bytes(block)
+            for worker in workers:
+                worker.submit(block)
+            bytes_hashed += len(block)
+
+        if pending_zeros:
+            for worker in workers:
+                worker.submit(pending_zeros)
+            bytes_hashed += pending_zeros
+    finally:
+        errors = []
+        for worker in workers:
+            try:
+                worker.finish()
+            except Exception as e:
+                errors.append(e)
+    if errors:
+        raise errors[0]
+    tracker.finish()
+
+    return HashResult(
+        {name: hash_object.hexdigest() for name, hash_object in hashes.items()},
+        piecewise.finish() if piecewise is not None else None,
+        piece_algorithm if piecewise is not None else None,
+        bytes_hashed, sparse_bytes, zero_bytes)
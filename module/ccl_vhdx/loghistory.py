@@ -0,0 +1,302 @@
+"""
+Copyright 2019, CCL (SOLUTIONS) Group Ltd.
+
+Permission is hereby granted, free of charge, to any person obtaining a copy of this software and associated
+documentation files (the "Software"), to deal in the Software without restriction, including without limitation the
+rights to use, copy, modify, merge, publish, distribute, sublicense, and/or sell copies of the Software, and to permit
+persons to whom the Software is furnished to do so, subject to the following conditions:
+
+The above copyright notice and this permission notice shall be included in all copies or substantial portions of the
+Software.
+
+THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR IMPLIED, INCLUDING BUT NOT LIMITED TO THE
+WARRANTIES OF MERCHANTABILITY, FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE AUTHORS OR
+COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR
+OTHERWISE, ARISING FROM, OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE SOFTWARE.
+"""
+
+import bisect
+import io
+import struct
+import typing
+
+from .ccl_vhdx import (VhdxFile, VhdxLogError, LogEntry, REGION_GUID_BAT, LOG_HEADER_MAGIC,
+                       LOG_DATA_SECTOR_MAGIC, LOG_SECTOR_SIZE, guid_to_blob, crc32c)
+from . import ccl_vhdx as _vhdx
+from .progress import ProgressCallback, ProgressTracker
+
+__all__ = ["LogSectorVersion", "HistoricalVersion", "RejectedLogEntry", "LogHistory", "read_log_history"]
+
+_NULL_GUID = bytes(16)
+_PROGRESS_STEP = 1 << 20  # bytes of the log scanned between progress updates
+
+
+class LogSectorVersion(typing.NamedTuple):
+    """A write recorded by a log entry: one sector of data, or a run of zeros"""
+    file_offset: int
+    length: int
+    sequence_number: int
+    entry_offset: int  # offset into the log of the entry holding the write
+    is_active: bool  # whether the entry is part of the active sequence, i.e. not yet known to be applied
+    data: typing.Optional[bytes]  # None for a zero descriptor
+
+    @property
+    def is_zero(self) -> bool:
+        return self.data is None
+
+    def get_data(self) -> bytes:
+        return bytes(self.length) if self.data is None else self.data
+
+
+class HistoricalVersion(typing.NamedTuple):
+    """Part of a LogSectorVersion which falls within a range of the virtual disk"""
+    virtual_offset: int
+    file_offset: int
+    sequence_number: int
+    entry_offset: int
+    is_active: bool
+    data: bytes
+
+
+class RejectedLogEntry(typing.NamedTuple):
+    entry_offset: int
+    reason: str
+
+
+class _VersionIndex:
+    """LogSectorVersions sorted by (file_offset, sequence_number) so that overlapping versions are found by bisection"""
+    def __init__(self, versions: typing.Iterable[LogSectorVersion]):
+        self._versions = sorted(versions, key=lambda x: (x.file_offset, x.sequence_number))
+        self._starts = [x.file_offset for x in self._versions]
+        self._max_length = max((x.length for x in self._versions), default=0)
+
+    def __len__(self):
+        return len(self._versions)
+
+    def __iter__(self):
+        yield from self._versions
+
+    def iter_overlapping(self, start: int, end: int):
+        first = bisect.bisect_left(self._starts, start - self._max_length + 1)
+        last = bisect.bisect_left(self._starts, end)
+        for version in self._versions[first:last]:
+            if version.file_offset + version.length > start:
+                yield version
+
+
+class LogHistory:
+    def __init__(self, log_offset: int, log_length: int, entries: typing.Dict[int, LogEntry],
+                 active_offsets: typing.Collection[int], rejected: typing.List[RejectedLogEntry],
+                 versions: typing.Iterable[LogSectorVersion]):
+        self._log_offset = log_offset
+        self._log_length = log_length
+        self._entries = entries
+        self._active_offsets = frozenset(active_offsets)
+        self._rejected = rejected
+        versions = list(versions)
+        # zero descriptors can cover a great deal more than a sector, so they are kept apart from the data sectors to
+        # stop them widening every data sector lookup
+        self._data_index = _VersionIndex(x for x in versions if not x.is_zero)
+        self._zero_index = _VersionIndex(x for x in versions if x.is_zero)
+
+    @property
+    def log_offset(self) -> int:
+        return self._log_offset
+
+    @property
+    def log_length(self) -> int:
+        return self._log_length
+
+    @property
+    def entries(self) -> typing.List[typing.Tuple[int, LogEntry]]:
+        """(offset into the log, LogEntry) for every valid entry found in the log, in sequence number order"""
+        return sorted(self._entries.items(), key=lambda x: x[1].sequence_number)
+
+    @property
+    def active_entry_offsets(self) -> typing.FrozenSet[int]:
+        return self._active_offsets
+
+    @property
+    def rejected_entries(self) -> typing.List[RejectedLogEntry]:
+        """Entry headers found in the log which failed validation (torn or partly overwritten entries)"""
+        return self._rejected
+
+    @property
+    def sector_count(self) -> int:
+        return len(self._data_index)
+
+    def iter_file_versions(self, file_offset: int, length: int) -> typing.Iterator[LogSectorVersion]:
+        """
+        Yields every logged write which overlaps length bytes of the VHDX file from file_offset, ordered by file offset
+        and then by sequence number (oldest first)
+        """
+        end = file_offset + length
+        yield from sorted(
+            list(self._data_index.iter_overlapping(file_offset, end)) +
+            list(self._zero_index.iter_overlapping(file_offset, end)),
+            key=lambda x: (x.file_offset, x.sequence_number))
+
+    def _iter_block_file_offsets(self, vhdx: VhdxFile, bat_index: int):
+        # where the block has been stored: the current BAT entry, then whatever each logged BAT sector said
+        offsets = set()
+        raw_bat = vhdx.raw_bat
+        if bat_index < len(raw_bat):
+            offsets.add(((raw_bat[bat_index] >> 20) & 0xfffffffffff) << 20)
+        entry_offset = vhdx.region_table[guid_to_blob(REGION_GUID_BAT)].offset + bat_index * 8
+        for version in self.iter_file_versions(entry_offset, 8):
+            if version.is_zero:
+                continue
+            raw_entry, = struct.unpack_from("<Q", version.data, entry_offset - version.file_offset)
+            offsets.add(((raw_entry >> 20) & 0xfffffffffff) << 20)
+        offsets.discard(0)
+        return sorted(offsets)
+
+    def get_virtual_versions(self, vhdx: VhdxFile, virtual_offset: int,
+                             length: int) -> typing.List[HistoricalVersion]:
+        """
+        Every logged version of the data in length bytes of vhdx's virtual disk from virtual_offset, clipped to the
+        range and ordered by virtual offset and then sequence number. Payload blocks are found through the current BAT
+        and through every version of the BAT held in the log, so writes to a block's earlier location are included.
+        vhdx must be the file this history was read from.
+        """
+        if virtual_offset < 0 or length < 0 or virtual_offset + length > vhdx.virtual_disk_size:
+            raise ValueError("Range is outside the virtual disk")
+        end = virtual_offset + length
+        block_size = vhdx.block_size
+        found = []
+        for block_index in range(virtual_offset // block_size, -(-end // block_size)):
+            block_start = block_index * block_size
+            start_in_block = max(virtual_offset, block_start) - block_start
+            end_in_block = min(end, block_start + block_size) - block_start
+            bat_index = block_index + (block_index // vhdx.chunk_ratio)
+            for block_file_offset in self._iter_block_file_offsets(vhdx, bat_index):
+                range_start = block_file_offset + start_in_block
+                range_end = block_file_offset + end_in_block
+                for version in self.iter_file_versions(range_start, range_end - range_start):
+                    clip_start = max(range_start, version.file_offset)
+                    clip_end = min(range_end, version.file_offset + version.length)
+                    if version.is_zero:
+                        data = bytes(clip_end - clip_start)
+                    else:
+                        data = version.data[clip_start - version.file_offset:clip_end - version.file_offset]
+                    found.append(HistoricalVersion(
+                        block_start + (clip_start - block_file_offset), clip_start, version.sequence_number,
+                        version.entry_offset, version.is_active, data))
+
+        found.sort(key=lambda x: (x.virtual_offset, x.sequence_number, x.file_offset))
+        return found
+
+
+def _read_ring(log: bytes, offset: int, length: int) -> bytes:
+    # entries may wrap from the end of the log back to the start
+    if offset + length <= len(log):
+        return log[offset:offset + length]
+    return log[offset:] + log[:offset + length - len(log)]
+
+
+def _parse_entry(log: bytes, entry_offset: int) -> LogEntry:
+    entry_length, = struct.unpack_from("<I", log, entry_offset + 8)
+    if entry_length == 0 or entry_length % LOG_SECTOR_SIZE:
+        raise VhdxLogError(f"Log entry length {entry_length} is not a whole number of log sectors")
+    if entry_length > len(log):
+        raise VhdxLogError(f"Log entry length {entry_length} does not fit in the log")
+    raw = _read_ring(log, entry_offset, entry_length)
+    entry = LogEntry.from_stream(io.BytesIO(raw))
+    if crc32c(raw[0:4] + bytes(4) + raw[8:]) != entry.checksum:
+        raise VhdxLogError("Checksum mismatch")
+    if entry.descriptor_area_length + len(entry.data_descriptors) * LOG_SECTOR_SIZE > entry_length:
+        raise VhdxLogError("Too many data descriptors for the entry length")
+    for descriptor in entry.descriptors:
+        if descriptor.sequence_number != entry.sequence_number:
+            raise VhdxLogError(
+                f"Descriptor sequence number {descriptor.sequence_number} does not match the entry's "
+                f"({entry.sequence_number})")
+    for i in range(len(entry.data_descriptors)):
+        sector_offset = entry.descriptor_area_length + i * LOG_SECTOR_SIZE
+        if raw[sector_offset:sector_offset + 4] != LOG_DATA_SECTOR_MAGIC:
+            raise VhdxLogError(f"Invalid data sector magic in data sector {i}")
+        sequence_high, = struct.unpack_from("<I", raw, sector_offset + 4)
+        sequence_low, = struct.unpack_from("<I", raw, sector_offset + LOG_SECTOR_SIZE - 4)
+        if (sequence_high << 32) | sequence_low != entry.sequence_number:
+            raise VhdxLogError(f"Data sector {i} is from another entry (torn write)")
+    return entry
+
+
+def _iter_entry_versions(log: bytes, entry_offset: int, entry: LogEntry,
+                         is_active: bool) -> typing.Iterator[LogSectorVersion]:
+    sector_offset = entry_offset + entry.descriptor_area_length
+    for descriptor in entry.descriptors:
+        if descriptor.is_zero:
+            yield LogSectorVersion(descriptor.file_offset, descriptor.length, entry.sequence_number, entry_offset,
+                                   is_active, None)
+            continue
+        data_sector = _read_ring(log, sector_offset % len(log), LOG_SECTOR_SIZE)
+        sector_offset += LOG_SECTOR_SIZE
+        yield LogSectorVersion(descriptor.file_offset, descriptor.length, entry.sequence_number, entry_offset,
+                               is_active, descriptor.build_sector(data_sector))
+
+
+def _find_active_sequence(entries: typing.Dict[int, LogEntry], log_guid: bytes, log_length: int) -> typing.Set[int]:
+    # the active sequence runs from the tail named by the newest entry with the header's log guid up to that entry,
+    # each entry following directly on from the last with the next sequence number
+    if log_guid == _NULL_GUID:
+        return set()
+    candidates = {offset: entry for offset, entry in entries.items() if entry.log_guid == log_guid}
+    if not candidates:
+        return set()
+    head_offset = max(candidates, key=lambda x: candidates[x].sequence_number)
+    head = candidates[head_offset]
+    active = set()
+    offset = head.tail
+    previous_sequence_number = None
+    while offset in candidates and len(active) < len(candidates):
+        entry = candidates[offset]
+        if previous_sequence_number is not None and entry.sequence_number != previous_sequence_number + 1:
+            break
+        active.add(offset)
+        if offset == head_offset:
+            return active
+        previous_sequence_number = entry.sequence_number
+        offset = (offset + entry.entry_length) % log_length
+    _vhdx._l(f"WARNING: Could not follow the active log sequence from {head.tail} to the entry at {head_offset}",
+             to_stdout=_vhdx.DEBUG_TO_STDOUT)
+    return set()
+
+
+def read_log_history(vhdx: VhdxFile, *, progress: typing.Optional[ProgressCallback] = None) -> LogHistory:
+    """
+    Reads every valid entry from the log of a VHDX file, whether it is part of the active sequence or left over from
+    earlier ones, and indexes the sectors they wrote by file offset and sequence number. Each 4096 byte boundary of the
+    log is tried as the start of an entry, and an entry is only accepted if its checksum matches and its descriptors
+    and data sectors carry its sequence number. progress is a callback as for ProgressTracker.
+    """
+    log_offset = vhdx.header.log_offset
+    log_length = vhdx.header.log_length
+    log = vhdx.source.read_at(log_offset, log_length) if log_length else b""
+    if len(log) < log_length:
+        _vhdx._l(f"WARNING: Log truncated (Expected: {log_length} bytes; got: {len(log)})",
+                 to_stdout=_vhdx.DEBUG_TO_STDOUT)
+        log = log[:len(log) - (len(log) % LOG_SECTOR_SIZE)]
+    log_length = len(log)
+
+    tracker = ProgressTracker(progress, "log_history", log_length)
+    entries = {}
+    rejected = []
+    for entry_offset in range(0, log_length, LOG_SECTOR_SIZE):
+        if log[entry_offset:entry_offset + 4] == LOG_HEADER_MAGIC:
+            try:
+                entries[entry_offset] = _parse_entry(log, entry_offset)
+            except (VhdxLogError, ValueError) as e:
+                # stale or partly overwritten sectors can hold anything, so nothing about one stops the scan
+                rejected.append(RejectedLogEntry(entry_offset, str(e)))
+        if (entry_offset + LOG_SECTOR_SIZE) % _PROGRESS_STEP == 0:
+            tracker.advance(processed=_PROGRESS_STEP)
+    tracker.advance(processed=log_length % _PROGRESS_STEP)
+    tracker.finish()
+
+    active = _find_active_sequence(entries, vhdx.header.log_guid, log_length)
+    versions = []
+    for entry_offset, entry in entries.items():
+        versions.extend(_iter_entry_versions(log, entry_offset, entry, entry_offset in active))
+
+    return LogHistory(log_offset, log_length, entries, active, rejected, versions)
@@ -0,0 +1,266 @@
+"""
+Copyright 2019, CCL (SOLUTIONS) Group Ltd.
+
+Permission is hereby granted, free of charge, to any person obtaining a copy of this software and associated
+documentation files (the "Software"), to deal in the Software without restriction, including without limitation the
+rights to use, copy, modify, merge, publish, distribute, sublicense, and/or sell copies of the Software, and to permit
+persons to whom the Software is furnished to do so, subject to the following conditions:
+
+The above copyright notice and this permission notice shall be included in all copies or substantial portions of the
+Software.
+
+THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR IMPLIED, INCLUDING BUT NOT LIMITED TO THE
+WARRANTIES OF MERCHANTABILITY, FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE AUTHORS OR
+COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR
+OTHERWISE, ARISING FROM, OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE SOFTWARE.
+"""
+
+import bisect
+import os
+import pathlib
+import typing
+
+from .ccl_vhdx import VhdxFile, BatPayloadBlockState, BAT_SB_BLOCK_PRESENT, is_zero_buffer
+
+__all__ = ["IntervalSet", "PhysicalExtent", "OccupancyMap", "build_occupancy_map", "carve_unreferenced"]
+
+HEADER_SECTION_LENGTH = 1 << 20  # file identifier, both headers and both region tables, plus reserved space
+SECTOR_BITMAP_BLOCK_LENGTH = 1 << 20
+
+EXTENT_HEADER_SECTION = "header_section"
+EXTENT_REGION = "region"
+EXTENT_LOG = "log"
+EXTENT_PAYLOAD = "payload"
+EXTENT_SECTOR_BITMAP = "sector_bitmap"
+EXTENT_STALE = "stale_payload"
+EXTENT_GAP = "unreferenced"
+
+_LIVE_PAYLOAD_STATES = (BatPayloadBlockState.BAT_PAYLOAD_BLOCK_FULLY_PRESENT,
+                        BatPayloadBlockState.BAT_PAYLOAD_BLOCK_PARTIALLY_PRESENT)
+
+_CARVE_CHUNK_SIZE = 1 << 24
+
+
+class PhysicalExtent(typing.NamedTuple):
+    start: int
+    end: int  # exclusive
+    kind: str
+    detail: typing.Optional[int] = None  # BAT index for payload, sector bitmap and stale extents
+
+    @property
+    def length(self):
+        return self.end - self.start
+
+
+class IntervalSet:
+    """
+    A set of half-open integer intervals. Intervals are collected unsorted and then sorted and merged once, on first
+    query, so building a set from n intervals costs O(n log n) however they arrive.
+    """
+    def __init__(self, intervals: typing.Iterable[typing.Tuple[int, int]] = ()):
+        self._pending = [(start, end) for start, end in intervals if end > start]
+        self._merged = []
+        self._ends = []
+
+    def add(self, start: int, end: int):
+        if end > start:
+            self._pending.append((start, end))
+
+    def _merge(self):
+        if not self._pending:
+            return
+        intervals = sorted(self._merged + self._pending)
+        self._pending = []
+        merged = [list(intervals[0])]
+        for start, end in intervals[1:]:
+            if start <= merged[-1][1]:
+                merged[-1][1] = max(merged[-1][1], end)
+            else:
+                merged.append([start, end])
+        self._merged = [(start, end) for start, end in merged]
+        self._ends = [end for _, end in self._merged]
+
+    def __iter__(self):
+        self._merge()
+        yield from self._merged
+
+    def __len__(self):
+        self._merge()
+        return len(self._merged)
+
+    def total_length(self) -> int:
+        return sum(end - start for start, end in self)
+
+    def gaps(self, start: int, end: int):
+        """Yields the (start, end) intervals between start and end which are not covered by the set"""
+        self._merge()
+        position = start
+        # the merged intervals are disjoint, so their ends are sorted too and the first one reaching start is bisected
+        for index in range(bisect.bisect_right(self._ends, start), len(self._merged)):
+            interval_start, interval_end = self._merged[index]
+            if interval_start >= end:
+                break
+            if interval_start > position:
+                yield position, interval_start
+            position = max(position, interval_end)
+        if position < end:
+            yield position, end
+
+
+class OccupancyMap:
+    def __init__(self, file_size: int, extents: typing.List[PhysicalExtent], gaps: typing.List[PhysicalExtent],
+                 beyond_eof: typing.List[PhysicalExtent]):
+        self._file_size = file_size
+        self._extents = extents
+        self._gaps = gaps
+        self._beyond_eof = beyond_eof
+
+    @property
+    def file_size(self):
+        return self._file_size
+
+    @property
+    def extents(self) -> typing.List[PhysicalExtent]:
+        """Every referenced extent (live and stale), sorted by start offset and clipped to the end of the file"""
+        return self._extents
+
+    @property
+    def gaps(self) -> typing.List[PhysicalExtent]:
+        """Areas of the file referenced by nothing at all (not even a stale BAT entry)"""
+        return self._gaps
+
+    @property
+    def stale_extents(self) -> typing.List[PhysicalExtent]:
+        """
+        Space referenced only by stale BAT entries (payload entries which are NOT_PRESENT, UNDEFINED, ZERO or UNMAPPED,
+        and sector bitmap entries which are not PRESENT), less anything a live extent also covers. A stale block which
+        is partly overlapped by live data is split into the pieces which are not.
+        """
+        return [x for x in self._extents if x.kind == EXTENT_STALE]
+
+    @property
+    def beyond_eof(self) -> typing.List[PhysicalExtent]:
+        """Referenced extents which start beyond the end of the file"""
+        return self._beyond_eof
+
+    def iter_unreferenced(self, *, include_stale=True):
+        """Yields the gaps and (optionally) the stale extents together, in file order"""
+        if not include_stale:
+            yield from self._gaps
+            return
+        yield from sorted(self._gaps + self.stale_extents)
+
+
+def _iter_referenced_extents(vhdx: VhdxFile):
+    yield PhysicalExtent(0, HEADER_SECTION_LENGTH, EXTENT_HEADER_SECTION)
+
+    for guid in vhdx.region_table:
+        region = vhdx.region_table[guid]
+        yield PhysicalExtent(region.offset, region.offset + region.length, EXTENT_REGION)
+
+    if vhdx.header.log_length:
+        yield PhysicalExtent(vhdx.header.log_offset, vhdx.header.log_offset + vhdx.header.log_length, EXTENT_LOG)
+
+    # a single pass over the raw BAT values, every (chunk_ratio + 1)th entry being a sector bitmap entry
+    mb = 1 << 20
+    block_size = vhdx.block_size
+    sector_bitmap_period = vhdx.chunk_ratio + 1
+    for bat_index, raw_entry in enumerate(vhdx.raw_bat):
+        file_offset = ((raw_entry >> 20) & 0xfffffffffff) * mb
+        if file_offset == 0:
+            continue
+        state = raw_entry & 0x07
+        if (bat_index + 1) % sector_bitmap_period == 0:
+            if state == BAT_SB_BLOCK_PRESENT:
+                yield PhysicalExtent(file_offset, file_offset + SECTOR_BITMAP_BLOCK_LENGTH, EXTENT_SECTOR_BITMAP,
+                                     bat_index)
+            else:
+                yield PhysicalExtent(file_offset, file_offset + SECTOR_BITMAP_BLOCK_LENGTH, EXTENT_STALE, bat_index)
+        elif state in _LIVE_PAYLOAD_STATES:
+            yield PhysicalExtent(file_offset, file_offset + block_size, EXTENT_PAYLOAD, bat_index)
+        else:
+            yield PhysicalExtent(file_offset, file_offset + block_size, EXTENT_STALE, bat_index)
+
+
+def build_occupancy_map(vhdx: VhdxFile) -> OccupancyMap:
+    """
+    Maps the physical space of a VHDX file: everything referenced by the header section, region table, log and BAT
+    (payload blocks and sector bitmaps), the space only referenced by stale BAT entries, and the gaps which nothing
+    references. The BAT is walked once and the extents are sorted once.
+    """
+    file_size = vhdx.file_size
+    extents = []
+    stale = []
+    beyond_eof = []
+    referenced = IntervalSet()
+    live = IntervalSet()
+    for extent in _iter_referenced_extents(vhdx):
+        if extent.start >= file_size:
+            beyond_eof.append(extent)
+            continue
+        extent = extent._replace(end=min(extent.end, file_size))
+        referenced.add(extent.start, extent.end)
+        if extent.kind == EXTENT_STALE:
+            stale.append(extent)
+        else:
+            extents.append(extent)
+            live.add(extent.start, extent.end)
+
+    # a stale entry can still point at space which has since been reused by a live block or sector bitmap; only what
+    # is left over is stale. Several stale entries often point at the same block (after it was reused), which is only
+    # listed once: of the stale extents starting at the same offset, the longest (then the first in the BAT) is kept
+    stale_by_start = {}
+    for extent in stale:
+        for start, end in live.gaps(extent.start, extent.end):
+            kept = stale_by_start.get(start)
+            if kept is None or end > kept.end:
+                stale_by_start[start] = extent._replace(start=start, end=end)
+    extents.extend(stale_by_start.values())
+
+    extents.sort()
+    gaps = [PhysicalExtent(start, end, EXTENT_GAP) for start, end in referenced.gaps(0, file_size)]
+    return OccupancyMap(file_size, extents, gaps, beyond_eof)
+
+
+def carve_unreferenced(vhdx: VhdxFile, out_dir: os.PathLike, occupancy: typing.Optional[OccupancyMap] = None, *,
+                       include_stale=True, skip_zero=True) -> typing.List[pathlib.Path]:
+    """
+    Copies each unreferenced area (and optionally each stale payload block) of the VHDX file to its own file in
+    out_dir, named for its kind and file offset. Zero chunks are left as holes, and extents which are entirely zeros
+    are not written at all if skip_zero is True. Returns the paths written.
+    """
+    if occupancy is None:
+        occupancy = build_occupancy_map(vhdx)
+    out_dir = pathlib.Path(out_dir)
+    out_dir.mkdir(parents=True, exist_ok=True)
+    written = []
+    with vhdx.source.open() as f:
+        for extent in occupancy.iter_unreferenced(include_stale=include_stale):
+            out_path = out_dir / f"{extent.kind}_{extent.start:016x}.bin"
+            out = None
+            f.seek(extent.start)
+            position = extent.start
+            try:
+                while position < extent.end:
+                    data = f.read(min(_CARVE_CHUNK_SIZE, extent.end - position))
+                    if not data:
+                        break
+                    if is_zero_buffer(data):
+                        if out is not None:
+                            out.seek(len(data), os.SEEK_CUR)
+                    else:
+                        if out is None:
+                            out = out_path.open("xb")
+                            out.seek(position - extent.start)
+                        out.write(data)
+                    position += len(data)
+                if out is None and not skip_zero:
+                    out = out_path.open("xb")
+                if out is not None:
+                    out.truncate(position - extent.start)
+                    written.append(out_path)
+            finally:
+                if out is not None:
+                    out.close()
+
+    return written
@@ -0,0 +1,67 @@
+"""
+Copyright 2019, CCL (SOLUTIONS) Group Ltd.
+
+Permission is hereby granted, free of charge, to any person obtaining a copy of this software and associated
+documentation files (the "Software"), to deal in the Software without restriction, including without limitation the
+rights to use, copy, modify, merge, publish, distribute, sublicense, and/or sell copies of the Software, and to permit
+persons to whom the Software is furnished to do so, subject to the following conditions:
+
+The above copyright notice and this permission notice shall be included in all copies or substantial portions of the
+Software.
+
+THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR IMPLIED, INCLUDING BUT NOT LIMITED TO THE
+WARRANTIES OF MERCHANTABILITY, FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE AUTHORS OR
+COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR
+OTHERWISE, ARISING FROM, OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE SOFTWARE.
+"""
+
+import collections
+import concurrent.futures
+import typing
+
+__all__ = ["iter_worker_results"]
+
+MAX_IN_FLIGHT_PER_WORKER = 2
+
+# (method name, args) to call on the worker object
+WorkerCall = typing.Tuple[str, tuple]
+
+_worker_object = None
+
+
+def _init_worker(worker_factory, factory_args):
+    global _worker_object
+    _worker_object = worker_factory(*factory_args)
+
+
+def _run_in_worker(call: WorkerCall):
+    method, args = call
+    return getattr(_worker_object, method)(*args)
+
+
+def iter_worker_results(worker_factory: typing.Callable, factory_args: tuple, calls: typing.Iterable[WorkerCall],
+                        workers: int) -> typing.Iterator[typing.Tuple[WorkerCall, typing.Any]]:
+    """
+    Makes each (method name, args) call on an object made by worker_factory(*factory_args), yielding (call, result)
+    in the order of calls. With workers=1 everything happens in this process; otherwise the calls are shared among a
+    pool of worker processes, each of which makes its own object when it starts, so whatever the object holds (a disk,
+    say) is sent to each process once rather than with every call. Only MAX_IN_FLIGHT_PER_WORKER calls per worker are
+    queued at once, so results are never held back for long.
+    """
+    if workers == 1:
+        worker_object = worker_factory(*factory_args)
+        for method, args in calls:
+            yield (method, args), getattr(worker_object, method)(*args)
+        return
+
+    with concurrent.futures.ProcessPoolExecutor(
+            workers, initializer=_init_worker, initargs=(worker_factory, factory_args)) as executor:
+        in_flight = collections.deque()
+        for call in calls:
+            in_flight.append((call, executor.submit(_run_in_worker, call)))
+            if len(in_flight) >= workers * MAX_IN_FLIGHT_PER_WORKER:
+                done_call, future = in_flight.popleft()
+                yield done_call, future.result()
+        while in_flight:
+            done_call, future = in_flight.popleft()
+            yield done_call, future.result()
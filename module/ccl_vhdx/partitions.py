@@ -0,0 +1,299 @@
+"""
+Copyright 2019, CCL (SOLUTIONS) Group Ltd.
+
+Permission is hereby granted, free of charge, to any person obtaining a copy of this software and associated
+documentation files (the "Software"), to deal in the Software without restriction, including without limitation the
+rights to use, copy, modify, merge, publish, distribute, sublicense, and/or sell copies of the Software, and to permit
+persons to whom the Software is furnished to do so, subject to the following conditions:
+
+The above copyright notice and this permission notice shall be included in all copies or substantial portions of the
+Software.
+
+THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR IMPLIED, INCLUDING BUT NOT LIMITED TO THE
+WARRANTIES OF MERCHANTABILITY, FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE AUTHORS OR
+COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR
+OTHERWISE, ARISING FROM, OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE SOFTWARE.
+"""
+
+import struct
+import typing
+import uuid
+import zlib
+
+from . import ccl_vhdx as _vhdx
+from .ccl_vhdx import VhdxError
+
+__all__ = ["VhdxPartitionError", "Partition", "PartitionTable", "read_partition_table", "GPT_TYPE_NAMES",
+           "MBR_TYPE_NAMES"]
+
+MBR_SIGNATURE = b"\x55\xaa"
+MBR_TYPE_PROTECTIVE = 0xee
+MBR_EXTENDED_TYPES = (0x05, 0x0f, 0x85)
+
+GPT_SIGNATURE = b"EFI PART"
+GPT_HEADER_FORMAT = "<8sIIIIQQQQ16sQIII"
+GPT_ENTRY_FORMAT = "<16s16sQQQ72s"
+GPT_MAX_ENTRIES = 1 << 16  # sanity limit; the standard table has 128
+GPT_MAX_ENTRY_SIZE = 4096  # entries are 128 * 2^n bytes; anything bigger than this is not a real table
+
+MAX_LOGICAL_PARTITIONS = 1024  # guard against looping EBR chains
+
+GPT_TYPE_NAMES = {
+    "C12A7328-F81F-11D2-BA4B-00A0C93EC93B": "EFI System",
+    "E3C9E316-0B5C-4DB8-817D-F92DF00215AE": "Microsoft Reserved",
+    "EBD0A0A2-B9E5-4433-87C0-68B6B72699C7": "Microsoft Basic Data",
+    "DE94BBA4-06D1-4D40-A16A-BFD50179D6AC": "Windows Recovery Environment",
+    "5808C8AA-7E8F-42E0-85D2-E1E90434CFB3": "LDM Metadata",
+    "AF9B60A0-1431-4F62-BC68-3311714A69AD": "LDM Data",
+    "E75CAF8F-F680-4CEE-AFA3-B001E56EFC2D": "Storage Spaces",
+    "0FC63DAF-8483-4772-8E79-3D69D8477DE4": "Linux Filesystem",
+    "0657FD6D-A4AB-43C4-84E5-0933C84B4F4F": "Linux Swap",
+    "E6D6D379-F507-44C2-A23C-238F2A3DF928": "Linux LVM",
+    "21686148-6449-6E6F-744E-656564454649": "BIOS Boot",
+}
+
+MBR_TYPE_NAMES = {
+    0x01: "FAT12",
+    0x04: "FAT16 (<32 MB)",
+    0x05: "Extended",
+    0x06: "FAT16",
+    0x07: "NTFS / exFAT",
+    0x0b: "FAT32 (CHS)",
+    0x0c: "FAT32 (LBA)",
+    0x0e: "FAT16 (LBA)",
+    0x0f: "Extended (LBA)",
+    0x27: "Windows Recovery Environment",
+    0x82: "Linux Swap",
+    0x83: "Linux",
+    0x85: "Linux Extended",
+    0x8e: "Linux LVM",
+    0xee: "GPT Protective",
+    0xef: "EFI System",
+}
+
+
+class VhdxPartitionError(VhdxError):
+    pass
+
+
+def _format_guid(raw: bytes) -> str:
+    return str(uuid.UUID(bytes_le=raw)).upper()
+
+
+class Partition:
+    def __init__(self, index: int, scheme: str, offset: int, length: int, partition_type, *, name: str = "",
+                 guid: typing.Optional[str] = None, attributes: int = 0, is_bootable: bool = False):
+        self._index = index
+        self._scheme = scheme
+        self._offset = offset
+        self._length = length
+        self._type = partition_type
+        self._name = name
+        self._guid = guid
+        self._attributes = attributes
+        self._is_bootable = is_bootable
+
+    def __repr__(self):
+        return (f"<Partition {self._index} ({self._scheme}) offset: {self._offset}; length: {self._length}; "
+                f"type: {self.type_description}>")
+
+    @property
+    def index(self) -> int:
+        """1-based: MBR primary partitions are 1-4 and logical partitions follow from 5; GPT uses the table slot"""
+        return self._index
+
+    @property
+    def scheme(self) -> str:
+        return self._scheme
+
+    @property
+    def offset(self) -> int:
+        """Byte offset of the partition on the virtual disk"""
+        return self._offset
+
+    @property
+    def length(self) -> int:
+        return self._length
+
+    @property
+    def type(self):
+        """The MBR partition type byte (int) or GPT partition type GUID (str)"""
+        return self._type
+
+    @property
+    def type_description(self) -> str:
+        if self._scheme == "GPT":
+            return GPT_TYPE_NAMES.get(self._type, self._type)
+        return MBR_TYPE_NAMES.get(self._type, f"0x{self._type:02x}")
+
+    @property
+    def name(self) -> str:
+        return self._name
+
+    @property
+    def guid(self) -> typing.Optional[str]:
+        return self._guid
+
+    @property
+    def attributes(self) -> int:
+        return self._attributes
+
+    @property
+    def is_bootable(self) -> bool:
+        return self._is_bootable
+
+
+class PartitionTable:
+    def __init__(self, scheme: str, partitions: typing.Sequence[Partition], *, disk_guid: typing.Optional[str] = None,
+                 used_backup_gpt: bool = False):
+        self._scheme = scheme
+        self._partitions = tuple(partitions)
+        self._disk_guid = disk_guid
+        self._used_backup_gpt = used_backup_gpt
+
+    def __len__(self):
+        return len(self._partitions)
+
+    def __iter__(self):
+        yield from self._partitions
+
+    def __getitem__(self, index: int) -> Partition:
+        """Looks up a partition by its (1-based) partition index"""
+        for partition in self._partitions:
+            if partition.index == index:
+                return partition
+        raise KeyError(index)
+
+    @property
+    def scheme(self) -> str:
+        """"MBR", "GPT" or "None" if no partition table could be found"""
+        return self._scheme
+
+    @property
+    def partitions(self) -> typing.Tuple[Partition, ...]:
+        return self._partitions
+
+    @property
+    def disk_guid(self) -> typing.Optional[str]:
+        return self._disk_guid
+
+    @property
+    def used_backup_gpt(self) -> bool:
+        return self._used_backup_gpt
+
+
+def _parse_mbr_entries(sector: bytes):
+    for i in range(4):
+        status, partition_type, first_lba, sector_count = struct.unpack_from("<B3xB3xII", sector, 446 + (16 * i))
+        yield i, status, partition_type, first_lba, sector_count
+
+
+def _read_mbr(disk, sector_size: int, mbr: bytes) -> typing.List[Partition]:
+    partitions = []
+    extended = None
+    for i, status, partition_type, first_lba, sector_count in _parse_mbr_entries(mbr):
+        if partition_type == 0 or sector_count == 0:
+            continue
+        if partition_type in MBR_EXTENDED_TYPES:
+            extended = first_lba
+            continue
+        partitions.append(Partition(i + 1, "MBR", first_lba * sector_size, sector_count * sector_size,
+                                    partition_type, is_bootable=status == 0x80))
+
+    # logical partitions live in a linked list of extended boot records; the first entry of each is relative to that
+    # EBR, the second points at the next EBR relative to the start of the extended partition
+    if extended is not None:
+        ebr_lba = extended
+        logical_index = 5
+        seen = set()
+        while ebr_lba not in seen and len(seen) < MAX_LOGICAL_PARTITIONS:
+            seen.add(ebr_lba)
+            ebr = disk.read(ebr_lba * sector_size, sector_size)
+            if len(ebr) < 512 or ebr[510:512] != MBR_SIGNATURE:
+                _vhdx._l(f"WARNING: Invalid extended boot record at LBA {ebr_lba}", to_stdout=_vhdx.DEBUG_TO_STDOUT)
+                break
+            entries = list(_parse_mbr_entries(ebr))
+            _, status, partition_type, first_lba, sector_count = entries[0]
+            if partition_type != 0 and sector_count != 0:
+                partitions.append(Partition(logical_index, "MBR", (ebr_lba + first_lba) * sector_size,
+                                            sector_count * sector_size, partition_type, is_bootable=status == 0x80))
+                logical_index += 1
+            _, _, next_type, next_lba, _ = entries[1]
+            if next_type not in MBR_EXTENDED_TYPES or next_lba == 0:
+                break
+            ebr_lba = extended + next_lba
+
+    return partitions
+
+
+def _read_gpt_header(disk, sector_size: int, lba: int):
+    raw = disk.read(lba * sector_size, sector_size)
+    if len(raw) < struct.calcsize(GPT_HEADER_FORMAT) or raw[0:8] != GPT_SIGNATURE:
+        return None
+    (signature, revision, header_size, header_crc, reserved, my_lba, alternate_lba, first_usable, last_usable,
+     disk_guid, entries_lba, entry_count, entry_size, entries_crc) = struct.unpack_from(GPT_HEADER_FORMAT, raw, 0)
+    if header_size < 92 or header_size > sector_size:
+        _vhdx._l(f"WARNING: Invalid GPT header size {header_size} at LBA {lba}", to_stdout=_vhdx.DEBUG_TO_STDOUT)
+        return None
+    check = bytearray(raw[:header_size])
+    check[16:20] = b"\x00\x00\x00\x00"
+    if zlib.crc32(check) != header_crc:
+        _vhdx._l(f"WARNING: GPT header CRC mismatch at LBA {lba}", to_stdout=_vhdx.DEBUG_TO_STDOUT)
+        return None
+    if (entry_size < struct.calcsize(GPT_ENTRY_FORMAT) or entry_size > GPT_MAX_ENTRY_SIZE or
+            entry_size & (entry_size - 1) or entry_count > GPT_MAX_ENTRIES):
+        _vhdx._l(f"WARNING: Implausible GPT entry table at LBA {lba}", to_stdout=_vhdx.DEBUG_TO_STDOUT)
+        return None
+
+    entries_raw = disk.read(entries_lba * sector_size, entry_count * entry_size)
+    if len(entries_raw) != entry_count * entry_size or zlib.crc32(entries_raw) != entries_crc:
+        _vhdx._l(f"WARNING: GPT partition entry CRC mismatch for header at LBA {lba}",
+                 to_stdout=_vhdx.DEBUG_TO_STDOUT)
+        return None
+
+    partitions = []
+    for i in range(entry_count):
+        type_guid, unique_guid, first_lba, last_lba, attributes, name = struct.unpack_from(
+            GPT_ENTRY_FORMAT, entries_raw, i * entry_size)
+        if type_guid == b"\x00" * 16:
+            continue
+        if last_lba < first_lba:
+            _vhdx._l(f"WARNING: GPT entry {i} ends before it starts, skipping", to_stdout=_vhdx.DEBUG_TO_STDOUT)
+            continue
+        partitions.append(Partition(
+            i + 1, "GPT", first_lba * sector_size, (last_lba - first_lba + 1) * sector_size, _format_guid(type_guid),
+            name=name.decode("utf-16-le", "replace").split("\x00", 1)[0], guid=_format_guid(unique_guid),
+            attributes=attributes))
+
+    return _format_guid(disk_guid), partitions
+
+
+def read_partition_table(disk) -> PartitionTable:
+    """
+    Reads the MBR or GPT from a VhdxFile or VhdxChain. A GPT is used when the MBR is protective (or missing); if the
+    primary GPT header or entry table fails its CRC the backup GPT at the end of the disk is used instead.
+    """
+    sector_size = disk.logical_sector_size
+    mbr = disk.read(0, 512)
+    mbr_valid = len(mbr) == 512 and mbr[510:512] == MBR_SIGNATURE
+    is_protective = mbr_valid and any(
+        partition_type == MBR_TYPE_PROTECTIVE for _, _, partition_type, _, _ in _parse_mbr_entries(mbr))
+
+    if mbr_valid and not is_protective:
+        return PartitionTable("MBR", _read_mbr(disk, sector_size, mbr))
+
+    primary = _read_gpt_header(disk, sector_size, 1)
+    if primary is not None:
+        disk_guid, partitions = primary
+        return PartitionTable("GPT", partitions, disk_guid=disk_guid)
+
+    last_lba = (disk.virtual_disk_size // sector_size) - 1
+    _vhdx._l(f"WARNING: Primary GPT unusable, trying the backup at LBA {last_lba}", to_stdout=_vhdx.DEBUG_TO_STDOUT)
+    backup = _read_gpt_header(disk, sector_size, last_lba)
+    if backup is not None:
+        disk_guid, partitions = backup
+        return PartitionTable("GPT", partitions, disk_guid=disk_guid, used_backup_gpt=True)
+
+    if is_protective:
+        raise VhdxPartitionError("Protective MBR present but neither the primary nor backup GPT is usable")
+    return PartitionTable("None", [])
@@ -0,0 +1,175 @@
+"""
+Copyright 2019, CCL (SOLUTIONS) Group Ltd.
+
+Permission is hereby granted, free of charge, to any person obtaining a copy of this software and associated
+documentation files (the "Software"), to deal in the Software without restriction, including without limitation the
+rights to use, copy, modify, merge, publish, distribute, sublicense, and/or sell copies of the Software, and to permit
+persons to whom the Software is furnished to do so, subject to the following conditions:
+
+The above copyright notice and this permission notice shall be included in all copies or substantial portions of the
+Software.
+
+THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR IMPLIED, INCLUDING BUT NOT LIMITED TO THE
+WARRANTIES OF MERCHANTABILITY, FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE AUTHORS OR
+COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR
+OTHERWISE, ARISING FROM, OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE SOFTWARE.
+"""
+
+import collections
+import sys
+import time
+import typing
+
+from .ccl_vhdx import VhdxError
+
+__all__ = ["OperationCancelled", "ProgressUpdate", "ProgressCallback", "ProgressTracker", "StatusLinePrinter",
+           "count_allocated_bytes"]
+
+PROGRESS_INTERVAL = 0.5  # seconds between callbacks
+RATE_WINDOW = 10.0  # seconds of samples the current rate is worked out over
+
+
+class OperationCancelled(VhdxError):
+    pass
+
+
+class ProgressUpdate(typing.NamedTuple):
+    operation: str
+    processed_bytes: int  # bytes actually read (or otherwise worked on)
+    skipped_bytes: int  # bytes passed over without reading, as they are sparse
+    total_bytes: int  # everything the operation covers, processed, skipped or still to come
+    expected_bytes: int  # the bytes expected to be processed (allocated bytes rather than the virtual size)
+    elapsed: float  # seconds
+    bytes_per_second: float  # the current rate of processing, over the last RATE_WINDOW seconds
+    eta: typing.Optional[float]  # seconds remaining at the current rate, None until there is a rate
+    finished: bool = False
+
+    @property
+    def fraction(self) -> float:
+        """How much of the expected work is done, from 0.0 to 1.0"""
+        if self.expected_bytes <= 0:
+            return 1.0
+        return min(1.0, self.processed_bytes / self.expected_bytes)
+
+
+# a callback returning a true value asks for the operation to stop; it does so by raising OperationCancelled
+ProgressCallback = typing.Callable[[ProgressUpdate], typing.Optional[bool]]
+
+
+class ProgressTracker:
+    """
+    Counts the bytes an operation processes and skips, passing a ProgressUpdate to the callback at most every interval
+    seconds (and once more when finished). Cancellation is cooperative: if the callback returns a true value,
+    OperationCancelled is raised from the next call to advance().
+    """
+    def __init__(self, callback: typing.Optional[ProgressCallback], operation: str, total_bytes: int,
+                 expected_bytes: typing.Optional[int] = None, *, interval=PROGRESS_INTERVAL):
+        self._callback = callback
+        self._operation = operation
+        self._total_bytes = total_bytes
+        self._expected_bytes = total_bytes if expected_bytes is None else expected_bytes
+        self._interval = interval
+        self._processed_bytes = 0
+        self._skipped_bytes = 0
+        self._start_time = time.monotonic()
+        self._next_report = self._start_time + interval
+        self._samples = collections.deque([(self._start_time, 0)])
+        self._cancelled = False
+
+    @property
+    def processed_bytes(self) -> int:
+        return self._processed_bytes
+
+    @property
+    def skipped_bytes(self) -> int:
+        return self._skipped_bytes
+
+    def _make_update(self, now: float, finished: bool) -> ProgressUpdate:
+        self._samples.append((now, self._processed_bytes))
+        while len(self._samples) > 2 and now - self._samples[1][0] >= RATE_WINDOW:
+            self._samples.popleft()
+        first_time, first_processed = self._samples[0]
+        rate = (self._processed_bytes - first_processed) / (now - first_time) if now > first_time else 0.0
+        remaining = max(0, self._expected_bytes - self._processed_bytes)
+        eta = remaining / rate if rate > 0 else (0.0 if not remaining else None)
+        return ProgressUpdate(self._operation, self._processed_bytes, self._skipped_bytes, self._total_bytes,
+                              self._expected_bytes, now - self._start_time, rate, eta, finished)
+
+    def _report(self, now: float, finished: bool):
+        if self._callback(self._make_update(now, finished)):
+            self._cancelled = True
+
+    def advance(self, processed: int = 0, skipped: int = 0):
+        self._processed_bytes += processed
+        self._skipped_bytes += skipped
+        if self._callback is None:
+            return
+        now = time.monotonic()
+        if now >= self._next_report:
+            self._next_report = now + self._interval
+            self._report(now, False)
+        if self._cancelled:
+            raise OperationCancelled(f"{self._operation} was cancelled")
+
+    def finish(self):
+        if self._callback is not None:
+            self._report(time.monotonic(), True)
+
+
+def count_allocated_bytes(disk, offset: int = 0, length: typing.Optional[int] = None) -> int:
+    """
+    The bytes of a range of a VhdxFile or VhdxChain which are in payload blocks that are not sparse, from the BAT
+    (and sector bitmaps) alone; this is what an export or hash of the range will actually read.
+    """
+    if length is None:
+        length = disk.virtual_disk_size - offset
+    end = offset + length
+    allocated = 0
+    for block_index in range(offset // disk.block_size, -(-end // disk.block_size)):
+        if not disk.is_block_sparse(block_index):
+            block_start = block_index * disk.block_size
+            allocated += min(block_start + disk.block_size, end) - max(block_start, offset)
+    return allocated
+
+
+def _format_bytes(count: float) -> str:
+    for unit in ("B", "KiB", "MiB", "GiB"):
+        if abs(count) < 1024:
+            return f"{count:.1f} {unit}"
+        count /= 1024
+    return f"{count:.1f} TiB"
+
+
+def _format_seconds(seconds: typing.Optional[float]) -> str:
+    if seconds is None:
+        return "--:--:--"
+    seconds = int(seconds)
+    return f"{seconds // 3600:02}:{seconds // 60 % 60:02}:{seconds % 60:02}"
+
+
+class StatusLinePrinter:
+    """
+    A progress callback which writes a status line to a stream (stderr by default): redrawn in place on a terminal,
+    otherwise written as a new line at most every log_interval seconds so that logs stay readable.
+    """
+    def __init__(self, stream: typing.Optional[typing.TextIO] = None, *, log_interval=30.0):
+        self._stream = stream or sys.stderr
+        self._is_terminal = self._stream.isatty()
+        self._log_interval = log_interval
+        self._last_logged = None
+        self._line_length = 0
+
+    def __call__(self, update: ProgressUpdate):
+        line = (f"{update.operation}: {update.fraction * 100:5.1f}% "
+                f"{_format_bytes(update.processed_bytes)} of {_format_bytes(update.expected_bytes)} "
+                f"({_format_bytes(update.skipped_bytes)} sparse skipped) "
+                f"{_format_bytes(update.bytes_per_second)}/s "
+                f"elapsed {_format_seconds(update.elapsed)} ETA {_format_seconds(update.eta)}")
+        if self._is_terminal:
+            self._stream.write("\r" + line.ljust(self._line_length) + ("\n" if update.finished else ""))
+            self._line_length = 0 if update.finished else len(line)
+        elif (update.finished or self._last_logged is None or
+              update.elapsed - self._last_logged >= self._log_interval):
+            self._stream.write(line + "\n")
+            self._last_logged = update.elapsed
+        self._stream.flush()
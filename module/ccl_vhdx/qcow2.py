@@ -0,0 +1,210 @@
+"""
+Copyright 2019, CCL (SOLUTIONS) Group Ltd.
+
+Permission is hereby granted, free of charge, to any person obtaining a copy of this software and associated
+documentation files (the "Software"), to deal in the Software without restriction, including without limitation the
+rights to use, copy, modify, merge, publish, distribute, sublicense, and/or sell copies of the Software, and to permit
+persons to whom the Software is furnished to do so, subject to the following conditions:
+
+The above copyright notice and this permission notice shall be included in all copies or substantial portions of the
+Software.
+
+THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR IMPLIED, INCLUDING BUT NOT LIMITED TO THE
+WARRANTIES OF MERCHANTABILITY, FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE AUTHORS OR
+COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR
+OTHERWISE, ARISING FROM, OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE SOFTWARE.
+"""
+
+import array
+import os
+import pathlib
+import struct
+import typing
+
+from .ccl_vhdx import is_zero_buffer
+from .export import ExportResult, iter_virtual_extents, _resolve_range
+from .progress import ProgressCallback
+
+__all__ = ["QCOW2_DEFAULT_CLUSTER_SIZE", "export_to_qcow2"]
+
+QCOW2_MAGIC = b"QFI\xfb"
+QCOW2_VERSION = 3
+QCOW2_DEFAULT_CLUSTER_SIZE = 1 << 16
+QCOW2_REFCOUNT_ORDER = 4  # 16-bit refcounts
+QCOW2_HEADER_LENGTH = 104
+QCOW2_OFLAG_COPIED = 1 << 63  # set on L1 and L2 entries whose cluster has a refcount of exactly 1
+
+_HEADER_STRUCT = struct.Struct(">4sIQIIQIIQQIIQQQQII")
+
+
+def _ceil_div(a: int, b: int) -> int:
+    return -(-a // b)
+
+
+class _Qcow2DataWriter:
+    """
+    Writes the non-zero clusters of a virtual disk one after another, in virtual order, recording which virtual
+    cluster each one holds. Clusters are assembled from extents which need not be cluster aligned.
+    """
+    def __init__(self, out: typing.BinaryIO, cluster_size: int, first_data_offset: int):
+        self._out = out
+        self._cluster_size = cluster_size
+        self._next_offset = first_data_offset
+        self._clusters = array.array("Q")  # virtual cluster index of each data cluster, in file order
+        self._pending = bytearray(cluster_size)
+        self._pending_index = None
+        self._pending_dirty = False
+
+    @property
+    def clusters(self) -> array.array:
+        return self._clusters
+
+    @property
+    def end_offset(self) -> int:
+        return self._next_offset
+
+    def _write_cluster(self, cluster_index: int, data):
+        if is_zero_buffer(data):
+            return
+        self._out.write(data)
+        self._clusters.append(cluster_index)
+        self._next_offset += self._cluster_size
+
+    def _take_pending(self, cluster_index: int):
+        if self._pending_index == cluster_index:
+            return
+        self.flush()
+        self._pending_index = cluster_index
+
+    def flush(self):
+        if self._pending_index is not None and self._pending_dirty:
+            self._write_cluster(self._pending_index, self._pending)
+            self._pending[:] = bytes(self._cluster_size)
+        self._pending_index = None
+        self._pending_dirty = False
+
+    def write(self, position: int, data):
+        # only data is passed in; zero runs need nothing writing as unallocated clusters read as zeros
+        view = memoryview(data)
+        cluster_size = self._cluster_size
+        done = 0
+        while done < len(view):
+            cluster_index, offset_in_cluster = divmod(position + done, cluster_size)
+            part_length = min(cluster_size - offset_in_cluster, len(view) - done)
+            if part_length == cluster_size:
+                self.flush()
+                self._write_cluster(cluster_index, view[done:done + part_length])
+            else:
+                self._take_pending(cluster_index)
+                self._pending[offset_in_cluster:offset_in_cluster + part_length] = view[done:done + part_length]
+                self._pending_dirty = True
+            done += part_length
+
+
+def _write_tables(out: typing.BinaryIO, clusters: array.array, cluster_size: int, virtual_size: int,
+                  metadata_offset: int) -> typing.Tuple[int, int, int, int]:
+    """
+    Writes the L2 tables, L1 table, refcount blocks and refcount table after the data clusters, returning
+    (l1_size, l1_table_offset, refcount_table_offset, refcount_table_clusters)
+    """
+    l2_entry_count = cluster_size // 8
+    l1_size = _ceil_div(_ceil_div(virtual_size, cluster_size), l2_entry_count)
+    l2_table_count = len(set(x // l2_entry_count for x in clusters))
+    l1_table_clusters = max(1, _ceil_div(l1_size * 8, cluster_size))
+
+    # the refcount blocks have to count every cluster, themselves and the refcount table included
+    refcounts_per_block = cluster_size * 8 // (1 << QCOW2_REFCOUNT_ORDER)
+    fixed_clusters = metadata_offset // cluster_size + l2_table_count + l1_table_clusters
+    refcount_block_count = refcount_table_clusters = 0
+    while True:
+        total_clusters = fixed_clusters + refcount_block_count + refcount_table_clusters
+        needed_blocks = _ceil_div(total_clusters, refcounts_per_block)
+        needed_table_clusters = _ceil_div(needed_blocks * 8, cluster_size)
+        if (needed_blocks, needed_table_clusters) == (refcount_block_count, refcount_table_clusters):
+            break
+        refcount_block_count, refcount_table_clusters = needed_blocks, needed_table_clusters
+
+    # L2 tables, each built as its data clusters are passed (they are already in virtual order)
+    l1_table = array.array("Q", bytes(l1_table_clusters * cluster_size))
+    position = metadata_offset
+    data_offset = cluster_size
+    l2_table = None
+    l2_index = None
+    for cluster_index in clusters:
+        if cluster_index // l2_entry_count != l2_index:
+            if l2_table is not None:
+                l2_table.byteswap()
+                out.write(l2_table.tobytes())
+                position += cluster_size
+            l2_index = cluster_index // l2_entry_count
+            l2_table = array.array("Q", bytes(cluster_size))
+            l1_table[l2_index] = position | QCOW2_OFLAG_COPIED
+        l2_table[cluster_index % l2_entry_count] = data_offset | QCOW2_OFLAG_COPIED
+        data_offset += cluster_size
+    if l2_table is not None:
+        l2_table.byteswap()
+        out.write(l2_table.tobytes())
+        position += cluster_size
+
+    l1_table_offset = position
+    l1_table.byteswap()
+    out.write(l1_table.tobytes())
+    position += l1_table_clusters * cluster_size
+
+    # every cluster in use has a refcount of 1, and nothing follows the refcount table
+    refcount_blocks = array.array("H", bytes(refcount_block_count * cluster_size))
+    refcount_blocks[0:total_clusters] = array.array("H", [1]) * total_clusters
+    refcount_blocks.byteswap()
+    refcount_table = array.array("Q", bytes(refcount_table_clusters * cluster_size))
+    for i in range(refcount_block_count):
+        refcount_table[i] = position + i * cluster_size
+    refcount_table.byteswap()
+    out.write(refcount_blocks.tobytes())
+    refcount_table_offset = position + refcount_block_count * cluster_size
+    out.write(refcount_table.tobytes())
+
+    return l1_size, l1_table_offset, refcount_table_offset, refcount_table_clusters
+
+
+def export_to_qcow2(disk, out_path: os.PathLike, offset: int = 0, length: typing.Optional[int] = None, *,
+                    cluster_size=QCOW2_DEFAULT_CLUSTER_SIZE, overwrite=False,
+                    progress: typing.Optional[ProgressCallback] = None) -> ExportResult:
+    """
+    Converts a range of the virtual disk of a VhdxFile or VhdxChain straight to a qcow2 (version 3) image, with no
+    intermediate raw image. Only non-zero clusters are stored (sparse blocks are not read at all), so the image's size
+    follows the space used rather than the virtual size. The data clusters are written out sequentially as the disk
+    is read, followed by the L2 tables, L1 table and refcount structures which are built in memory. progress is a
+    callback as for iter_virtual_extents.
+    """
+    if cluster_size & (cluster_size - 1) or not (1 << 9) <= cluster_size <= (1 << 21):
+        raise ValueError("cluster_size must be a power of two from 512 bytes to 2MB")
+    offset, length = _resolve_range(disk, offset, length)
+    out_path = pathlib.Path(out_path)
+    with out_path.open("wb" if overwrite else "xb") as out:
+        # the header takes the first cluster and is written once everything else is in place
+        out.write(bytes(cluster_size))
+        data_writer = _Qcow2DataWriter(out, cluster_size, cluster_size)
+        extents = iter_virtual_extents(disk, offset, length, progress=progress, operation="qcow2 conversion")
+        for extent_offset, extent_length, data in extents:
+            if data is not None:
+                data_writer.write(extent_offset - offset, data)
+        data_writer.flush()
+
+        l1_size, l1_table_offset, refcount_table_offset, refcount_table_clusters = _write_tables(
+            out, data_writer.clusters, cluster_size, length, data_writer.end_offset)
+
+        header = _HEADER_STRUCT.pack(
+            QCOW2_MAGIC, QCOW2_VERSION,
+            0, 0,  # no backing file
+            cluster_size.bit_length() - 1, length,
+            0,  # not encrypted
+            l1_size, l1_table_offset, refcount_table_offset, refcount_table_clusters,
+            0, 0,  # no snapshots
+            0, 0, 0,  # no incompatible, compatible or autoclear features
+            QCOW2_REFCOUNT_ORDER, QCOW2_HEADER_LENGTH)
+        out.seek(0)
+        out.write(header)
+        out.write(bytes(8))  # end of header extensions
+
+    stored_bytes = len(data_writer.clusters) * cluster_size
+    return ExportResult(offset, length, max(0, length - stored_bytes))
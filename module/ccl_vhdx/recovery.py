@@ -0,0 +1,326 @@
+"""
+Copyright 2019, CCL (SOLUTIONS) Group Ltd.
+
+Permission is hereby granted, free of charge, to any person obtaining a copy of this software and associated
+documentation files (the "Software"), to deal in the Software without restriction, including without limitation the
+rights to use, copy, modify, merge, publish, distribute, sublicense, and/or sell copies of the Software, and to permit
+persons to whom the Software is furnished to do so, subject to the following conditions:
+
+The above copyright notice and this permission notice shall be included in all copies or substantial portions of the
+Software.
+
+THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR IMPLIED, INCLUDING BUT NOT LIMITED TO THE
+WARRANTIES OF MERCHANTABILITY, FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE AUTHORS OR
+COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR
+OTHERWISE, ARISING FROM, OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE SOFTWARE.
+"""
+
+import array
+import os
+import sys
+import typing
+
+from . import ccl_vhdx as _vhdx
+from .ccl_vhdx import VhdxFile, VhdxError, SENSIBLE_FALLBACK_METAS, METADATA_TABLE_MAGIC, open_byte_source
+from .geometry import infer_geometry, get_bat_states, sector_bitmap_fit
+from .progress import ProgressCallback, ProgressTracker
+
+__all__ = ["BatCandidate", "locate_bat_candidates", "locate_metadata_tables", "open_with_recovered_bat"]
+
+DEFAULT_SCAN_CHUNK_SIZE = 1 << 26
+DEFAULT_MAX_ZERO_GAP = 64  # pages of zeros allowed inside a single BAT candidate
+
+_PAGE_SIZE = 1 << 20  # regions are 1MB aligned, so the BAT starts on a page boundary
+_HEADER_SECTION_LENGTH = 1 << 20
+
+_PAGE_OTHER = 0
+_PAGE_ZERO = 1
+_PAGE_ENTRIES = 2
+
+_VALID_STATES = (0, 1, 2, 3, 6, 7)
+# Each 64 bit BAT entry is: state (bits 0-2), reserved (bits 3-19, zero), file offset in MB (bits 20-63). Taking every
+# 8th byte of a page gives one "lane" of bytes per byte of the entries, and each lane can then be checked in one go:
+# translating with the allowed values deleted leaves nothing if every entry in the page is well-formed.
+_ALLOWED_LANE_0 = bytes(b for b in range(256) if (b & 0x07) in _VALID_STATES and not b & 0xf8)
+_ALLOWED_LANE_2 = bytes(b for b in range(256) if not b & 0x0f)
+
+_CANDIDATE_CHUNK_RATIOS = sorted({((1 << 23) * sector_size) // (1 << block_size_power)
+                                  for sector_size in (512, 4096) for block_size_power in range(20, 29)})
+
+
+class BatCandidate:
+    def __init__(self, offset: int, length: int, entry_count: int, nonzero_entry_count: int,
+                 in_file_fraction: float, unique_fraction: float, chunk_ratio: typing.Optional[int],
+                 chunk_ratio_consistency: typing.Optional[float]):
+        self._offset = offset
+        self._length = length
+        self._entry_count = entry_count
+        self._nonzero_entry_count = nonzero_entry_count
+        self._in_file_fraction = in_file_fraction
+        self._unique_fraction = unique_fraction
+        self._chunk_ratio = chunk_ratio
+        self._chunk_ratio_consistency = chunk_ratio_consistency
+
+    def __repr__(self):
+        return (f"<BatCandidate offset: {self._offset}; length: {self._length}; score: {self.score:.3f}; "
+                f"nonzero_entries: {self._nonzero_entry_count}; chunk_ratio: {self._chunk_ratio}>")
+
+    @property
+    def offset(self) -> int:
+        return self._offset
+
+    @property
+    def length(self) -> int:
+        """Length up to the end of the last page containing non-zero entries"""
+        return self._length
+
+    @property
+    def entry_count(self) -> int:
+        return self._entry_count
+
+    @property
+    def nonzero_entry_count(self) -> int:
+        return self._nonzero_entry_count
+
+    @property
+    def in_file_fraction(self) -> float:
+        """Fraction of the entries with an offset which point inside the file (and outside the header and BAT)"""
+        return self._in_file_fraction
+
+    @property
+    def unique_fraction(self) -> float:
+        """Fraction of the entries with an offset which don't share that offset with another entry"""
+        return self._unique_fraction
+
+    @property
+    def chunk_ratio(self) -> typing.Optional[int]:
+        """The chunk ratio whose sector bitmap entries best fit the candidate, or None if it cannot be told"""
+        return self._chunk_ratio
+
+    @property
+    def chunk_ratio_consistency(self) -> typing.Optional[float]:
+        return self._chunk_ratio_consistency
+
+    @property
+    def score(self) -> float:
+        """0.0 to 1.0; how much the candidate looks like a live BAT"""
+        chunk_ratio_score = 0.5 if self._chunk_ratio_consistency is None else self._chunk_ratio_consistency
+        return 0.4 * self._in_file_fraction + 0.3 * self._unique_fraction + 0.3 * chunk_ratio_score
+
+
+def _classify_page(chunk: bytes, start: int) -> int:
+    end = start + _PAGE_SIZE
+    if end > len(chunk):
+        return _PAGE_OTHER
+    entry_count = _PAGE_SIZE // 8
+    # the reserved byte is the cheapest test and rejects almost all data straight away
+    if chunk[start + 1:end:8].count(0) != entry_count:
+        return _PAGE_OTHER
+    if chunk[start:end:8].translate(None, _ALLOWED_LANE_0):
+        return _PAGE_OTHER
+    if chunk[start + 2:end:8].translate(None, _ALLOWED_LANE_2):
+        return _PAGE_OTHER
+    if chunk.count(0, start, end) == _PAGE_SIZE:
+        return _PAGE_ZERO
+    return _PAGE_ENTRIES
+
+
+def _iter_page_runs(f: typing.BinaryIO, file_size: int, chunk_size: int, max_zero_gap: int,
+                    metadata_pages: typing.Optional[list] = None, tracker: typing.Optional[ProgressTracker] = None):
+    # yields (first_page, page_count) for runs of well-formed pages containing at least one non-zero page, with
+    # leading and trailing zero pages trimmed, split wherever there are more than max_zero_gap zero pages in a row.
+    # The metadata region is also 1MB aligned, so pages starting with its signature are noted in metadata_pages.
+    chunk_size = max(_PAGE_SIZE, chunk_size - (chunk_size % _PAGE_SIZE))
+    run_start = None
+    last_entries_page = None
+    page_index = _HEADER_SECTION_LENGTH // _PAGE_SIZE
+    f.seek(_HEADER_SECTION_LENGTH)
+    while page_index * _PAGE_SIZE < file_size:
+        chunk = f.read(chunk_size)
+        if not chunk:
+            break
+        if tracker is not None:
+            tracker.advance(processed=len(chunk))
+        for start in range(0, len(chunk), _PAGE_SIZE):
+            page_class = _classify_page(chunk, start)
+            if metadata_pages is not None and chunk.startswith(METADATA_TABLE_MAGIC, start):
+                metadata_pages.append(page_index)
+            if page_class == _PAGE_ENTRIES:
+                if run_start is None:
+                    run_start = page_index
+                last_entries_page = page_index
+            elif run_start is not None and (page_class == _PAGE_OTHER or
+                                            page_index - last_entries_page > max_zero_gap):
+                yield run_start, last_entries_page - run_start + 1
+                run_start = None
+            page_index += 1
+
+    if run_start is not None:
+        yield run_start, last_entries_page - run_start + 1
+
+
+def _assess_chunk_ratio(entries: array.array, states: bytes) -> \
+        typing.Tuple[typing.Optional[int], typing.Optional[float]]:
+    # The sector bitmap entries are checked as for a differencing disk, which allows both the zero entries of a disk
+    # without a parent and PRESENT ones; a chunk ratio is judged on how many chunks' sector bitmap entries are exactly
+    # what their payload entries call for (see sector_bitmap_fit).
+    results = []
+    for chunk_ratio in _CANDIDATE_CHUNK_RATIOS:
+        if len(entries) < chunk_ratio + 1:
+            continue
+        fit = sector_bitmap_fit(entries, states, chunk_ratio, True)
+        if fit is not None and fit.informative:
+            results.append((fit.exact / fit.informative, fit.informative, chunk_ratio))
+
+    if not results:
+        return None, None
+    results.sort(reverse=True)
+    best_consistency, _, best_chunk_ratio = results[0]
+    if len(results) > 1 and results[1][0] == best_consistency:
+        # more than one chunk ratio fits as well as the best, so it can't be told which is right
+        return None, best_consistency
+    return best_chunk_ratio, best_consistency
+
+
+def _assess_candidate(raw: bytes, offset: int, file_size: int) -> BatCandidate:
+    entries = array.array("Q")
+    entries.frombytes(raw[:len(raw) - (len(raw) % 8)])
+    if sys.byteorder != "little":
+        entries.byteswap()
+
+    mb = 1 << 20
+    offsets = [((x >> 20) & 0xfffffffffff) * mb for x in entries if x >> 20]
+    nonzero_entry_count = len(entries) - entries.count(0)
+    bat_end = offset + len(raw)
+    if offsets:
+        in_file = sum(1 for x in offsets if _HEADER_SECTION_LENGTH <= x < file_size and not offset <= x < bat_end)
+        in_file_fraction = in_file / len(offsets)
+        unique_fraction = len(set(offsets)) / len(offsets)
+    else:
+        in_file_fraction = unique_fraction = 0.0
+    states = get_bat_states(entries)
+    chunk_ratio, chunk_ratio_consistency = _assess_chunk_ratio(entries, states)
+
+    return BatCandidate(offset, len(raw), len(entries), nonzero_entry_count, in_file_fraction, unique_fraction,
+                        chunk_ratio, chunk_ratio_consistency)
+
+
+def locate_bat_candidates(in_path: os.PathLike, *, chunk_size=DEFAULT_SCAN_CHUNK_SIZE,
+                          max_zero_gap=DEFAULT_MAX_ZERO_GAP, min_score=0.0,
+                          progress: typing.Optional[ProgressCallback] = None,
+                          metadata_pages: typing.Optional[list] = None) -> typing.List[BatCandidate]:
+    """
+    Scans a VHDX file for areas which look like a BAT, for use when the region tables are damaged. The file is read in
+    chunk_size pieces and each 1MB page after the header section is checked for being made up entirely of well-formed
+    BAT entries (valid states, zero reserved bits). Runs of such pages are then scored on whether their offsets point
+    inside the file and don't overlap, and on how well the sector bitmap entries fit a chunk ratio. Returns the
+    candidates scoring at least min_score, best first. progress is a callback as for ProgressTracker, counting the
+    bytes of the file scanned. If metadata_pages is a list, the offsets of pages starting with the metadata table
+    signature are appended to it, as locate_metadata_tables would return them, in the same scan.
+    """
+    source = open_byte_source(in_path)
+    file_size = source.size
+    tracker = ProgressTracker(progress, "BAT scan", max(0, file_size - _HEADER_SECTION_LENGTH))
+    candidates = []
+    with source.open() as f:
+        page_indices = [] if metadata_pages is not None else None
+        runs = list(_iter_page_runs(f, file_size, chunk_size, max_zero_gap, page_indices, tracker))
+        if metadata_pages is not None:
+            metadata_pages.extend(x * _PAGE_SIZE for x in page_indices)
+        _vhdx._l(f"{len(runs)} possible BAT regions found in {in_path}", to_stdout=_vhdx.DEBUG_TO_STDOUT)
+        for first_page, page_count in runs:
+            f.seek(first_page * _PAGE_SIZE)
+            raw = f.read(page_count * _PAGE_SIZE)
+            candidate = _assess_candidate(raw, first_page * _PAGE_SIZE, file_size)
+            if candidate.score >= min_score:
+                candidates.append(candidate)
+
+    candidates.sort(key=lambda x: (-x.score, x.offset))
+    tracker.finish()
+    return candidates
+
+
+def locate_metadata_tables(in_path: os.PathLike, *, chunk_size=DEFAULT_SCAN_CHUNK_SIZE,
+                           progress: typing.Optional[ProgressCallback] = None) -> typing.List[int]:
+    """Returns the offsets of the 1MB aligned pages of a VHDX file which start with the metadata table signature"""
+    source = open_byte_source(in_path)
+    tracker = ProgressTracker(progress, "metadata scan", max(0, source.size - _HEADER_SECTION_LENGTH))
+    metadata_pages = []
+    with source.open() as f:
+        for _ in _iter_page_runs(f, source.size, chunk_size, 0, metadata_pages, tracker):
+            pass
+    tracker.finish()
+    return [x * _PAGE_SIZE for x in metadata_pages]
+
+
+def open_with_recovered_bat(in_path: os.PathLike, candidate: typing.Optional[BatCandidate] = None, *,
+                            fallback_metas=None) -> VhdxFile:
+    """
+    Opens a VHDX file with ignore_faults, using the best BAT candidate found by locate_bat_candidates (or the one
+    given) in place of the BAT in the region table. If the region table is unreadable or its metadata table is damaged,
+    a metadata table is looked for as well (found in the same scan as the BAT when no candidate is given), and
+    fallback_metas only used if none can be parsed. If fallback_metas is None, the geometry is
+    inferred from the recovered BAT (see geometry.infer_geometry).
+    """
+    metadata_offsets = None
+    if candidate is None:
+        # the scan for the BAT notes the metadata tables too, so the file need not be scanned again for them
+        metadata_offsets = []
+        candidates = locate_bat_candidates(in_path, metadata_pages=metadata_offsets)
+        if not candidates:
+            raise VhdxError(f"No plausible BAT found in {in_path}")
+        candidate = candidates[0]
+    _vhdx._l(f"Using recovered BAT candidate {candidate}", to_stdout=_vhdx.DEBUG_TO_STDOUT)
+
+    if fallback_metas is None:
+        source = open_byte_source(in_path)
+        raw = source.read_at(candidate.offset, candidate.length)
+        entries = array.array("Q")
+        entries.frombytes(raw[:len(raw) - (len(raw) % 8)])
+        if sys.byteorder != "little":
+            entries.byteswap()
+        geometry = infer_geometry(entries, source.size)
+        _vhdx._l(f"Inferred geometry from the recovered BAT: {geometry}", to_stdout=_vhdx.DEBUG_TO_STDOUT)
+        if geometry.best is not None:
+            # the recovered BAT runs to the end of its last non-zero page, which for large block sizes would make a
+            # far bigger disk than the original, so the disk is taken to end with its last block with a BAT entry
+            fallback_metas = geometry.best.to_metas(
+                virtual_disk_size=geometry.best.get_minimum_virtual_disk_size(entries))
+        else:
+            fallback_metas = SENSIBLE_FALLBACK_METAS
+
+    # a damaged metadata table (an unknown item id, or an entry count or item offset running off the region) means
+    # the fallback metas are used, see VhdxFile
+    try:
+        vhdx = VhdxFile(in_path, ignore_faults=True, fallback_metas=fallback_metas,
+                        bat_region=(candidate.offset, candidate.length))
+    except (VhdxError, ValueError, KeyError) as ex:
+        _vhdx._l(f"WARNING: Could not open with the recovered BAT: {ex}", to_stdout=_vhdx.DEBUG_TO_STDOUT)
+        vhdx = None
+    if vhdx is None or vhdx.used_fallback_metas:
+        if metadata_offsets is None:
+            metadata_offsets = locate_metadata_tables(in_path)
+        for metadata_offset in metadata_offsets:
+            try:
+                located = VhdxFile(in_path, ignore_faults=True, fallback_metas=fallback_metas,
+                                   bat_region=(candidate.offset, candidate.length),
+                                   metadata_region=(metadata_offset, _PAGE_SIZE))
+            except (VhdxError, ValueError, KeyError) as ex:
+                _vhdx._l(f"WARNING: Could not open with the metadata table at offset {metadata_offset}: {ex}",
+                         to_stdout=_vhdx.DEBUG_TO_STDOUT)
+                continue
+            if not located.used_fallback_metas:
+                _vhdx._l(f"Using metadata table found at offset {metadata_offset}", to_stdout=_vhdx.DEBUG_TO_STDOUT)
+                vhdx = located
+                break
+            if vhdx is None:
+                vhdx = located
+        if vhdx is None:
+            raise VhdxError(f"No usable metadata found in {in_path}")
+        if vhdx.used_fallback_metas:
+            _vhdx._l("No usable metadata table found, using the fallback metadata", to_stdout=_vhdx.DEBUG_TO_STDOUT)
+
+    if candidate.chunk_ratio is not None and candidate.chunk_ratio != vhdx.chunk_ratio:
+        _vhdx._l(f"WARNING: chunk ratio of the metadata ({vhdx.chunk_ratio}) does not match the chunk ratio which best "
+                 f"fits the recovered BAT ({candidate.chunk_ratio})", to_stdout=_vhdx.DEBUG_TO_STDOUT)
+    return vhdx
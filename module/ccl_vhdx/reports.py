@@ -0,0 +1,124 @@
+"""
+Copyright 2019, CCL (SOLUTIONS) Group Ltd.
+
+Permission is hereby granted, free of charge, to any person obtaining a copy of this software and associated
+documentation files (the "Software"), to deal in the Software without restriction, including without limitation the
+rights to use, copy, modify, merge, publish, distribute, sublicense, and/or sell copies of the Software, and to permit
+persons to whom the Software is furnished to do so, subject to the following conditions:
+
+The above copyright notice and this permission notice shall be included in all copies or substantial portions of the
+Software.
+
+THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR IMPLIED, INCLUDING BUT NOT LIMITED TO THE
+WARRANTIES OF MERCHANTABILITY, FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE AUTHORS OR
+COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR
+OTHERWISE, ARISING FROM, OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE SOFTWARE.
+"""
+
+import collections
+import os
+import typing
+import uuid
+
+from .ccl_vhdx import (VhdxFile, BatPayloadBlockState, SENSIBLE_FALLBACK_METAS, REGION_GUID_BAT,
+                       REGION_GUID_METADATA, guid_to_blob)
+
+__all__ = ["REPORT_KINDS", "header_report", "metadata_report", "region_report", "bat_report", "build_report"]
+
+REPORT_KINDS = ("header", "metadata", "region", "bat")
+
+_KNOWN_REGIONS = {guid_to_blob(REGION_GUID_BAT): "BAT", guid_to_blob(REGION_GUID_METADATA): "Metadata"}
+_GUID_METAS = ("Page83Data",)
+
+
+def _guid_string(guid_blob: bytes) -> str:
+    return str(uuid.UUID(bytes_le=guid_blob))
+
+
+def _json_value(value):
+    if isinstance(value, bytes):
+        return value.hex()
+    elif isinstance(value, dict):
+        return {key: _json_value(x) for key, x in value.items()}
+    return value
+
+
+def header_report(vhdx: VhdxFile) -> dict:
+    header = vhdx.header
+    return {
+        "SequenceNumber": header.sequence_number,
+        "FileWriteGuid": _guid_string(header.file_write_guid),
+        "DataWriteGuid": _guid_string(header.data_write_guid),
+        "LogGuid": _guid_string(header.log_guid),
+        "LogToReplay": header.log_guid != b"\x00" * 16,
+        "LogVersion": header.log_version,
+        "Version": header.version,
+        "LogLength": header.log_length,
+        "LogOffset": header.log_offset
+    }
+
+
+def metadata_report(vhdx: VhdxFile) -> dict:
+    metas = vhdx.metas
+    report = {key: _guid_string(metas[key]) if key in _GUID_METAS else _json_value(metas[key]) for key in metas}
+    report["UsedFallbackMetas"] = vhdx.used_fallback_metas
+    return report
+
+
+def region_report(vhdx: VhdxFile) -> list:
+    return [{
+        "Guid": _guid_string(guid),
+        "Name": _KNOWN_REGIONS.get(guid),
+        "Offset": vhdx.region_table[guid].offset,
+        "Length": vhdx.region_table[guid].length,
+        "Required": vhdx.region_table[guid].required
+    } for guid in vhdx.region_table]
+
+
+def bat_report(vhdx: VhdxFile, *, include_map=False) -> dict:
+    bat_region = vhdx.region_table[guid_to_blob(REGION_GUID_BAT)]
+    state_counts = collections.Counter()
+    allocation = []
+    for entry in vhdx.iter_bat_payload_entries():
+        state_counts[entry.state] += 1
+        if include_map:
+            allocation.append("1" if entry.state in (BatPayloadBlockState.BAT_PAYLOAD_BLOCK_FULLY_PRESENT,
+                                                     BatPayloadBlockState.BAT_PAYLOAD_BLOCK_PARTIALLY_PRESENT)
+                              else "0")
+    report = {
+        "Offset": bat_region.offset,
+        "Length": bat_region.length,
+        "MaxEntryCount": bat_region.length // 8,
+        "AllocatedPayloadBlockCount": state_counts[BatPayloadBlockState.BAT_PAYLOAD_BLOCK_FULLY_PRESENT] +
+                                      state_counts[BatPayloadBlockState.BAT_PAYLOAD_BLOCK_PARTIALLY_PRESENT],
+        "PayloadStateCounts": {state.name: state_counts[state] for state in BatPayloadBlockState}
+    }
+    if include_map:
+        report["AllocationMap"] = "".join(allocation)
+    return report
+
+
+def build_report(in_path: os.PathLike, kinds: typing.Iterable[str] = REPORT_KINDS, *, ignore_faults=True,
+                 fallback_metas=SENSIBLE_FALLBACK_METAS, include_map=False) -> dict:
+    """
+    Opens a VHDX file and returns a JSON-serialisable dict of the requested reports (see REPORT_KINDS) keyed by kind.
+    Errors don't propagate: an "error" key is set instead, alongside any reports which did succeed.
+    """
+    report = {"path": str(in_path)}
+    try:
+        vhdx = VhdxFile(in_path, ignore_faults=ignore_faults,
+                        fallback_metas=fallback_metas if ignore_faults else None)
+        for kind in kinds:
+            if kind == "header":
+                report[kind] = header_report(vhdx)
+            elif kind == "metadata":
+                report[kind] = metadata_report(vhdx)
+            elif kind == "region":
+                report[kind] = region_report(vhdx)
+            elif kind == "bat":
+                report[kind] = bat_report(vhdx, include_map=include_map)
+            else:
+                raise ValueError(f"Unknown report kind {kind}")
+    except Exception as e:
+        report["error"] = f"{type(e).__name__}: {e}"
+    return report
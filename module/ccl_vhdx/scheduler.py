@@ -0,0 +1,262 @@
+"""
+Copyright 2019, CCL (SOLUTIONS) Group Ltd.
+
+Permission is hereby granted, free of charge, to any person obtaining a copy of this software and associated
+documentation files (the "Software"), to deal in the Software without restriction, including without limitation the
+rights to use, copy, modify, merge, publish, distribute, sublicense, and/or sell copies of the Software, and to permit
+persons to whom the Software is furnished to do so, subject to the following conditions:
+
+The above copyright notice and this permission notice shall be included in all copies or substantial portions of the
+Software.
+
+THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR IMPLIED, INCLUDING BUT NOT LIMITED TO THE
+WARRANTIES OF MERCHANTABILITY, FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE AUTHORS OR
+COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR
+OTHERWISE, ARISING FROM, OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE SOFTWARE.
+"""
+
+import concurrent.futures
+import os
+import pathlib
+import time
+import typing
+import urllib.parse
+
+from .ccl_vhdx import VhdxChain, SENSIBLE_FALLBACK_METAS
+from .export import export_to_path, get_journal_path
+from .progress import ProgressCallback, ProgressTracker, count_allocated_bytes
+from .qcow2 import export_to_qcow2
+
+__all__ = ["EXPORT_FORMATS", "DEFAULT_JOBS_PER_DEVICE", "ExportJob", "ExportJobResult", "DeviceThroughput",
+           "BatchExportResult", "get_device_key", "run_export_batch"]
+
+EXPORT_FORMAT_RAW = "raw"
+EXPORT_FORMAT_QCOW2 = "qcow2"
+EXPORT_FORMATS = (EXPORT_FORMAT_RAW, EXPORT_FORMAT_QCOW2)
+
+DEFAULT_JOBS_PER_DEVICE = 1  # more than one stream per spindle mostly just adds seeking
+
+DeviceKey = typing.Hashable
+
+
+class ExportJob(typing.NamedTuple):
+    paths: typing.Tuple[str, ...]  # the VHDX file, or the files of a chain ordered parent first
+    out_path: str
+    export_format: str = EXPORT_FORMAT_RAW
+
+
+class ExportJobResult(typing.NamedTuple):
+    job: ExportJob
+    virtual_size: int
+    allocated_bytes: int  # what the export reads, from the BAT (and sector bitmaps)
+    data_bytes: int  # non-zero bytes written
+    elapsed: float  # seconds, 0.0 for a job which failed before it started
+    error: typing.Optional[str] = None
+
+    @property
+    def succeeded(self) -> bool:
+        return self.error is None
+
+
+class DeviceThroughput(typing.NamedTuple):
+    device: DeviceKey
+    job_count: int
+    bytes_read: int  # allocated bytes of the jobs reading from the device
+    bytes_written: int  # data bytes of the jobs writing to the device
+    busy_seconds: float  # time during which at least one job was using the device
+
+    @property
+    def bytes_per_second(self) -> float:
+        return (self.bytes_read + self.bytes_written) / self.busy_seconds if self.busy_seconds > 0 else 0.0
+
+
+class BatchExportResult:
+    def __init__(self, job_results: typing.List[ExportJobResult], devices: typing.List[DeviceThroughput],
+                 elapsed: float):
+        self._job_results = job_results
+        self._devices = devices
+        self._elapsed = elapsed
+
+    def __repr__(self):
+        return (f"<BatchExportResult jobs: {len(self._job_results)}; failed: {len(self.failed_jobs)}; "
+                f"elapsed: {self._elapsed:.1f}s>")
+
+    @property
+    def job_results(self) -> typing.List[ExportJobResult]:
+        """A result for each job, in the order the jobs were given"""
+        return self._job_results
+
+    @property
+    def failed_jobs(self) -> typing.List[ExportJobResult]:
+        return [x for x in self._job_results if not x.succeeded]
+
+    @property
+    def devices(self) -> typing.List[DeviceThroughput]:
+        return self._devices
+
+    @property
+    def elapsed(self) -> float:
+        return self._elapsed
+
+    @property
+    def bytes_read(self) -> int:
+        return sum(x.allocated_bytes for x in self._job_results if x.succeeded)
+
+    @property
+    def bytes_per_second(self) -> float:
+        """Aggregate read throughput of the whole batch"""
+        return self.bytes_read / self._elapsed if self._elapsed > 0 else 0.0
+
+
+def get_device_key(location: typing.Union[str, os.PathLike]) -> DeviceKey:
+    """
+    The device a location is stored on: the st_dev of the file, or of the nearest existing directory above it for
+    outputs which don't exist yet (and archive members or segments, whose paths are not themselves files). Remote
+    sources are keyed by their host.
+    """
+    location = os.fspath(location)
+    if isinstance(location, str) and "://" in location:
+        url = urllib.parse.urlsplit(location)
+        return f"{url.scheme}://{url.netloc}"
+    path = pathlib.Path(location).absolute()
+    for candidate in (path,) + tuple(path.parents):
+        try:
+            return os.stat(candidate).st_dev
+        except OSError:
+            continue
+    raise ValueError(f"Could not find the device for {location}")
+
+
+def _open_job(job: ExportJob, ignore_faults: bool, direct_io: bool) -> VhdxChain:
+    return VhdxChain.from_paths(job.paths, ignore_faults=ignore_faults,
+                                fallback_metas=SENSIBLE_FALLBACK_METAS if ignore_faults else None,
+                                direct_io=direct_io)
+
+
+def _run_job(job: ExportJob, ignore_faults: bool, direct_io: bool, overwrite: bool, journal: bool) -> int:
+    # runs in a worker process, returning the data bytes written
+    disk = _open_job(job, ignore_faults, direct_io)
+    if job.export_format == EXPORT_FORMAT_QCOW2:
+        result = export_to_qcow2(disk, job.out_path, overwrite=overwrite)
+    else:
+        resume = journal and get_journal_path(job.out_path).exists()
+        result = export_to_path(disk, job.out_path, overwrite=overwrite, journal=journal, resume=resume)
+    return result.length - result.zero_bytes
+
+
+class _PlannedJob(typing.NamedTuple):
+    index: int
+    job: ExportJob
+    devices: typing.FrozenSet[DeviceKey]
+    source_devices: typing.FrozenSet[DeviceKey]
+    target_device: DeviceKey
+    virtual_size: int
+    allocated_bytes: int
+
+
+def _plan_job(index: int, job: ExportJob, ignore_faults: bool) -> _PlannedJob:
+    if job.export_format not in EXPORT_FORMATS:
+        raise ValueError(f"Unknown export format {job.export_format}")
+    if not job.paths:
+        raise ValueError("A job needs at least one VHDX file")
+    disk = _open_job(job, ignore_faults, False)
+    source_devices = frozenset(get_device_key(x) for x in job.paths)
+    target_device = get_device_key(job.out_path)
+    return _PlannedJob(index, job, source_devices | {target_device}, source_devices, target_device,
+                       disk.virtual_disk_size, count_allocated_bytes(disk))
+
+
+def _busy_seconds(intervals: typing.List[typing.Tuple[float, float]]) -> float:
+    busy = 0.0
+    covered_to = None
+    for start, end in sorted(intervals):
+        if covered_to is not None and start < covered_to:
+            start = covered_to
+        if end > start:
+            busy += end - start
+            covered_to = end
+    return busy
+
+
+def run_export_batch(jobs: typing.Iterable[ExportJob], *, jobs_per_device=DEFAULT_JOBS_PER_DEVICE,
+                     device_limits: typing.Optional[typing.Dict[DeviceKey, int]] = None,
+                     workers: typing.Optional[int] = None, ignore_faults=False, direct_io=False, overwrite=False,
+                     journal=False, progress: typing.Optional[ProgressCallback] = None) -> BatchExportResult:
+    """
+    Exports many VHDX files and chains at once, keeping every storage device busy without overloading any of them.
+    Each job is tied to the devices (st_dev, see get_device_key) of its source files and its output, and only starts
+    when each of those devices is running fewer than jobs_per_device jobs (device_limits overrides this for
+    particular devices, e.g. for SSDs which cope with more). Jobs are started largest allocated size first, passing
+    over any whose devices are busy, so the long exports are not left until last. The exports themselves are those of
+    export_to_path and export_to_qcow2, run in a pool of worker processes (by default as many as could run at once,
+    up to one per CPU); with journal True, raw exports are journalled and resumed where a journal is left over.
+
+    Errors don't propagate: a failed job's result has its error set. progress is a callback as for ProgressTracker,
+    told of each job as it finishes.
+    """
+    if jobs_per_device < 1:
+        raise ValueError("jobs_per_device must be at least 1")
+    device_limits = device_limits or {}
+    jobs = list(jobs)
+    results: typing.List[typing.Optional[ExportJobResult]] = [None] * len(jobs)
+    planned = []
+    for index, job in enumerate(jobs):
+        try:
+            planned.append(_plan_job(index, job, ignore_faults))
+        except Exception as e:
+            results[index] = ExportJobResult(job, 0, 0, 0, 0.0, f"{type(e).__name__}: {e}")
+    planned.sort(key=lambda x: x.allocated_bytes, reverse=True)
+
+    limits = {}
+    for plan in planned:
+        for device in plan.devices:
+            limits[device] = max(1, device_limits.get(device, jobs_per_device))
+    if workers is None:
+        workers = max(1, min(os.cpu_count() or 1, sum(limits.values())))
+
+    tracker = ProgressTracker(progress, "batch export", sum(x.virtual_size for x in planned),
+                              sum(x.allocated_bytes for x in planned))
+    running = dict.fromkeys(limits, 0)
+    device_intervals = {device: [] for device in limits}
+    start_time = time.monotonic()
+    with concurrent.futures.ProcessPoolExecutor(workers) as executor:
+        in_flight = {}
+        pending = planned
+        while pending or in_flight:
+            waiting = []
+            for plan in pending:
+                if len(in_flight) < workers and all(running[x] < limits[x] for x in plan.devices):
+                    for device in plan.devices:
+                        running[device] += 1
+                    future = executor.submit(_run_job, plan.job, ignore_faults, direct_io, overwrite, journal)
+                    in_flight[future] = (plan, time.monotonic())
+                else:
+                    waiting.append(plan)
+            pending = waiting
+
+            done, _ = concurrent.futures.wait(in_flight, return_when=concurrent.futures.FIRST_COMPLETED)
+            finished_time = time.monotonic()
+            for future in done:
+                plan, started_time = in_flight.pop(future)
+                for device in plan.devices:
+                    running[device] -= 1
+                    device_intervals[device].append((started_time, finished_time))
+                try:
+                    data_bytes, error = future.result(), None
+                except Exception as e:
+                    data_bytes, error = 0, f"{type(e).__name__}: {e}"
+                results[plan.index] = ExportJobResult(plan.job, plan.virtual_size, plan.allocated_bytes, data_bytes,
+                                                      finished_time - started_time, error)
+                tracker.advance(processed=plan.allocated_bytes, skipped=plan.virtual_size - plan.allocated_bytes)
+    tracker.finish()
+
+    devices = []
+    for device in limits:
+        device_plans = [x for x in planned if device in x.devices and results[x.index].succeeded]
+        devices.append(DeviceThroughput(
+            device, len([x for x in planned if device in x.devices]),
+            sum(x.allocated_bytes for x in device_plans if device in x.source_devices),
+            sum(results[x.index].data_bytes for x in device_plans if x.target_device == device),
+            _busy_seconds(device_intervals[device])))
+
+    return BatchExportResult(results, devices, time.monotonic() - start_time)
@@ -0,0 +1,224 @@
+"""
+Copyright 2019, CCL (SOLUTIONS) Group Ltd.
+
+Permission is hereby granted, free of charge, to any person obtaining a copy of this software and associated
+documentation files (the "Software"), to deal in the Software without restriction, including without limitation the
+rights to use, copy, modify, merge, publish, distribute, sublicense, and/or sell copies of the Software, and to permit
+persons to whom the Software is furnished to do so, subject to the following conditions:
+
+The above copyright notice and this permission notice shall be included in all copies or substantial portions of the
+Software.
+
+THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR IMPLIED, INCLUDING BUT NOT LIMITED TO THE
+WARRANTIES OF MERCHANTABILITY, FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE AUTHORS OR
+COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR
+OTHERWISE, ARISING FROM, OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE SOFTWARE.
+"""
+
+import heapq
+import os
+import pathlib
+import re
+import typing
+
+from .ccl_vhdx import VhdxFile, VhdxChain
+from .occupancy import build_occupancy_map, EXTENT_STALE
+from .parallel import iter_worker_results
+from .progress import ProgressCallback, ProgressTracker
+
+__all__ = ["SEARCH_SCOPES", "SearchHit", "search_disk"]
+
+SEARCH_SCOPE_DISK = "disk"
+SEARCH_SCOPE_ALLOCATED = "allocated"
+SEARCH_SCOPE_SLACK = "slack"
+SEARCH_SCOPES = (SEARCH_SCOPE_DISK, SEARCH_SCOPE_ALLOCATED, SEARCH_SCOPE_SLACK)
+
+DEFAULT_SEARCH_CHUNK_SIZE = 1 << 24
+DEFAULT_MAX_MATCH_LENGTH = 4096  # how far a regex match can run into the next chunk
+
+Pattern = typing.Union[bytes, typing.Pattern[bytes]]
+
+
+class SearchHit(typing.NamedTuple):
+    pattern_index: int
+    match: bytes
+    virtual_offset: typing.Optional[int]  # None for slack which no BAT entry maps onto the virtual disk
+    file_path: typing.Optional[pathlib.Path]  # the VHDX file holding the match, None if it is not stored anywhere
+    physical_offset: typing.Optional[int]
+    kind: str  # SEARCH_SCOPE_DISK for data on the virtual disk, otherwise the kind of slack extent (see occupancy)
+
+
+class _Searcher:
+    """Searches pieces of a disk (see parallel.iter_worker_results)"""
+    def __init__(self, disk: typing.Union[VhdxFile, VhdxChain], patterns: typing.Sequence[Pattern],
+                 max_match_length: int):
+        self._disk = disk
+        self._patterns = list(patterns)
+        self._overlap = max(
+            [len(x) for x in self._patterns if isinstance(x, bytes)] +
+            [max_match_length for x in self._patterns if not isinstance(x, bytes)]) - 1
+        self._lookback = max_match_length - 1 if any(not isinstance(x, bytes) for x in self._patterns) else 0
+
+    @property
+    def overlap(self) -> int:
+        return self._overlap
+
+    @property
+    def lookback(self) -> int:
+        return self._lookback
+
+    @staticmethod
+    def _find_pattern(pattern_index: int, pattern: Pattern, data: bytes, first: int, limit: int):
+        # matches starting from first and before limit. A byte string is found at every position it occurs, so its
+        # matches can overlap; a regex is matched as finditer does, each search carrying on from the end of the last
+        # match. The regex scan starts from the beginning of data (the lookback before first) so that it is in step
+        # with the scan of the previous piece by the time it reaches first
+        if isinstance(pattern, bytes):
+            position = data.find(pattern, first, limit + len(pattern) - 1)
+            while position != -1:
+                yield pattern_index, position, pattern
+                position = data.find(pattern, position + 1, limit + len(pattern) - 1)
+        else:
+            for match in pattern.finditer(data):
+                if match.start() >= limit:
+                    break
+                if match.start() >= first:
+                    yield pattern_index, match.start(), bytes(match.group())
+
+    def _find(self, data: bytes, first: int, limit: int):
+        # yields (pattern_index, offset in data, match) for matches starting from first and before limit, in order of
+        # offset (and of pattern index at the same offset)
+        yield from heapq.merge(
+            *(self._find_pattern(pattern_index, pattern, data, first, limit)
+              for pattern_index, pattern in enumerate(self._patterns)),
+            key=lambda x: (x[1], x[0]))
+
+    def search_virtual(self, read_start: int, start: int, end: int, read_end: int) -> typing.List[SearchHit]:
+        data = self._disk.read(read_start, read_end - read_start)
+        hits = []
+        for pattern_index, position, match in self._find(data, start - read_start, end - read_start):
+            virtual_offset = read_start + position
+            layer, physical_offset = self._disk.locate(virtual_offset)
+            hits.append(SearchHit(pattern_index, match, virtual_offset,
+                                  layer.file_path if physical_offset is not None else None, physical_offset,
+                                  SEARCH_SCOPE_DISK))
+        return hits
+
+    def search_physical(self, layer_index: int, read_start: int, start: int, end: int, read_end: int, kind: str,
+                        first_virtual_offset: typing.Optional[int]) -> typing.List[SearchHit]:
+        # first_virtual_offset is the virtual offset of start
+        layer = self._disk.layers[layer_index] if isinstance(self._disk, VhdxChain) else self._disk
+        data = layer.source.read_at(read_start, read_end - read_start)
+        hits = []
+        for pattern_index, position, match in self._find(data, start - read_start, end - read_start):
+            physical_offset = read_start + position
+            virtual_offset = None if first_virtual_offset is None else first_virtual_offset + (physical_offset - start)
+            hits.append(SearchHit(pattern_index, match, virtual_offset, layer.file_path, physical_offset, kind))
+        return hits
+
+
+def _iter_allocated_ranges(disk: typing.Union[VhdxFile, VhdxChain]):
+    # runs of blocks which are not sparse, found from the BAT (and sector bitmaps) alone
+    run_start = None
+    for block_index in range(disk.payload_block_count):
+        if disk.is_block_sparse(block_index):
+            if run_start is not None:
+                yield run_start * disk.block_size, block_index * disk.block_size
+                run_start = None
+        elif run_start is None:
+            run_start = block_index
+    if run_start is not None:
+        yield run_start * disk.block_size, disk.virtual_disk_size
+
+
+def _iter_slack_extents(disk: typing.Union[VhdxFile, VhdxChain]):
+    # (layer_index, start, end, kind, virtual offset of start) for each unreferenced or stale extent of each file
+    layers = disk.layers if isinstance(disk, VhdxChain) else (disk,)
+    for layer_index, layer in enumerate(layers):
+        sector_bitmap_period = layer.chunk_ratio + 1
+        for extent in build_occupancy_map(layer).iter_unreferenced(include_stale=True):
+            first_virtual_offset = None
+            if extent.kind == EXTENT_STALE and (extent.detail + 1) % sector_bitmap_period != 0:
+                # a stale payload block is still found where its BAT entry would put it on the virtual disk; the extent
+                # may be only the part of the block which live data doesn't cover, so it is placed from the block start
+                block_index = extent.detail - (extent.detail // sector_bitmap_period)
+                block_file_offset = ((layer.raw_bat[extent.detail] >> 20) & 0xfffffffffff) << 20
+                first_virtual_offset = block_index * layer.block_size + (extent.start - block_file_offset)
+            yield layer_index, extent.start, extent.end, extent.kind, first_virtual_offset
+
+
+def _iter_pieces(disk, scope: str, chunk_size: int, overlap: int, lookback: int):
+    # splits the scope into (method, args) pieces of chunk_size, each read overlap further so that matches crossing
+    # into the next piece are found (and only reported by the piece they start in), and lookback further back so that
+    # regexes are scanned from where the previous piece's matches could have ended
+    if scope == SEARCH_SCOPE_SLACK:
+        for layer_index, start, end, kind, first_virtual_offset in _iter_slack_extents(disk):
+            for piece_start in range(start, end, chunk_size):
+                piece_end = min(piece_start + chunk_size, end)
+                piece_virtual_offset = None if first_virtual_offset is None else \
+                    first_virtual_offset + (piece_start - start)
+                yield "search_physical", (layer_index, max(piece_start - lookback, start), piece_start, piece_end,
+                                          min(piece_end + overlap, end), kind, piece_virtual_offset)
+        return
+
+    if scope == SEARCH_SCOPE_ALLOCATED:
+        ranges = _iter_allocated_ranges(disk)
+    elif scope == SEARCH_SCOPE_DISK:
+        ranges = [(0, disk.virtual_disk_size)]
+    else:
+        raise ValueError(f"Unknown search scope {scope}")
+    for start, end in ranges:
+        for piece_start in range(start, end, chunk_size):
+            piece_end = min(piece_start + chunk_size, end)
+            yield "search_virtual", (max(piece_start - lookback, start), piece_start, piece_end,
+                                     min(piece_end + overlap, end))
+
+
+def _get_piece_length(piece) -> int:
+    method, args = piece
+    if method == "search_virtual":
+        start, end = args[1:3]
+    else:
+        start, end = args[2:4]
+    return end - start
+
+
+def search_disk(disk: typing.Union[VhdxFile, VhdxChain], patterns: typing.Sequence[Pattern], *,
+                scope=SEARCH_SCOPE_ALLOCATED, chunk_size=DEFAULT_SEARCH_CHUNK_SIZE,
+                max_match_length=DEFAULT_MAX_MATCH_LENGTH, workers: typing.Optional[int] = None,
+                progress: typing.Optional[ProgressCallback] = None) -> typing.Iterator[SearchHit]:
+    """
+    Searches a VhdxFile or VhdxChain for any number of byte strings and compiled bytes regexes, yielding a SearchHit
+    for each match in order of offset (virtual offset, or file and then physical offset for slack), and of pattern
+    index for matches at the same offset. A byte string is reported at every position it occurs, so its matches may
+    overlap (b"aa" is found twice in b"aaa"); regex matches don't overlap, following re.finditer (each search carries
+    on from the end of the previous match). scope is one of:
+        "disk":      the whole virtual disk
+        "allocated": only blocks which are stored in a file (sparse blocks are skipped without being read)
+        "slack":     the areas of each file which nothing references, and payload blocks with stale BAT entries
+    The scope is split into chunk_size pieces which are searched in parallel by a pool of worker processes (workers=1
+    searches in this process). Matches which cross from one piece into the next are found, provided that regex matches
+    are no longer than max_match_length; each piece's regex scan starts max_match_length before the piece so that it
+    is in step with the previous piece's. progress is a callback as for ProgressTracker, told of each piece as its
+    hits are yielded; sparse blocks skipped by the "allocated" scope are counted as skipped.
+    """
+    if not patterns:
+        raise ValueError("No patterns to search for")
+    for pattern in patterns:
+        if isinstance(pattern, bytes):
+            if not pattern:
+                raise ValueError("Patterns cannot be empty")
+        elif not isinstance(pattern, re.Pattern) or not isinstance(pattern.pattern, bytes):
+            raise TypeError("Patterns must be bytes or compiled bytes regexes")
+
+    workers = workers or os.cpu_count() or 1
+    searcher = _Searcher(disk, patterns, max_match_length)
+    pieces = list(_iter_pieces(disk, scope, chunk_size, searcher.overlap, searcher.lookback))
+    expected_bytes = sum(_get_piece_length(x) for x in pieces)
+    total_bytes = expected_bytes if scope == SEARCH_SCOPE_SLACK else disk.virtual_disk_size
+    tracker = ProgressTracker(progress, "search", total_bytes, expected_bytes)
+    tracker.advance(skipped=total_bytes - expected_bytes)
+    for piece, hits in iter_worker_results(_Searcher, (disk, patterns, max_match_length), pieces, workers):
+        yield from hits
+        tracker.advance(processed=_get_piece_length(piece))
+    tracker.finish()
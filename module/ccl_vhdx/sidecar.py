@@ -0,0 +1,193 @@
+"""
+Copyright 2019, CCL (SOLUTIONS) Group Ltd.
+
+Permission is hereby granted, free of charge, to any person obtaining a copy of this software and associated
+documentation files (the "Software"), to deal in the Software without restriction, including without limitation the
+rights to use, copy, modify, merge, publish, distribute, sublicense, and/or sell copies of the Software, and to permit
+persons to whom the Software is furnished to do so, subject to the following conditions:
+
+The above copyright notice and this permission notice shall be included in all copies or substantial portions of the
+Software.
+
+THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR IMPLIED, INCLUDING BUT NOT LIMITED TO THE
+WARRANTIES OF MERCHANTABILITY, FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE AUTHORS OR
+COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR
+OTHERWISE, ARISING FROM, OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE SOFTWARE.
+"""
+
+import array
+import json
+import mmap
+import os
+import pathlib
+import struct
+import sys
+import typing
+
+from . import ccl_vhdx as _vhdx
+from .ccl_vhdx import VhdxFile, VhdxError, guid_to_blob, REGION_GUID_BAT
+
+__all__ = ["SIDECAR_SUFFIX", "get_sidecar_path", "write_sidecar_index", "load_sidecar_index", "open_with_index"]
+
+SIDECAR_SUFFIX = ".cclidx"
+SIDECAR_MAGIC = b"CCLVHDXI"
+SIDECAR_VERSION = 1
+
+# magic, version, length of the json description which follows; the BAT and the allocated sector runs follow the
+# description as little-endian uint64 arrays, each starting on an 8 byte boundary so that they can be mapped directly
+_SIDECAR_PREAMBLE = struct.Struct("<8sII")
+
+
+def get_sidecar_path(vhdx_path: os.PathLike) -> pathlib.Path:
+    vhdx_path = pathlib.Path(vhdx_path)
+    return vhdx_path.with_name(vhdx_path.name + SIDECAR_SUFFIX)
+
+
+def _get_index_path(vhdx: VhdxFile, index_path: typing.Optional[os.PathLike]) -> pathlib.Path:
+    if index_path is not None:
+        return pathlib.Path(index_path)
+    if vhdx.source.local_path is None:
+        raise ValueError(f"{vhdx.source.name} is not a local file, so the index path must be given")
+    return get_sidecar_path(vhdx.source.local_path)
+
+
+def _describe(vhdx: VhdxFile) -> dict:
+    # everything which, if changed, means that the index no longer describes the file
+    bat_region = vhdx.region_table[guid_to_blob(REGION_GUID_BAT)]
+    return {
+        "file_size": vhdx.file_size,
+        "sequence_number": vhdx.header.sequence_number,
+        "file_write_guid": vhdx.header.file_write_guid.hex(),
+        "data_write_guid": vhdx.header.data_write_guid.hex(),
+        "bat_offset": bat_region.offset,
+        "bat_length": bat_region.length,
+        "block_size": vhdx.block_size,
+        "logical_sector_size": vhdx.logical_sector_size,
+        "virtual_disk_size": vhdx.virtual_disk_size,
+        "has_parent": vhdx.is_differencing,
+    }
+
+
+def _align(offset: int) -> int:
+    return (offset + 7) & ~7
+
+
+def write_sidecar_index(vhdx: VhdxFile, index_path: typing.Optional[os.PathLike] = None) -> pathlib.Path:
+    """
+    Writes the decoded BAT, the runs of allocated sectors (for differencing files) and the geometry of a VHDX file to
+    an index file (by default alongside the VHDX file with SIDECAR_SUFFIX appended), so that it can be reopened
+    without walking the BAT and sector bitmaps again. Returns the path written.
+    """
+    index_path = _get_index_path(vhdx, index_path)
+
+    bat = array.array("Q", vhdx.raw_bat)
+    runs = array.array("Q")
+    if vhdx.is_differencing:
+        for first_sector, sector_count in vhdx.iter_allocated_sector_runs():
+            runs.append(first_sector)
+            runs.append(sector_count)
+    if sys.byteorder != "little":
+        bat.byteswap()
+        runs.byteswap()
+
+    description = _describe(vhdx)
+    description["bat_entry_count"] = len(bat)
+    description["run_count"] = len(runs) // 2
+    description_raw = json.dumps(description).encode("utf-8")
+    preamble = _SIDECAR_PREAMBLE.pack(SIDECAR_MAGIC, SIDECAR_VERSION, len(description_raw))
+    header_length = _align(len(preamble) + len(description_raw))
+
+    # written to a temporary file first so that a reader never sees a partially written index
+    temp_path = index_path.with_name(index_path.name + ".tmp")
+    with temp_path.open("wb") as f:
+        f.write(preamble)
+        f.write(description_raw)
+        f.write(bytes(header_length - f.tell()))
+        f.write(bat.tobytes())
+        f.write(runs.tobytes())
+    os.replace(temp_path, index_path)
+    return index_path
+
+
+def _read_index(index_path: pathlib.Path):
+    # returns (description, BAT, runs, mmap) with the arrays as views onto the mapped file where that is possible
+    with index_path.open("rb") as f:
+        preamble = f.read(_SIDECAR_PREAMBLE.size)
+        if len(preamble) < _SIDECAR_PREAMBLE.size:
+            raise VhdxError("Index file is truncated")
+        magic, version, description_length = _SIDECAR_PREAMBLE.unpack(preamble)
+        if magic != SIDECAR_MAGIC:
+            raise VhdxError(f"Invalid index magic (Expected: {SIDECAR_MAGIC.hex()}; got: {magic.hex()})")
+        if version != SIDECAR_VERSION:
+            raise VhdxError(f"Unsupported index version {version}")
+        description = json.loads(f.read(description_length).decode("utf-8"))
+
+        bat_start = _align(_SIDECAR_PREAMBLE.size + description_length)
+        runs_start = bat_start + description["bat_entry_count"] * 8
+        end = runs_start + description["run_count"] * 16
+        f.seek(0, os.SEEK_END)
+        if f.tell() < end:
+            raise VhdxError("Index file is truncated")
+
+        if sys.byteorder == "little" and end > bat_start:
+            index_mmap = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+            view = memoryview(index_mmap)
+            return description, view[bat_start:runs_start].cast("Q"), view[runs_start:end].cast("Q"), index_mmap
+
+        f.seek(bat_start)
+        bat = array.array("Q")
+        bat.frombytes(f.read(runs_start - bat_start))
+        runs = array.array("Q")
+        runs.frombytes(f.read(end - runs_start))
+        if sys.byteorder != "little":
+            bat.byteswap()
+            runs.byteswap()
+        return description, bat, runs, None
+
+
+def load_sidecar_index(vhdx: VhdxFile, index_path: typing.Optional[os.PathLike] = None) -> bool:
+    """
+    Loads an index written by write_sidecar_index into an open VhdxFile. Returns False, leaving the VhdxFile alone,
+    if there is no index or it is unreadable or stale (the file's size, headers, BAT region or geometry have changed
+    since it was written).
+    """
+    if index_path is None and vhdx.source.local_path is None:
+        return False
+    index_path = _get_index_path(vhdx, index_path)
+    if not index_path.exists():
+        return False
+    try:
+        description, bat, runs, index_mmap = _read_index(index_path)
+    except (VhdxError, ValueError, KeyError, OSError) as ex:
+        _vhdx._l(f"WARNING: Could not read index file {index_path} ({ex})", to_stdout=_vhdx.DEBUG_TO_STDOUT)
+        return False
+
+    expected = _describe(vhdx)
+    stale = [key for key in expected if description.get(key) != expected[key]]
+    if stale:
+        _vhdx._l(f"Index file {index_path} is stale ({', '.join(stale)} changed)", debug_only=True,
+                 to_stdout=_vhdx.DEBUG_TO_STDOUT)
+        if index_mmap is not None:
+            bat.release()
+            runs.release()
+            index_mmap.close()
+        return False
+
+    vhdx._use_index(bat, runs, index_mmap)
+    return True
+
+
+def open_with_index(in_path: os.PathLike, *, index_path: typing.Optional[os.PathLike] = None, create=True,
+                    **kwargs) -> VhdxFile:
+    """
+    Opens a VHDX file (kwargs are passed to VhdxFile), using its sidecar index if there is a current one. Otherwise,
+    if create is True, the index is built and written for next time (a failure to write it is only logged).
+    """
+    vhdx = VhdxFile(in_path, **kwargs)
+    if load_sidecar_index(vhdx, index_path) or not create:
+        return vhdx
+    try:
+        write_sidecar_index(vhdx, index_path)
+    except (OSError, ValueError) as ex:
+        _vhdx._l(f"WARNING: Could not write index file ({ex})", to_stdout=_vhdx.DEBUG_TO_STDOUT)
+    return vhdx
@@ -0,0 +1,396 @@
+"""
+Copyright 2019, CCL (SOLUTIONS) Group Ltd.
+
+Permission is hereby granted, free of charge, to any person obtaining a copy of this software and associated
+documentation files (the "Software"), to deal in the Software without restriction, including without limitation the
+rights to use, copy, modify, merge, publish, distribute, sublicense, and/or sell copies of the Software, and to permit
+persons to whom the Software is furnished to do so, subject to the following conditions:
+
+The above copyright notice and this permission notice shall be included in all copies or substantial portions of the
+Software.
+
+THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR IMPLIED, INCLUDING BUT NOT LIMITED TO THE
+WARRANTIES OF MERCHANTABILITY, FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE AUTHORS OR
+COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR
+OTHERWISE, ARISING FROM, OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE SOFTWARE.
+"""
+
+import array
+import bisect
+import collections
+import http.client
+import os
+import pathlib
+import re
+import struct
+import threading
+import typing
+import urllib.parse
+import zipfile
+
+from . import ccl_vhdx as _vhdx
+from .ccl_vhdx import ByteSource, ByteSourceError, FileByteSource, open_byte_source, register_byte_source_opener, \
+    register_byte_source_probe
+
+__all__ = ["HttpByteSource", "SliceByteSource", "SegmentedByteSource", "find_segments", "open_zip_member"]
+
+HTTP_PAGE_SIZE = 1 << 16
+HTTP_CACHE_SIZE = 64 << 20
+HTTP_MAX_CONNECTIONS = 4
+HTTP_DIRECT_READ_SIZE = 4 << 20  # reads larger than this are fetched straight into the caller's buffer, uncached
+HTTP_TIMEOUT = 60
+
+SEGMENT_NAME_PATTERN = re.compile(r"^(?P<stem>.+\.)(?P<number>\d{3,})$")
+ZIP_MEMBER_SEPARATOR = "!"  # archive.zip!path/in/archive.vhdx
+
+_ZIP_LOCAL_HEADER = struct.Struct("<4s5H3L2H")
+_ZIP_LOCAL_HEADER_MAGIC = b"PK\x03\x04"
+
+_RETRY_EXCEPTIONS = (http.client.RemoteDisconnected, http.client.BadStatusLine, ConnectionResetError,
+                     BrokenPipeError)
+
+
+class HttpByteSource(ByteSource):
+    """
+    Reads a file served over HTTP or HTTPS using Range requests, so that only the parts of a VHDX file which are used
+    are downloaded. Connections are kept alive and reused (at most max_connections at once), the pages missing from a
+    read are fetched with one request per contiguous run, and pages are kept in a least recently used cache of up to
+    cache_size bytes so that the headers, BAT and sector bitmaps are only fetched once. From a server which ignores
+    Range requests the whole file is downloaded once and kept, if it fits in cache_size (otherwise reads fail).
+    """
+    def __init__(self, url: str, *, page_size=HTTP_PAGE_SIZE, cache_size=HTTP_CACHE_SIZE,
+                 max_connections=HTTP_MAX_CONNECTIONS, timeout=HTTP_TIMEOUT,
+                 headers: typing.Optional[typing.Dict[str, str]] = None):
+        parsed = urllib.parse.urlsplit(url)
+        if parsed.scheme.lower() not in ("http", "https"):
+            raise ValueError(f"Not an http or https url: {url}")
+        self._url = url
+        self._is_https = parsed.scheme.lower() == "https"
+        self._host = parsed.hostname
+        self._port = parsed.port
+        self._target = (parsed.path or "/") + (f"?{parsed.query}" if parsed.query else "")
+        self._page_size = page_size
+        self._cache_size = cache_size
+        self._max_connections = max_connections
+        self._timeout = timeout
+        self._headers = dict(headers or {})
+        self._size = None
+        self._request_count = 0
+        self._bytes_fetched = 0
+        self._init_state()
+
+    def _init_state(self):
+        self._lock = threading.Lock()
+        self._connection_slots = threading.BoundedSemaphore(self._max_connections)
+        self._idle_connections = []
+        self._pages = collections.OrderedDict()  # page index : bytes
+        self._whole_file = None  # the whole body, kept if the server ignores range requests
+
+    def __getstate__(self):
+        # connections and cached pages stay with this process
+        state = self.__dict__.copy()
+        for key in ("_lock", "_connection_slots", "_idle_connections", "_pages", "_whole_file"):
+            del state[key]
+        return state
+
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+        self._init_state()
+
+    def _new_connection(self) -> http.client.HTTPConnection:
+        if self._is_https:
+            return http.client.HTTPSConnection(self._host, self._port, timeout=self._timeout)
+        return http.client.HTTPConnection(self._host, self._port, timeout=self._timeout)
+
+    def _request(self, method: str,
+                 headers: typing.Dict[str, str]) -> typing.Tuple[int, http.client.HTTPMessage, bytes]:
+        with self._connection_slots:
+            with self._lock:
+                connection = self._idle_connections.pop() if self._idle_connections else None
+            for attempt in range(2):
+                if connection is None:
+                    connection = self._new_connection()
+                try:
+                    connection.request(method, self._target, headers={**self._headers, **headers})
+                    response = connection.getresponse()
+                    body = response.read()
+                    break
+                except _RETRY_EXCEPTIONS:
+                    # the server closed an idle keep-alive connection, so try again once on a new one
+                    connection.close()
+                    connection = None
+                    if attempt:
+                        raise
+                except Exception:
+                    connection.close()
+                    raise
+
+            with self._lock:
+                self._request_count += 1
+                self._bytes_fetched += len(body)
+                if response.will_close:
+                    connection.close()
+                else:
+                    self._idle_connections.append(connection)
+        return response.status, response.headers, body
+
+    def _fetch(self, start: int, end: int) -> bytes:
+        status, headers, body = self._request("GET", {"Range": f"bytes={start}-{end - 1}"})
+        if status == 206:
+            return body
+        elif status == 200:
+            # the server ignored the range and sent the whole file, which is kept (if it fits in the cache) rather
+            # than downloaded again for every read
+            if len(body) > self._cache_size:
+                raise ByteSourceError(f"{self._url} does not support range requests, and at {len(body)} bytes it is "
+                                      f"too large to keep in memory (cache_size is {self._cache_size} bytes)")
+            _vhdx._l(f"WARNING: {self._url} does not support range requests, the whole file was downloaded and is "
+                     f"kept in memory", to_stdout=_vhdx.DEBUG_TO_STDOUT)
+            with self._lock:
+                self._whole_file = body
+            return body[start:end]
+        elif status == 416:
+            return b""
+        raise ByteSourceError(f"HTTP status {status} reading bytes {start}-{end - 1} of {self._url}")
+
+    def _get_size(self) -> int:
+        status, headers, _ = self._request("HEAD", {})
+        if status == 200 and headers.get("Content-Length") is not None:
+            return int(headers["Content-Length"])
+        # servers which don't answer HEAD usefully give the full length in the Content-Range of a range request
+        status, headers, _ = self._request("GET", {"Range": "bytes=0-0"})
+        content_range = headers.get("Content-Range", "")
+        if status == 206 and "/" in content_range and content_range.rsplit("/", 1)[1] != "*":
+            return int(content_range.rsplit("/", 1)[1])
+        raise ByteSourceError(f"Could not get the size of {self._url} (HTTP status {status})")
+
+    def readinto_at(self, offset: int, view: memoryview) -> int:
+        end = min(offset + len(view), self.size)
+        if end <= offset:
+            return 0
+        if self._whole_file is not None:
+            data = self._whole_file[offset:end]
+            view[:len(data)] = data
+            return len(data)
+        if end - offset > HTTP_DIRECT_READ_SIZE:
+            data = self._fetch(offset, end)
+            view[:len(data)] = data
+            return len(data)
+
+        page_size = self._page_size
+        first_page = offset // page_size
+        end_page = -(-end // page_size)
+        pages = {}
+        with self._lock:
+            for page_index in range(first_page, end_page):
+                page = self._pages.get(page_index)
+                if page is not None:
+                    self._pages.move_to_end(page_index)
+                    pages[page_index] = page
+
+        # the missing pages are fetched a contiguous run at a time
+        page_index = first_page
+        while page_index < end_page:
+            if page_index in pages:
+                page_index += 1
+                continue
+            run_end = page_index
+            while run_end < end_page and run_end not in pages:
+                run_end += 1
+            data = self._fetch(page_index * page_size, min(run_end * page_size, self.size))
+            for i in range(page_index, run_end):
+                pages[i] = data[(i - page_index) * page_size:(i - page_index + 1) * page_size]
+            with self._lock:
+                for i in range(page_index, run_end):
+                    self._pages[i] = pages[i]
+                while len(self._pages) * page_size > self._cache_size and self._pages:
+                    self._pages.popitem(last=False)
+            page_index = run_end
+
+        filled = 0
+        for page_index in range(first_page, end_page):
+            page_start = page_index * page_size
+            part = pages[page_index][max(offset - page_start, 0):end - page_start]
+            view[filled:filled + len(part)] = part
+            filled += len(part)
+            if len(pages[page_index]) < min(page_size, self.size - page_start):
+                break  # the file is shorter than it was
+        return filled
+
+    def close(self):
+        with self._lock:
+            for connection in self._idle_connections:
+                connection.close()
+            self._idle_connections = []
+            self._pages.clear()
+            self._whole_file = None
+
+    @property
+    def size(self) -> int:
+        if self._size is None:
+            self._size = self._get_size()
+        return self._size
+
+    @property
+    def name(self) -> str:
+        return self._url
+
+    @property
+    def request_count(self) -> int:
+        return self._request_count
+
+    @property
+    def bytes_fetched(self) -> int:
+        return self._bytes_fetched
+
+
+class SliceByteSource(ByteSource):
+    """A range of another ByteSource, for example a file stored uncompressed inside an archive"""
+    def __init__(self, source: ByteSource, offset: int, length: int, name: typing.Optional[str] = None):
+        self._source = source
+        self._offset = offset
+        self._length = length
+        self._name = name or f"{source.name}[{offset}:{offset + length}]"
+
+    def readinto_at(self, offset: int, view: memoryview) -> int:
+        length = max(0, min(len(view), self._length - offset))
+        return self._source.readinto_at(self._offset + offset, view[:length]) if length else 0
+
+    def close(self):
+        self._source.close()
+
+    @property
+    def size(self) -> int:
+        return self._length
+
+    @property
+    def name(self) -> str:
+        return self._name
+
+
+class SegmentedByteSource(ByteSource):
+    """
+    Ordered segments (for example image.vhdx.001, image.vhdx.002, ...) read as one file, without reassembling them.
+    The segment holding an offset is found by a binary search of the segments' starting offsets, and each segment is
+    read through its own ByteSource.
+    """
+    def __init__(self, segments: typing.Sequence[typing.Union[ByteSource, str, os.PathLike]],
+                 name: typing.Optional[str] = None):
+        if not segments:
+            raise ValueError("No segments given")
+        self._segments = [open_byte_source(x) for x in segments]
+        self._starts = array.array("Q")
+        position = 0
+        for segment in self._segments:
+            self._starts.append(position)
+            position += segment.size
+        self._size = position
+        self._name = name or self._segments[0].name
+
+    def readinto_at(self, offset: int, view: memoryview) -> int:
+        end = min(offset + len(view), self._size)
+        position = offset
+        segment_index = bisect.bisect_right(self._starts, offset) - 1
+        while position < end and segment_index < len(self._segments):
+            segment = self._segments[segment_index]
+            offset_in_segment = position - self._starts[segment_index]
+            part_length = min(segment.size - offset_in_segment, end - position)
+            if part_length > 0:
+                filled = segment.readinto_at(offset_in_segment, view[position - offset:position - offset + part_length])
+                position += filled
+                if filled < part_length:
+                    break  # the segment is shorter than it was
+            segment_index += 1
+        return max(position - offset, 0)
+
+    def close(self):
+        for segment in self._segments:
+            segment.close()
+
+    @property
+    def segments(self) -> typing.List[ByteSource]:
+        return self._segments
+
+    @property
+    def size(self) -> int:
+        return self._size
+
+    @property
+    def name(self) -> str:
+        return self._name
+
+
+def find_segments(first_segment: os.PathLike) -> typing.List[pathlib.Path]:
+    """
+    Returns the paths of the segments of a split file, given the path of one of them: every file alongside it sharing
+    its name up to the numeric extension, in order, stopping at the first gap in the numbering
+    """
+    first_segment = pathlib.Path(first_segment)
+    match = SEGMENT_NAME_PATTERN.match(first_segment.name)
+    if match is None:
+        raise ValueError(f"{first_segment} does not have a numeric segment extension")
+    stem, number = match.group("stem"), match.group("number")
+    segments = []
+    segment_number = int(number)
+    while True:
+        path = first_segment.with_name(f"{stem}{segment_number:0{len(number)}d}")
+        if not path.is_file():
+            break
+        segments.append(path)
+        segment_number += 1
+    return segments
+
+
+def open_zip_member(archive: typing.Union[ByteSource, str, os.PathLike], member: str) -> SliceByteSource:
+    """
+    Opens a file stored (without compression or encryption) inside a zip archive in place, as a range of the archive.
+    The archive can itself be any location open_byte_source accepts.
+    """
+    archive = open_byte_source(archive)
+    with archive.open() as f:
+        with zipfile.ZipFile(f) as zip_file:
+            info = zip_file.getinfo(member)
+    if info.compress_type != zipfile.ZIP_STORED:
+        raise ByteSourceError(f"{member} is compressed in {archive.name} so cannot be read in place")
+    if info.flag_bits & 0x01:
+        raise ByteSourceError(f"{member} is encrypted in {archive.name}")
+
+    # the data follows the local header, whose name and extra field lengths can differ from the central directory's
+    local_header = archive.read_at(info.header_offset, _ZIP_LOCAL_HEADER.size)
+    if len(local_header) < _ZIP_LOCAL_HEADER.size:
+        raise ByteSourceError(f"Local header of {member} is truncated in {archive.name}")
+    fields = _ZIP_LOCAL_HEADER.unpack(local_header)
+    if fields[0] != _ZIP_LOCAL_HEADER_MAGIC:
+        raise ByteSourceError(f"Invalid local header for {member} in {archive.name}")
+    name_length, extra_length = fields[-2], fields[-1]
+    data_offset = info.header_offset + _ZIP_LOCAL_HEADER.size + name_length + extra_length
+    return SliceByteSource(archive, data_offset, info.file_size, f"{archive.name}{ZIP_MEMBER_SEPARATOR}{member}")
+
+
+def _probe_segments(location) -> typing.Optional[ByteSource]:
+    if isinstance(location, str) and "://" in location:
+        return None
+    path = pathlib.Path(location)
+    if SEGMENT_NAME_PATTERN.match(path.name) is None or not path.is_file():
+        return None
+    segments = find_segments(path)
+    if len(segments) < 2:
+        return None  # a lone file with a numeric extension is just a file
+    return SegmentedByteSource([FileByteSource(x) for x in segments], str(path))
+
+
+def _probe_zip_member(location) -> typing.Optional[ByteSource]:
+    location = os.fspath(location)
+    if not isinstance(location, str):
+        return None
+    match = re.match(r"^(?P<archive>.+?\.zip)" + re.escape(ZIP_MEMBER_SEPARATOR) + r"(?P<member>.+)$", location,
+                     re.IGNORECASE)
+    if match is None:
+        return None
+    return open_zip_member(match.group("archive"), match.group("member").replace("\\", "/"))
+
+
+register_byte_source_opener("http", HttpByteSource)
+register_byte_source_opener("https", HttpByteSource)
+register_byte_source_probe(_probe_zip_member)
+register_byte_source_probe(_probe_segments)
@@ -0,0 +1,223 @@
+"""
+Copyright 2019, CCL (SOLUTIONS) Group Ltd.
+
+Permission is hereby granted, free of charge, to any person obtaining a copy of this software and associated
+documentation files (the "Software"), to deal in the Software without restriction, including without limitation the
+rights to use, copy, modify, merge, publish, distribute, sublicense, and/or sell copies of the Software, and to permit
+persons to whom the Software is furnished to do so, subject to the following conditions:
+
+The above copyright notice and this permission notice shall be included in all copies or substantial portions of the
+Software.
+
+THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR IMPLIED, INCLUDING BUT NOT LIMITED TO THE
+WARRANTIES OF MERCHANTABILITY, FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE AUTHORS OR
+COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR
+OTHERWISE, ARISING FROM, OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE SOFTWARE.
+"""
+
+import array
+import collections
+import math
+import os
+import typing
+
+from .ccl_vhdx import VhdxFile, VhdxChain
+from .parallel import iter_worker_results
+from .progress import ProgressCallback, ProgressTracker
+
+__all__ = ["DEFAULT_TRIAGE_SAMPLE_LENGTH", "DEFAULT_TRIAGE_STRIDE", "CONTENT_CLASSES", "BYTE_CLASSES", "BlockTriage",
+           "TriageMap", "triage_disk"]
+
+DEFAULT_TRIAGE_SAMPLE_LENGTH = 1 << 16
+DEFAULT_TRIAGE_STRIDE = 1 << 20  # one sample of DEFAULT_TRIAGE_SAMPLE_LENGTH from each MB of a block
+DEFAULT_TRIAGE_BATCH_BLOCKS = 16  # blocks sent to a worker process at a time
+
+HIGH_ENTROPY_THRESHOLD = 7.9  # bits per byte; encrypted (e.g. BitLocker) or well compressed data
+LOW_ENTROPY_THRESHOLD = 1.0  # fills and wiping patterns
+TEXT_THRESHOLD = 0.9  # fraction of text bytes (or, for UTF-16LE text, of text and zero bytes together)
+
+CONTENT_SPARSE = "sparse"
+CONTENT_ZERO = "zero"
+CONTENT_LOW_ENTROPY = "low_entropy"
+CONTENT_TEXT = "text"
+CONTENT_BINARY = "binary"
+CONTENT_HIGH_ENTROPY = "high_entropy"
+CONTENT_CLASSES = (CONTENT_SPARSE, CONTENT_ZERO, CONTENT_LOW_ENTROPY, CONTENT_TEXT, CONTENT_BINARY,
+                   CONTENT_HIGH_ENTROPY)
+_MAP_TABLE = b".0_tb#".ljust(256)  # one character per content class for TriageMap.to_map_string
+
+BYTE_CLASSES = ("zero", "text", "control", "high", "ff")
+_TEXT_BYTES = frozenset(range(0x20, 0x7f)) | {0x09, 0x0a, 0x0d}
+
+
+def _get_byte_class(b: int) -> int:
+    if b == 0:
+        return 0
+    if b in _TEXT_BYTES:
+        return 1
+    if b < 0x80:
+        return 2
+    return 3 if b < 0xff else 4
+
+
+_BYTE_CLASS_OF = bytes(_get_byte_class(b) for b in range(256))
+
+
+class BlockTriage(typing.NamedTuple):
+    block_index: int
+    virtual_offset: int
+    length: int
+    sampled_bytes: int  # how much of the block was read and counted (0 if it is sparse)
+    content_class: str
+    entropy: float  # Shannon entropy of the sampled bytes, in bits per byte (0.0 to 8.0)
+    byte_classes: typing.Tuple[float, ...]  # fraction of the sampled bytes in each of BYTE_CLASSES
+
+
+class TriageMap:
+    """Per-block results of triage_disk, held in compact arrays; BlockTriage tuples are made as they are asked for"""
+    def __init__(self, block_size: int, virtual_disk_size: int):
+        self._block_size = block_size
+        self._virtual_disk_size = virtual_disk_size
+        block_count = -(-virtual_disk_size // block_size)
+        self._classes = array.array("B", bytes(block_count))  # index into CONTENT_CLASSES, all sparse to begin with
+        self._entropies = array.array("f", bytes(4 * block_count))
+        self._sampled = array.array("Q", bytes(8 * block_count))
+        self._byte_classes = array.array("f", bytes(4 * block_count * len(BYTE_CLASSES)))
+
+    def __len__(self):
+        return len(self._classes)
+
+    def __getitem__(self, block_index: int) -> BlockTriage:
+        if not 0 <= block_index < len(self._classes):
+            raise IndexError(block_index)
+        start = block_index * len(BYTE_CLASSES)
+        virtual_offset = block_index * self._block_size
+        return BlockTriage(block_index, virtual_offset, min(self._block_size, self._virtual_disk_size - virtual_offset),
+                           self._sampled[block_index], CONTENT_CLASSES[self._classes[block_index]],
+                           self._entropies[block_index],
+                           tuple(self._byte_classes[start:start + len(BYTE_CLASSES)]))
+
+    def __iter__(self) -> typing.Iterator[BlockTriage]:
+        for block_index in range(len(self._classes)):
+            yield self[block_index]
+
+    def _set(self, block_index: int, sampled_bytes: int, content_class: int, entropy: float,
+             byte_classes: typing.Sequence[float]):
+        self._classes[block_index] = content_class
+        self._sampled[block_index] = sampled_bytes
+        self._entropies[block_index] = entropy
+        start = block_index * len(BYTE_CLASSES)
+        self._byte_classes[start:start + len(BYTE_CLASSES)] = array.array("f", byte_classes)
+
+    @property
+    def block_size(self) -> int:
+        return self._block_size
+
+    def class_totals(self) -> typing.Dict[str, int]:
+        """The bytes of the virtual disk in each content class"""
+        totals = dict.fromkeys(CONTENT_CLASSES, 0)
+        for block_index, content_class in enumerate(self._classes):
+            block_start = block_index * self._block_size
+            totals[CONTENT_CLASSES[content_class]] += min(self._block_size, self._virtual_disk_size - block_start)
+        return totals
+
+    def iter_runs(self) -> typing.Iterator[typing.Tuple[int, int, str]]:
+        """Yields (virtual offset, length, content class) for each run of blocks in the same class"""
+        run_start = 0
+        for block_index in range(1, len(self._classes) + 1):
+            if block_index == len(self._classes) or self._classes[block_index] != self._classes[run_start]:
+                offset = run_start * self._block_size
+                yield offset, min(block_index * self._block_size, self._virtual_disk_size) - offset, \
+                    CONTENT_CLASSES[self._classes[run_start]]
+                run_start = block_index
+
+    def to_map_string(self) -> str:
+        """One character per block: . sparse, 0 zero, _ low entropy, t text, b binary, # high entropy"""
+        return bytes(self._classes).translate(_MAP_TABLE).decode("ascii")
+
+
+def _get_histogram(data: bytes) -> typing.List[int]:
+    # Counter tallies the bytes in a single pass in C, which is a few times quicker than 256 passes of bytes.count
+    counts = collections.Counter(data)
+    return [counts[b] for b in range(256)]
+
+
+def _classify(histogram: typing.Sequence[int], total: int) -> typing.Tuple[int, float, typing.List[float]]:
+    # returns (index into CONTENT_CLASSES, entropy, byte class fractions)
+    entropy = 0.0
+    byte_class_counts = [0] * len(BYTE_CLASSES)
+    for b, count in enumerate(histogram):
+        if count:
+            p = count / total
+            entropy -= p * math.log2(p)
+            byte_class_counts[_BYTE_CLASS_OF[b]] += count
+    fractions = [x / total for x in byte_class_counts]
+    zero_fraction, text_fraction = fractions[0], fractions[1]
+
+    if zero_fraction == 1.0:
+        content_class = CONTENT_ZERO
+    elif entropy < LOW_ENTROPY_THRESHOLD:
+        content_class = CONTENT_LOW_ENTROPY
+    elif text_fraction >= TEXT_THRESHOLD or (0.3 <= zero_fraction <= 0.6 and
+                                             text_fraction + zero_fraction >= TEXT_THRESHOLD):
+        content_class = CONTENT_TEXT
+    elif entropy >= HIGH_ENTROPY_THRESHOLD:
+        content_class = CONTENT_HIGH_ENTROPY
+    else:
+        content_class = CONTENT_BINARY
+    return CONTENT_CLASSES.index(content_class), entropy, fractions
+
+
+class _Triager:
+    """Reads and classifies blocks (see parallel.iter_worker_results)"""
+    def __init__(self, disk: typing.Union[VhdxFile, VhdxChain], sample_length: int, stride: typing.Optional[int]):
+        self._disk = disk
+        self._sample_length = sample_length
+        self._stride = stride
+
+    def _read_samples(self, block_index: int) -> typing.Union[bytes, bytearray]:
+        disk = self._disk
+        block_length = disk.get_block_length(block_index)
+        if self._stride is None or self._stride <= self._sample_length or block_length <= self._sample_length:
+            return disk.get_virtual_block(block_index)
+        block_start = block_index * disk.block_size
+        return b"".join(disk.read(block_start + offset, min(self._sample_length, block_length - offset))
+                        for offset in range(0, block_length, self._stride))
+
+    def triage_blocks(self, block_indices: typing.Sequence[int]) -> list:
+        results = []
+        for block_index in block_indices:
+            data = self._read_samples(block_index)
+            content_class, entropy, fractions = _classify(_get_histogram(data), len(data))
+            results.append((block_index, len(data), content_class, entropy, fractions))
+        return results
+
+
+def triage_disk(disk: typing.Union[VhdxFile, VhdxChain], *, sample_length=DEFAULT_TRIAGE_SAMPLE_LENGTH,
+                stride: typing.Optional[int] = DEFAULT_TRIAGE_STRIDE, workers: typing.Optional[int] = None,
+                progress: typing.Optional[ProgressCallback] = None) -> TriageMap:
+    """
+    Classifies each payload block of a VhdxFile or VhdxChain as sparse, zero, low entropy, text, binary or high
+    entropy, from the Shannon entropy and byte class histogram (see BYTE_CLASSES) of its contents. Sparse blocks are
+    known from the BAT and never read. Of the other blocks, only sample_length bytes from every stride bytes are
+    read (stride=None reads whole blocks). Blocks are classified in parallel by a pool of worker processes
+    (workers=1 works in this process). progress is a callback as for ProgressTracker.
+    """
+    if sample_length <= 0:
+        raise ValueError("sample_length must be positive")
+    triage_map = TriageMap(disk.block_size, disk.virtual_disk_size)
+    allocated = [x for x in range(disk.payload_block_count) if not disk.is_block_sparse(x)]
+    allocated_bytes = sum(disk.get_block_length(x) for x in allocated)
+    tracker = ProgressTracker(progress, "triage", disk.virtual_disk_size, allocated_bytes)
+    tracker.advance(skipped=disk.virtual_disk_size - allocated_bytes)
+
+    calls = [("triage_blocks", (allocated[i:i + DEFAULT_TRIAGE_BATCH_BLOCKS],))
+             for i in range(0, len(allocated), DEFAULT_TRIAGE_BATCH_BLOCKS)]
+    workers = workers or os.cpu_count() or 1
+    for _, results in iter_worker_results(_Triager, (disk, sample_length, stride), calls, workers):
+        for block_index, sampled_bytes, content_class, entropy, fractions in results:
+            triage_map._set(block_index, sampled_bytes, content_class, entropy, fractions)
+            tracker.advance(processed=disk.get_block_length(block_index))
+
+    tracker.finish()
+    return triage_map
@@ -0,0 +1,313 @@
+"""
+Copyright 2019, CCL (SOLUTIONS) Group Ltd.
+
+Permission is hereby granted, free of charge, to any person obtaining a copy of this software and associated
+documentation files (the "Software"), to deal in the Software without restriction, including without limitation the
+rights to use, copy, modify, merge, publish, distribute, sublicense, and/or sell copies of the Software, and to permit
+persons to whom the Software is furnished to do so, subject to the following conditions:
+
+The above copyright notice and this permission notice shall be included in all copies or substantial portions of the
+Software.
+
+THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR IMPLIED, INCLUDING BUT NOT LIMITED TO THE
+WARRANTIES OF MERCHANTABILITY, FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE AUTHORS OR
+COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR
+OTHERWISE, ARISING FROM, OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE SOFTWARE.
+"""
+
+import collections
+import struct
+import typing
+
+from .ccl_vhdx import (VhdxFile, VhdxError, BatPayloadBlockState, ByteSource, SENSIBLE_FALLBACK_METAS,
+                       REGION_GUID_BAT, REGION_GUID_METADATA, REGION_TABLE_OFFSETS, HEAD_MAGIC, REGION_TABLE_MAGIC,
+                       BAT_SB_BLOCK_NOT_PRESENT, BAT_SB_BLOCK_PRESENT, guid_to_blob, open_byte_source, crc32c)
+from .occupancy import EXTENT_STALE, _iter_referenced_extents
+from .progress import ProgressCallback, ProgressTracker
+
+__all__ = ["SEVERITY_ERROR", "SEVERITY_WARNING", "MAX_FINDINGS_PER_CHECK", "Finding", "VerificationReport", "verify"]
+
+SEVERITY_ERROR = "error"
+SEVERITY_WARNING = "warning"
+
+MAX_FINDINGS_PER_CHECK = 1000  # beyond this only a count is kept for each kind of finding
+
+HEADER_OFFSETS = (64 * 1024, 128 * 1024)
+HEADER_LENGTH = 4096
+REGION_TABLE_LENGTH = 64 * 1024
+MB = 1 << 20
+_PROGRESS_STEP = 1 << 16  # BAT entries checked between progress updates
+
+_KNOWN_REGIONS = {guid_to_blob(REGION_GUID_BAT): "BAT", guid_to_blob(REGION_GUID_METADATA): "metadata"}
+_PAYLOAD_STATES = frozenset(int(x) for x in BatPayloadBlockState)
+_LIVE_PAYLOAD_STATES = (BatPayloadBlockState.BAT_PAYLOAD_BLOCK_FULLY_PRESENT,
+                        BatPayloadBlockState.BAT_PAYLOAD_BLOCK_PARTIALLY_PRESENT)
+_SECTOR_BITMAP_STATES = (BAT_SB_BLOCK_NOT_PRESENT, BAT_SB_BLOCK_PRESENT)
+_BAT_RESERVED_MASK = 0xffff8  # bits 3 to 19
+
+
+class Finding(typing.NamedTuple):
+    check: str  # a short, stable name for the kind of problem
+    severity: str
+    message: str
+    offset: typing.Optional[int] = None  # file offset of the structure at fault, where there is one
+    bat_index: typing.Optional[int] = None
+
+    def to_dict(self) -> dict:
+        return {key: value for key, value in self._asdict().items() if value is not None}
+
+
+class VerificationReport:
+    def __init__(self, path: str, findings: typing.List[Finding], finding_counts: typing.Dict[str, int]):
+        self._path = path
+        self._findings = findings
+        self._finding_counts = finding_counts
+
+    def __repr__(self):
+        return f"<VerificationReport {self._path}: {self.error_count} errors; {self.warning_count} warnings>"
+
+    @property
+    def path(self) -> str:
+        return self._path
+
+    @property
+    def findings(self) -> typing.List[Finding]:
+        """The findings, at most MAX_FINDINGS_PER_CHECK of each kind"""
+        return self._findings
+
+    @property
+    def finding_counts(self) -> typing.Dict[str, int]:
+        """The total number of findings of each kind, including those beyond MAX_FINDINGS_PER_CHECK"""
+        return self._finding_counts
+
+    def _count_severity(self, severity: str) -> int:
+        # each kind of finding always has the same severity, and the first findings of each kind are always kept
+        check_severities = {x.check: x.severity for x in self._findings}
+        return sum(count for check, count in self._finding_counts.items() if check_severities.get(check) == severity)
+
+    @property
+    def error_count(self) -> int:
+        """The total number of errors, including those beyond MAX_FINDINGS_PER_CHECK"""
+        return self._count_severity(SEVERITY_ERROR)
+
+    @property
+    def warning_count(self) -> int:
+        """The total number of warnings, including those beyond MAX_FINDINGS_PER_CHECK"""
+        return self._count_severity(SEVERITY_WARNING)
+
+    @property
+    def needs_resilient_mode(self) -> bool:
+        """True if there are errors, so the file should be opened with ignore_faults (and maybe fallback metadata)"""
+        return self.error_count > 0
+
+    def to_dict(self) -> dict:
+        return {
+            "path": self._path,
+            "needs_resilient_mode": self.needs_resilient_mode,
+            "error_count": self.error_count,
+            "warning_count": self.warning_count,
+            "finding_counts": dict(self._finding_counts),
+            "findings": [x.to_dict() for x in self._findings]
+        }
+
+
+class _FindingCollector:
+    def __init__(self):
+        self.findings = []
+        self.counts = collections.Counter()
+
+    def add(self, check: str, severity: str, message: str, offset=None, bat_index=None):
+        self.counts[check] += 1
+        if self.counts[check] <= MAX_FINDINGS_PER_CHECK:
+            self.findings.append(Finding(check, severity, message, offset, bat_index))
+
+
+def _check_headers(source: ByteSource, findings: _FindingCollector):
+    sequence_numbers = []
+    for header_offset in HEADER_OFFSETS:
+        raw = source.read_at(header_offset, HEADER_LENGTH)
+        if len(raw) < HEADER_LENGTH or raw[0:4] != HEAD_MAGIC:
+            findings.add("header_invalid", SEVERITY_ERROR, "Header is missing or has an invalid signature",
+                         header_offset)
+            continue
+        checksum, = struct.unpack_from("<I", raw, 4)
+        if crc32c(raw[0:4] + bytes(4) + raw[8:]) != checksum:
+            findings.add("header_checksum", SEVERITY_ERROR, "Header checksum does not match", header_offset)
+        sequence_numbers.append(struct.unpack_from("<Q", raw, 8)[0])
+    if len(sequence_numbers) == 2 and sequence_numbers[0] == sequence_numbers[1]:
+        findings.add("header_sequence_tie", SEVERITY_WARNING,
+                     f"Both headers have sequence number {sequence_numbers[0]}, so neither is clearly current")
+
+    for region_table_offset in REGION_TABLE_OFFSETS:
+        raw = source.read_at(region_table_offset, REGION_TABLE_LENGTH)
+        if len(raw) < REGION_TABLE_LENGTH or raw[0:4] != REGION_TABLE_MAGIC:
+            findings.add("region_table_invalid", SEVERITY_ERROR,
+                         "Region table is missing or has an invalid signature", region_table_offset)
+            continue
+        checksum, = struct.unpack_from("<I", raw, 4)
+        if crc32c(raw[0:4] + bytes(4) + raw[8:]) != checksum:
+            findings.add("region_table_checksum", SEVERITY_ERROR, "Region table checksum does not match",
+                         region_table_offset)
+
+
+def _check_regions(vhdx: VhdxFile, findings: _FindingCollector):
+    if vhdx.header.log_guid != bytes(16):
+        findings.add("log_not_replayed", SEVERITY_WARNING,
+                     "The header has a LogGuid set, so the log may hold writes which were never applied",
+                     vhdx.header.log_offset)
+
+    regions = [("log", vhdx.header.log_offset, vhdx.header.log_length)] if vhdx.header.log_length else []
+    for guid in vhdx.region_table:
+        entry = vhdx.region_table[guid]
+        name = _KNOWN_REGIONS.get(guid)
+        if name is None:
+            if entry.required:
+                findings.add("unknown_required_region", SEVERITY_ERROR,
+                             f"Region {guid.hex()} is marked required but is not known", entry.offset)
+            name = f"region {guid.hex()}"
+        regions.append((name, entry.offset, entry.length))
+
+    for name, offset, length in regions:
+        if offset % MB or length % MB:
+            findings.add("region_alignment", SEVERITY_ERROR,
+                         f"The {name} (offset {offset}, length {length}) is not aligned to 1MB", offset)
+        if offset < MB:
+            findings.add("region_in_header_section", SEVERITY_ERROR,
+                         f"The {name} starts inside the header section", offset)
+        if offset + length > vhdx.file_size:
+            findings.add("region_beyond_eof", SEVERITY_ERROR,
+                         f"The {name} ends at {offset + length}, beyond the end of the file ({vhdx.file_size})", offset)
+
+
+def _check_metadata(vhdx: VhdxFile, findings: _FindingCollector):
+    if vhdx.block_size not in tuple(1 << x for x in range(20, 29)):
+        findings.add("metadata_block_size", SEVERITY_ERROR, f"BlockSize {vhdx.block_size} is not a power of two "
+                     f"between 1MB and 256MB")
+    for name in ("LogicalSectorSize", "PhysicalSectorSize"):
+        if vhdx.metas.get(name) not in (512, 4096):
+            findings.add("metadata_sector_size", SEVERITY_ERROR, f"{name} {vhdx.metas.get(name)} is not 512 or 4096")
+    if vhdx.virtual_disk_size % vhdx.logical_sector_size:
+        findings.add("metadata_disk_size", SEVERITY_ERROR, f"VirtualDiskSize {vhdx.virtual_disk_size} is not a "
+                     f"multiple of the logical sector size")
+
+
+def _check_bat(vhdx: VhdxFile, findings: _FindingCollector, tracker: ProgressTracker):
+    bat = vhdx.raw_bat
+    sector_bitmap_period = vhdx.chunk_ratio + 1
+    required = vhdx.bat_entry_count
+    if len(bat) < required:
+        findings.add("bat_too_small", SEVERITY_ERROR,
+                     f"The BAT holds {len(bat)} entries, fewer than the {required} the disk needs")
+
+    file_size = vhdx.file_size
+    for bat_index, raw_entry in enumerate(bat):
+        if bat_index % _PROGRESS_STEP == _PROGRESS_STEP - 1:
+            tracker.advance(processed=_PROGRESS_STEP * 8)
+        state = raw_entry & 0x07
+        file_offset = ((raw_entry >> 20) & 0xfffffffffff) * MB
+        if raw_entry & _BAT_RESERVED_MASK:
+            findings.add("bat_reserved_bits", SEVERITY_WARNING, "BAT entry has reserved bits set",
+                         bat_index=bat_index)
+        if (bat_index + 1) % sector_bitmap_period == 0:
+            if state not in _SECTOR_BITMAP_STATES:
+                findings.add("sector_bitmap_state", SEVERITY_ERROR,
+                             f"Sector bitmap BAT entry has the invalid state {state}", bat_index=bat_index)
+            elif state == BAT_SB_BLOCK_PRESENT:
+                if not vhdx.is_differencing:
+                    findings.add("sector_bitmap_in_fixed_or_dynamic", SEVERITY_WARNING,
+                                 "Sector bitmap is present in a file which isn't differencing", file_offset, bat_index)
+                if file_offset == 0:
+                    findings.add("present_without_offset", SEVERITY_ERROR,
+                                 "Sector bitmap is present but has no file offset", bat_index=bat_index)
+                elif file_offset + MB > file_size:
+                    findings.add("beyond_eof", SEVERITY_ERROR,
+                                 f"Sector bitmap at {file_offset} runs beyond the end of the file", file_offset,
+                                 bat_index)
+            continue
+
+        if state not in _PAYLOAD_STATES:
+            findings.add("payload_state", SEVERITY_ERROR, f"Payload BAT entry has the invalid state {state}",
+                         bat_index=bat_index)
+            continue
+        if state not in _LIVE_PAYLOAD_STATES:
+            continue
+        if state == BatPayloadBlockState.BAT_PAYLOAD_BLOCK_PARTIALLY_PRESENT and not vhdx.is_differencing:
+            findings.add("partially_present_in_fixed_or_dynamic", SEVERITY_ERROR,
+                         "Payload block is partially present in a file which isn't differencing", file_offset,
+                         bat_index)
+        if file_offset == 0:
+            findings.add("present_without_offset", SEVERITY_ERROR, "Payload block is present but has no file offset",
+                         bat_index=bat_index)
+        elif file_offset + vhdx.block_size > file_size:
+            findings.add("beyond_eof", SEVERITY_ERROR,
+                         f"Payload block at {file_offset} runs beyond the end of the file", file_offset, bat_index)
+    tracker.advance(processed=(len(bat) % _PROGRESS_STEP) * 8)
+
+
+def _check_overlaps(vhdx: VhdxFile, findings: _FindingCollector):
+    # one sort and one sweep: each extent is compared with the furthest reaching extent before it, so every overlap
+    # is found without comparing extents pairwise
+    extents = sorted((x for x in _iter_referenced_extents(vhdx) if x.kind != EXTENT_STALE and x.end > x.start),
+                     key=lambda x: (x.start, x.end))
+    reach = None
+    for extent in extents:
+        if reach is not None and extent.start < reach.end:
+            owner = reach.kind if reach.detail is None else f"{reach.kind} of BAT entry {reach.detail}"
+            findings.add("overlap", SEVERITY_ERROR,
+                         f"The {extent.kind} at {extent.start}-{extent.end} overlaps the {owner} at "
+                         f"{reach.start}-{reach.end}", extent.start, extent.detail)
+        if reach is None or extent.end > reach.end:
+            reach = extent
+
+
+def verify(in_path, *, fallback_metas=None, progress: typing.Optional[ProgressCallback] = None) -> VerificationReport:
+    """
+    Runs every structural check on a VHDX file and returns the findings: header and region table signatures and
+    checksums, region placement, metadata values, BAT entry states and reserved bits, present blocks and sector
+    bitmaps without offsets or beyond the end of the file, and any overlap between the header section, regions, log,
+    payload blocks and sector bitmaps. If the file can't be opened strictly, or its BAT can't be read (it is cut short
+    by the end of the file), that is an error and it is opened with ignore_faults (and fallback_metas, or
+    SENSIBLE_FALLBACK_METAS) for the remaining checks. progress is a callback
+    as for ProgressTracker, counting the bytes of the BAT as they are checked.
+    """
+    findings = _FindingCollector()
+    source = open_byte_source(in_path)
+    _check_headers(source, findings)
+    fallback_metas = fallback_metas or SENSIBLE_FALLBACK_METAS
+    try:
+        vhdx = VhdxFile(source)
+        is_resilient = False
+    except (VhdxError, ValueError, KeyError) as ex:
+        findings.add("open_failed", SEVERITY_ERROR, f"Could not be opened without ignore_faults: {ex}")
+        try:
+            vhdx = VhdxFile(source, ignore_faults=True, fallback_metas=fallback_metas)
+            is_resilient = True
+        except (VhdxError, ValueError, KeyError) as ex:
+            findings.add("open_failed_resilient", SEVERITY_ERROR, f"Could not be opened with ignore_faults: {ex}")
+            return VerificationReport(source.name, findings.findings, dict(findings.counts))
+
+    # the BAT is only read on first use, so a BAT region cut short by the end of the file only shows up here; the
+    # entries which are there are still checked
+    try:
+        vhdx.raw_bat
+    except (VhdxError, ValueError, OSError) as ex:
+        findings.add("bat_unreadable", SEVERITY_ERROR, f"The BAT could not be read: {ex}")
+        if is_resilient:
+            return VerificationReport(source.name, findings.findings, dict(findings.counts))
+        try:
+            vhdx = VhdxFile(source, ignore_faults=True, fallback_metas=fallback_metas)
+            vhdx.raw_bat
+        except (VhdxError, ValueError, KeyError, OSError) as ex:
+            findings.add("bat_unreadable_resilient", SEVERITY_ERROR,
+                         f"The BAT could not be read with ignore_faults: {ex}")
+            return VerificationReport(source.name, findings.findings, dict(findings.counts))
+
+    if vhdx.used_fallback_metas:
+        findings.add("fallback_metadata", SEVERITY_ERROR, "The metadata could not be read, so fallback values were used")
+    _check_regions(vhdx, findings)
+    _check_metadata(vhdx, findings)
+    tracker = ProgressTracker(progress, "verify", len(vhdx.raw_bat) * 8)
+    _check_bat(vhdx, findings, tracker)
+    _check_overlaps(vhdx, findings)
+    tracker.finish()
+    return VerificationReport(source.name, findings.findings, dict(findings.counts))
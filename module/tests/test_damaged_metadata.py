@@ -0,0 +1,103 @@
+"""
+Copyright 2019, CCL (SOLUTIONS) Group Ltd.
+
+Permission is hereby granted, free of charge, to any person obtaining a copy of this software and associated
+documentation files (the "Software"), to deal in the Software without restriction, including without limitation the
+rights to use, copy, modify, merge, publish, distribute, sublicense, and/or sell copies of the Software, and to permit
+persons to whom the Software is furnished to do so, subject to the following conditions:
+
+The above copyright notice and this permission notice shall be included in all copies or substantial portions of the
+Software.
+
+THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR IMPLIED, INCLUDING BUT NOT LIMITED TO THE
+WARRANTIES OF MERCHANTABILITY, FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE AUTHORS OR
+COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR
+OTHERWISE, ARISING FROM, OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE SOFTWARE.
+"""
+
+import pathlib
+import struct
+import tempfile
+import unittest
+
+import ccl_vhdx
+
+MB = 1 << 20
+BLOCK_COUNT = 8
+METADATA_OFFSET = 2 * MB
+BAT_OFFSET = 3 * MB
+PAYLOAD_OFFSET = 4 * MB
+
+
+def build_dynamic_vhdx(path: pathlib.Path, metadata_table: bytes):
+    """
+    Writes a dynamic VHDX with 1MB blocks and 512 byte sectors whose payload blocks are all present, one after another,
+    with metadata_table as the whole of its metadata region. Checksums are left as zero (ignore_faults doesn't check
+    them).
+    """
+    raw = bytearray(PAYLOAD_OFFSET + BLOCK_COUNT * MB)
+    raw[0:8] = b"vhdxfile"
+    for sequence_number, header_offset in enumerate((64 * 1024, 128 * 1024), 1):
+        struct.pack_into("<4sIQ16s16s16sHHIQ", raw, header_offset, b"head", 0, sequence_number, bytes(16), bytes(16),
+                         bytes(16), 0, 1, MB, MB)
+    for region_table_offset in ccl_vhdx.REGION_TABLE_OFFSETS:
+        struct.pack_into("<4sIII", raw, region_table_offset, b"regi", 0, 2, 0)
+        struct.pack_into("<16sQII", raw, region_table_offset + 16, ccl_vhdx.guid_to_blob(ccl_vhdx.REGION_GUID_BAT),
+                         BAT_OFFSET, MB, 1)
+        struct.pack_into("<16sQII", raw, region_table_offset + 48,
+                         ccl_vhdx.guid_to_blob(ccl_vhdx.REGION_GUID_METADATA), METADATA_OFFSET, MB, 1)
+    raw[METADATA_OFFSET:METADATA_OFFSET + len(metadata_table)] = metadata_table
+    for block_index in range(BLOCK_COUNT):
+        struct.pack_into("<Q", raw, BAT_OFFSET + block_index * 8,
+                         ccl_vhdx.BatPayloadBlockState.BAT_PAYLOAD_BLOCK_FULLY_PRESENT |
+                         ((PAYLOAD_OFFSET // MB + block_index) << 20))
+        raw[PAYLOAD_OFFSET + block_index * MB:PAYLOAD_OFFSET + block_index * MB + 8] = struct.pack("<Q", block_index)
+    path.write_bytes(raw)
+
+
+def make_metadata_table(entry_count: int, entries: list) -> bytes:
+    # entries are (item guid blob, offset, length)
+    table = bytearray(64 * 1024)
+    struct.pack_into("<8sHH", table, 0, ccl_vhdx.METADATA_TABLE_MAGIC, 0, entry_count)
+    for i, (item_id, offset, length) in enumerate(entries):
+        struct.pack_into("<16sIIII", table, 32 + i * 32, item_id, offset, length, 0, 0)
+    return bytes(table)
+
+
+DAMAGED_METADATA_TABLES = {
+    "unknown item id": make_metadata_table(1, [(b"\xab" * 16, 0x10000, 8)]),
+    "garbage entry count": make_metadata_table(0xffff, []) + bytes(0x1f0000),
+    "item offset off the region": make_metadata_table(
+        1, [(ccl_vhdx.guid_to_blob(ccl_vhdx.METADATA_FILE_PARAMETERS), 0xfffff000, 8)]),
+}
+
+
+class DamagedMetadataTests(unittest.TestCase):
+    def setUp(self):
+        self._temp_dir = tempfile.TemporaryDirectory()
+        self.addCleanup(self._temp_dir.cleanup)
+
+    def _build(self, name: str, metadata_table: bytes) -> pathlib.Path:
+        path = pathlib.Path(self._temp_dir.name) / f"{name.replace(' ', '_')}.vhdx"
+        build_dynamic_vhdx(path, metadata_table)
+        return path
+
+    def test_infer_geometry_for_file(self):
+        for name, metadata_table in DAMAGED_METADATA_TABLES.items():
+            with self.subTest(name):
+                inference = ccl_vhdx.infer_geometry_for_file(self._build(name, metadata_table))
+                self.assertIsNotNone(inference.best)
+                self.assertEqual(inference.best.block_size, MB)
+
+    def test_open_with_recovered_bat(self):
+        for name, metadata_table in DAMAGED_METADATA_TABLES.items():
+            with self.subTest(name):
+                vhdx = ccl_vhdx.open_with_recovered_bat(self._build(name, metadata_table))
+                self.assertTrue(vhdx.used_fallback_metas)
+                self.assertEqual(vhdx.block_size, MB)
+                for block_index in range(BLOCK_COUNT):
+                    self.assertEqual(vhdx.read(block_index * MB, 8), struct.pack("<Q", block_index))
+
+
+if __name__ == "__main__":
+    unittest.main()
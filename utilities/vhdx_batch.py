@@ -0,0 +1,93 @@
+"""
+Copyright 2019, CCL (SOLUTIONS) Group Ltd.
+
+Permission is hereby granted, free of charge, to any person obtaining a copy of this software and associated
+documentation files (the "Software"), to deal in the Software without restriction, including without limitation the
+rights to use, copy, modify, merge, publish, distribute, sublicense, and/or sell copies of the Software, and to permit
+persons to whom the Software is furnished to do so, subject to the following conditions:
+
+The above copyright notice and this permission notice shall be included in all copies or substantial portions of the
+Software.
+
+THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR IMPLIED, INCLUDING BUT NOT LIMITED TO THE
+WARRANTIES OF MERCHANTABILITY, FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE AUTHORS OR
+COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR
+OTHERWISE, ARISING FROM, OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE SOFTWARE.
+"""
+
+__version__ = "0.1.0"
+__description__ = "Reports on many VHDX files in one process, writing a JSON object per file"
+__contact__ = "Alex Caithness"
+
+import sys
+import json
+import pathlib
+import concurrent.futures
+import os
+import ccl_vhdx
+
+SUBCOMMANDS = ccl_vhdx.REPORT_KINDS + ("all",)
+
+
+def iter_paths(args):
+    for arg in args:
+        if arg.startswith("--list="):
+            list_path = arg.split("=", 1)[1]
+            with (sys.stdin if list_path == "-" else open(list_path, "r", encoding="utf-8")) as f:
+                for line in f:
+                    if line.strip():
+                        yield line.rstrip("\r\n")
+        elif not arg.startswith("-"):
+            yield arg
+
+
+def main(args):
+    subcommand = args[0]
+    if subcommand not in SUBCOMMANDS:
+        print(f"ERROR: subcommand must be one of: {', '.join(SUBCOMMANDS)}", file=sys.stderr)
+        exit(1)
+    kinds = ccl_vhdx.REPORT_KINDS if subcommand == "all" else (subcommand,)
+    workers = os.cpu_count() or 1
+    for arg in args[1:]:
+        if arg.startswith("--workers="):
+            workers = int(arg.split("=", 1)[1])
+    is_strict = "--strict" in args[1:]
+    include_map = "-m" in args[1:] or "--map" in args[1:]
+
+    # reports are written as they finish (so not necessarily in the order given), with only a bounded number of
+    # files in flight so that a long file list isn't read up front
+    with concurrent.futures.ProcessPoolExecutor(workers) as executor:
+        max_in_flight = workers * 4
+        in_flight = set()
+        for path in iter_paths(args[1:]):
+            in_flight.add(executor.submit(ccl_vhdx.build_report, path, kinds, ignore_faults=not is_strict,
+                                          include_map=include_map))
+            if len(in_flight) >= max_in_flight:
+                done, in_flight = concurrent.futures.wait(in_flight, return_when=concurrent.futures.FIRST_COMPLETED)
+                for future in done:
+                    print(json.dumps(future.result()), flush=True)
+        for future in concurrent.futures.as_completed(in_flight):
+            print(json.dumps(future.result()), flush=True)
+
+
+if __name__ == '__main__':
+    if len(sys.argv) < 3:
+        me = pathlib.Path(sys.argv[0]).name
+        print("Reports on many VHDX files in one process with a pool of workers, writing one JSON object per line for "
+              "each file as it is finished")
+        print(f"USAGE: {me} <{'|'.join(SUBCOMMANDS)}> <vhdx_file_path> ... [--list=<file>] [--workers=<count>] "
+              f"[--strict] [-m | --map]")
+        print()
+        print("header:          Header fields (as vhdx_get_header_fields.py)")
+        print("metadata:        Metadata items (as vhdx_get_metadata.py)")
+        print("region:          Region table entries (as vhdx_get_region_info.py)")
+        print("bat:             BAT summary (as vhdx_get_bat_info.py)")
+        print("all:             All of the above")
+        print("vhdx_file_path:  Path to a VHDX file (can be repeated)")
+        print("--list=:         Read paths from this file, one per line (- for stdin)")
+        print("--workers=:      Number of worker processes (default: one per CPU)")
+        print("--strict:        Don't attempt to deal with invalid/missing data")
+        print("-m | --map:      Include the allocation map in the BAT report")
+        print()
+        exit(0)
+    main(sys.argv[1:])
@@ -0,0 +1,120 @@
+"""
+Copyright 2019, CCL (SOLUTIONS) Group Ltd.
+
+Permission is hereby granted, free of charge, to any person obtaining a copy of this software and associated
+documentation files (the "Software"), to deal in the Software without restriction, including without limitation the
+rights to use, copy, modify, merge, publish, distribute, sublicense, and/or sell copies of the Software, and to permit
+persons to whom the Software is furnished to do so, subject to the following conditions:
+
+The above copyright notice and this permission notice shall be included in all copies or substantial portions of the
+Software.
+
+THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR IMPLIED, INCLUDING BUT NOT LIMITED TO THE
+WARRANTIES OF MERCHANTABILITY, FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE AUTHORS OR
+COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR
+OTHERWISE, ARISING FROM, OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE SOFTWARE.
+"""
+
+
+__version__ = "0.1.0"
+__description__ = "Exports many VHDX files and chains at once, balancing the load across the storage devices"
+__contact__ = "Alex Caithness"
+
+import sys
+import pathlib
+import ccl_vhdx
+
+
+def read_jobs(list_path):
+    # one job per line: the output path, then the VHDX file (or the chain's files, parent first), separated by tabs
+    jobs = []
+    with (sys.stdin if list_path == "-" else open(list_path, "r", encoding="utf-8")) as f:
+        for line in f:
+            fields = [x for x in line.rstrip("\r\n").split("\t") if x]
+            if not fields:
+                continue
+            if len(fields) < 2:
+                print(f"ERROR: Job line \"{line.strip()}\" needs an output path and at least one VHDX file")
+                exit(1)
+            export_format = "qcow2" if fields[0].lower().endswith(".qcow2") else "raw"
+            jobs.append(ccl_vhdx.ExportJob(tuple(fields[1:]), fields[0], export_format))
+    return jobs
+
+
+def main(args):
+    list_path = args[0]
+    jobs_per_device = ccl_vhdx.DEFAULT_JOBS_PER_DEVICE
+    workers = None
+    is_resilient = False
+    direct_io = False
+    journal = False
+    for arg in args[1:]:
+        if arg.startswith("--per-device="):
+            jobs_per_device = int(arg.split("=", 1)[1])
+        elif arg.startswith("--workers="):
+            workers = int(arg.split("=", 1)[1])
+        elif arg in ("-r", "--resilient"):
+            is_resilient = True
+        elif arg == "--direct-io":
+            direct_io = True
+        elif arg == "--journal":
+            journal = True
+        else:
+            print(f"ERROR: Unknown argument \"{arg}\".")
+            exit(1)
+
+    if list_path != "-" and not pathlib.Path(list_path).is_file():
+        print(f"ERROR: \"{list_path}\" does not exist.")
+        exit(1)
+    jobs = read_jobs(list_path)
+    for job in jobs:
+        for p in job.paths:
+            if not ccl_vhdx.location_exists(p):
+                print(f"ERROR: \"{p}\" does not exist.")
+                exit(1)
+    if not jobs:
+        print("ERROR: The job list is empty")
+        exit(1)
+
+    result = ccl_vhdx.run_export_batch(jobs, jobs_per_device=jobs_per_device, workers=workers,
+                                       ignore_faults=is_resilient, direct_io=direct_io, journal=journal,
+                                       progress=ccl_vhdx.StatusLinePrinter())
+
+    print("\t".join(["Output", "Format", "Virtual size", "Allocated", "Data written", "Seconds", "Error"]))
+    for job_result in result.job_results:
+        print("\t".join(str(x) for x in [
+            job_result.job.out_path, job_result.job.export_format, job_result.virtual_size,
+            job_result.allocated_bytes, job_result.data_bytes, f"{job_result.elapsed:.1f}", job_result.error or ""]))
+    print()
+    print("\t".join(["Device", "Jobs", "Read", "Written", "Busy seconds", "Bytes/second"]))
+    for device in result.devices:
+        print("\t".join(str(x) for x in [
+            device.device, device.job_count, device.bytes_read, device.bytes_written, f"{device.busy_seconds:.1f}",
+            f"{device.bytes_per_second:.0f}"]))
+    print()
+    print(f"{len(result.job_results)} job(s), {len(result.failed_jobs)} failed; {result.bytes_read} bytes read in "
+          f"{result.elapsed:.1f}s ({result.bytes_per_second:.0f} bytes/second)")
+    if result.failed_jobs:
+        exit(1)
+
+
+if __name__ == '__main__':
+    if len(sys.argv) < 2:
+        me = pathlib.Path(sys.argv[0]).name
+        print("Exports many VHDX files and chains in parallel, limiting how many exports use each storage device at "
+              "once and starting the largest first, then reports the throughput of each device")
+        print(f"USAGE: {me} <job_list> [--per-device=<count>] [--workers=<count>] [-r | --resilient] [--direct-io] "
+              f"[--journal]")
+        print()
+        print("job_list:             File of jobs (- for stdin), one per line: the output path then the VHDX file, or")
+        print("                      the chain's files parent first, separated by tabs. Outputs ending .qcow2 are")
+        print("                      written as qcow2 images, anything else as raw images")
+        print(f"--per-device=:        Exports using each device at once "
+              f"(default {ccl_vhdx.DEFAULT_JOBS_PER_DEVICE})")
+        print("--workers=:           Number of worker processes (default: as many as can run, up to one per CPU)")
+        print("-r | --resilient:     Attempt to deal with invalid/missing data")
+        print("--direct-io:          Read the VHDX files without filling the page cache (O_DIRECT where supported)")
+        print("--journal:            Journal raw exports, resuming any left over from an interrupted run")
+        print()
+        exit(0)
+    main(sys.argv[1:])
@@ -0,0 +1,48 @@
+"""
+Copyright 2019, CCL (SOLUTIONS) Group Ltd.
+
+Permission is hereby granted, free of charge, to any person obtaining a copy of this software and associated
+documentation files (the "Software"), to deal in the Software without restriction, including without limitation the
+rights to use, copy, modify, merge, publish, distribute, sublicense, and/or sell copies of the Software, and to permit
+persons to whom the Software is furnished to do so, subject to the following conditions:
+
+The above copyright notice and this permission notice shall be included in all copies or substantial portions of the
+Software.
+
+THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR IMPLIED, INCLUDING BUT NOT LIMITED TO THE
+WARRANTIES OF MERCHANTABILITY, FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE AUTHORS OR
+COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR
+OTHERWISE, ARISING FROM, OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE SOFTWARE.
+"""
+
+__version__ = "0.1.0"
+__description__ = "Writes sidecar index files so that VHDX files can be reopened without re-reading the BAT"
+__contact__ = "Alex Caithness"
+
+import sys
+import pathlib
+import ccl_vhdx
+
+
+def main(args):
+    for arg in args:
+        in_path = arg
+        vhdx = ccl_vhdx.VhdxFile(in_path)
+        if ccl_vhdx.load_sidecar_index(vhdx):
+            print(f"{in_path}\tindex is current")
+            continue
+        index_path = ccl_vhdx.write_sidecar_index(vhdx)
+        print(f"{in_path}\tindex written to {index_path}")
+
+
+if __name__ == '__main__':
+    if len(sys.argv) < 2:
+        me = pathlib.Path(sys.argv[0]).name
+        print("Writes a sidecar index (the BAT, allocated sector runs and geometry) alongside each VHDX file")
+        print(f"USAGE: {me} <vhdx_file_path> [vhdx_file_path ...]")
+        print()
+        print("vhdx_file_path: Path to a VHDX file; the index is written to the same path with "
+              f"{ccl_vhdx.SIDECAR_SUFFIX} appended")
+        print()
+        exit(0)
+    main(sys.argv[1:])
@@ -0,0 +1,100 @@
+"""
+Copyright 2019, CCL (SOLUTIONS) Group Ltd.
+
+Permission is hereby granted, free of charge, to any person obtaining a copy of this software and associated
+documentation files (the "Software"), to deal in the Software without restriction, including without limitation the
+rights to use, copy, modify, merge, publish, distribute, sublicense, and/or sell copies of the Software, and to permit
+persons to whom the Software is furnished to do so, subject to the following conditions:
+
+The above copyright notice and this permission notice shall be included in all copies or substantial portions of the
+Software.
+
+THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR IMPLIED, INCLUDING BUT NOT LIMITED TO THE
+WARRANTIES OF MERCHANTABILITY, FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE AUTHORS OR
+COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR
+OTHERWISE, ARISING FROM, OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE SOFTWARE.
+"""
+
+__version__ = "0.1.0"
+__description__ = "Lists the ranges of a virtual disk which changed between two VHDX files or chains, or between " \
+                  "the layers of a chain, from the BATs and sector bitmaps"
+__contact__ = "Alex Caithness"
+
+import sys
+import pathlib
+import ccl_vhdx
+
+
+def open_disk(paths, is_resilient):
+    fallback_metas = ccl_vhdx.SENSIBLE_FALLBACK_METAS if is_resilient else None
+    if len(paths) == 1:
+        return ccl_vhdx.VhdxFile(paths[0], ignore_faults=is_resilient, fallback_metas=fallback_metas)
+    return ccl_vhdx.VhdxChain.from_paths(paths, ignore_faults=is_resilient, fallback_metas=fallback_metas)
+
+
+def print_ranges(changed):
+    print("\t".join(["Offset", "Length", "End"]))
+    for changed_range in changed:
+        print("\t".join(str(x) for x in [changed_range.offset, changed_range.length, changed_range.end]))
+    print()
+    print(f"{len(changed)} ranges; {sum(x.length for x in changed)} bytes")
+    print()
+
+
+def main(args):
+    confirm = False
+    is_resilient = False
+    old_paths = []
+    new_paths = []
+    paths = old_paths
+    for arg in args:
+        if arg == "--new":
+            paths = new_paths
+        elif arg == "--confirm":
+            confirm = True
+        elif arg in ("-r", "--resilient"):
+            is_resilient = True
+        else:
+            paths.append(arg)
+
+    for p in old_paths + new_paths:
+        if not ccl_vhdx.location_exists(p):
+            print(f"ERROR: \"{p}\" does not exist.")
+            exit(1)
+    if not old_paths:
+        print("ERROR: no VHDX files given")
+        exit(1)
+
+    if not new_paths:
+        chain = ccl_vhdx.VhdxChain.from_paths(
+            old_paths, ignore_faults=is_resilient,
+            fallback_metas=ccl_vhdx.SENSIBLE_FALLBACK_METAS if is_resilient else None)
+        for layer, changed in ccl_vhdx.diff_layers(chain, confirm=confirm):
+            print(layer.file_path)
+            print_ranges(changed)
+        return
+
+    old = open_disk(old_paths, is_resilient)
+    new = open_disk(new_paths, is_resilient)
+    print(f"Old: {', '.join(str(x) for x in old_paths)}")
+    print(f"New: {', '.join(str(x) for x in new_paths)}")
+    print()
+    print_ranges(ccl_vhdx.diff_disks(old, new, confirm=confirm))
+
+
+if __name__ == '__main__':
+    if len(sys.argv) < 2:
+        me = pathlib.Path(sys.argv[0]).name
+        print("Lists the ranges of a virtual disk which changed between two VHDX files (or chains), or which each "
+              "differencing layer of a chain changes, reading only the BATs and sector bitmaps")
+        print(f"USAGE: {me} <vhdx_file 1> [vhdx_file 2] ... [--new <vhdx_file 1> [vhdx_file 2] ...] [--confirm] "
+              f"[-r | --resilient]")
+        print()
+        print("vhdx_file:        One or more VHDX files, ordered parent first. Without --new, the changes made by each")
+        print("                  differencing file in the chain are listed")
+        print("--new:            The VHDX files which follow are the newer disk to compare against")
+        print("--confirm:        Read the candidate ranges and only list the sectors which actually differ")
+        print("-r | --resilient: Attempt to deal with invalid/missing data")
+        print()
+        exit(0)
+    main(sys.argv[1:])
@@ -27,16 +27,44 @@ import ccl_vhdx
 
 
 def main(args):
-    in_file_path = pathlib.Path(args[0])
+    in_file_path = args[0]
     out_dir_path = pathlib.Path(args[1])
     single_image = "-s" in args[2:] or "--single-image" in args[2:]
     is_resilient_mode = "-r" in args[2:] or "--resilient" in args[2:]
     is_differencing = "-d" in args[2:] or "--is-differencing" in args[2:]
+    direct_io = "--direct-io" in args[2:]
+    partition_index = None
+    compression_format = None
+    for arg in args[2:]:
+        if arg.startswith("--partition="):
+            partition_index = int(arg.split("=", 1)[1])
+        elif arg.startswith("--compress="):
+            compression_format = arg.split("=", 1)[1]
+            if compression_format not in ccl_vhdx.COMPRESSION_FORMATS:
+                print(f"ERROR: Unknown compression format \"{compression_format}\".")
+                exit(1)
+    extension = {None: "", "gzip": ".gz", "xz": ".xz"}[compression_format]
 
     default_metas = dict(ccl_vhdx.SENSIBLE_FALLBACK_METAS)
     default_metas["HasParent"] = is_differencing
 
-    vhdx = ccl_vhdx.VhdxFile(in_file_path, ignore_faults=is_resilient_mode, fallback_metas=default_metas)
+    vhdx = ccl_vhdx.VhdxFile(in_file_path, ignore_faults=is_resilient_mode, fallback_metas=default_metas,
+                             direct_io=direct_io)
+
+    first_sector = 0
+    sector_count = vhdx.metas["VirtualDiskSize"] // vhdx.metas["LogicalSectorSize"]
+    if partition_index is not None:
+        try:
+            partition = ccl_vhdx.read_partition_table(vhdx)[partition_index]
+        except (KeyError, ccl_vhdx.VhdxPartitionError):
+            print(f"ERROR: Partition {partition_index} could not be found.")
+            exit(1)
+        if partition.offset + partition.length > vhdx.virtual_disk_size:
+            print(f"ERROR: Partition {partition_index} runs past the end of the virtual disk "
+                  f"({partition.offset + partition.length} > {vhdx.virtual_disk_size}).")
+            exit(1)
+        first_sector = partition.offset // vhdx.logical_sector_size
+        sector_count = partition.length // vhdx.logical_sector_size
 
     if out_dir_path.is_dir():
         print(f"ERROR: {out_dir_path} already exists")
@@ -44,18 +72,48 @@ def main(args):
 
     out = None
     if single_image:
-        out = (out_dir_path / "vhdx_dump_000000000000.bin").open("wb")
+        out = ccl_vhdx.open_export_output(
+            out_dir_path / f"vhdx_dump_000000000000.bin{extension}", compression_format, overwrite=True)
 
-    sector_count = vhdx.metas["VirtualDiskSize"] // vhdx.metas["LogicalSectorSize"]
-    for sector in range(sector_count):
-        if vhdx.is_sector_allocated(sector) or single_image:
-            if out is None:
-                out = (out_dir_path / f"vhdx_dump_{sector:012}").open("wb")
-            out.write(vhdx.get_sector(sector))
-        else:
-            if out is not None:
-                out.close()
-                out = None
+    sector_size = vhdx.logical_sector_size
+    expected_bytes = None if single_image else \
+        ccl_vhdx.count_allocated_bytes(vhdx, first_sector * sector_size, sector_count * sector_size)
+    tracker = ccl_vhdx.ProgressTracker(
+        ccl_vhdx.StatusLinePrinter(), "dump", sector_count * sector_size, expected_bytes)
+
+    # each run of allocated sectors is read in large pieces (so that --direct-io applies) and goes to its own file
+    end_sector = first_sector + sector_count
+    if single_image:
+        runs = [(first_sector, sector_count)]
+    else:
+        runs = ((max(first, first_sector), min(first + count, end_sector) - max(first, first_sector))
+                for first, count in vhdx.iter_allocated_sector_runs()
+                if first < end_sector and first + count > first_sector)
+
+    buffer = memoryview(bytearray(min(ccl_vhdx.BULK_READ_SIZE, sector_count * sector_size)))
+    sector = first_sector
+    for run_first, run_count in runs:
+        tracker.advance(skipped=(run_first - sector) * sector_size)
+        if out is None:
+            out = ccl_vhdx.open_export_output(
+                out_dir_path / f"vhdx_dump_{run_first:012}{extension}", compression_format, overwrite=True)
+        position = run_first * sector_size
+        run_end = (run_first + run_count) * sector_size
+        while position < run_end:
+            view = buffer[:min(len(buffer), run_end - position)]
+            vhdx.readinto(view, position)
+            out.write(view)
+            tracker.advance(processed=len(view))
+            position += len(view)
+        if not single_image:
+            out.close()
+            out = None
+        sector = run_first + run_count
+    tracker.advance(skipped=(end_sector - sector) * sector_size)
+
+    if out is not None:
+        out.close()
+    tracker.finish()
 
 
 if __name__ == '__main__':
@@ -63,13 +121,17 @@ if __name__ == '__main__':
         me = pathlib.Path(sys.argv[0]).name
         print("Dumps allocated space in the VHDX to files")
         print(f"USAGE: {me} <vhdx_file_path>  <out_dir> [-s | --single-image] "
-              f"[-r | --resilient] [-d | --is-differencing]")
+              f"[-r | --resilient] [-d | --is-differencing] [--partition=<index>] [--compress=<gzip|xz>] "
+              f"[--direct-io]")
         print()
         print("vhdx_file_path:         Path to the VHDX file")
         print("out_dir:                Path to output directory (cannot already exist)")
         print("-s | --single-image:    Dump data to a single (potentially sparse) file")
         print("-r | --resilient:       Attempt to deal with invalid/missing data")
         print("-d | --is-differencing: Input file is a differencing VHDX")
+        print("--partition=:           Only dump this partition (see vhdx_list_partitions.py for the indices)")
+        print("--compress=:            Compress the output files (gzip or xz) in parallel as they are written")
+        print("--direct-io:            Read the VHDX file without filling the page cache (O_DIRECT where supported)")
         print()
         exit(0)
     main(sys.argv[1:])
@@ -29,17 +29,46 @@ import ccl_vhdx
 def main(args):
     out_path = pathlib.Path(args[0])
     is_resilient = True
+    partition_index = None
+    compression_format = None
+    write_index = False
+    direct_io = False
+    resume = False
+    vhdx_args = []
+    for arg in args[1:]:
+        if arg.startswith("--partition="):
+            partition_index = int(arg.split("=", 1)[1])
+        elif arg.startswith("--compress="):
+            compression_format = arg.split("=", 1)[1]
+            if compression_format not in ccl_vhdx.COMPRESSION_FORMATS:
+                print(f"ERROR: Unknown compression format \"{compression_format}\".")
+                exit(1)
+        elif arg == "--index":
+            write_index = True
+        elif arg == "--direct-io":
+            direct_io = True
+        elif arg == "--resume":
+            resume = True
+        else:
+            vhdx_args.append(arg)
+
+    if resume and compression_format is not None:
+        print("ERROR: Compressed output can't be resumed.")
+        exit(1)
+    if out_path.exists() and not resume:
+        print(f"ERROR: \"{out_path}\" already exists (use --resume to continue an interrupted dump).")
+        exit(1)
 
     virtual_disks = []
-    for i, p in enumerate(args[1:]):
+    for i, p in enumerate(vhdx_args):
         fallback_meta = dict(ccl_vhdx.SENSIBLE_FALLBACK_METAS)
         fallback_meta["HasParent"] = i != 0
-        vhdx_path = pathlib.Path(p)
-        if not vhdx_path.is_file():
+        vhdx_path = p
+        if not ccl_vhdx.location_exists(vhdx_path):
             print(f"ERROR: \"{p}\" does not exist.")
             exit(1)
 
-        v = ccl_vhdx.VhdxFile(vhdx_path, ignore_faults=is_resilient, fallback_metas=fallback_meta)
+        v = ccl_vhdx.VhdxFile(vhdx_path, ignore_faults=is_resilient, fallback_metas=fallback_meta, direct_io=direct_io)
         if i == 0 and v.metas["HasParent"]:
             print("ERROR: The first VHDX cannot be differencing.")
             exit(1)
@@ -48,20 +77,32 @@ def main(args):
 
     if not virtual_disks:
         print("ERROR: You must provide at least one VHDX file as input")
+        exit(1)
+
+    # sizes are taken from the base vhdx
+    chain = ccl_vhdx.VhdxChain(virtual_disks)
+    offset, length = 0, chain.virtual_disk_size
+    if partition_index is not None:
+        try:
+            partition = ccl_vhdx.read_partition_table(chain)[partition_index]
+        except (KeyError, ccl_vhdx.VhdxPartitionError):
+            print(f"ERROR: Partition {partition_index} could not be found.")
+            exit(1)
+        if partition.offset + partition.length > chain.virtual_disk_size:
+            print(f"ERROR: Partition {partition_index} runs past the end of the virtual disk "
+                  f"({partition.offset + partition.length} > {chain.virtual_disk_size}).")
+            exit(1)
+        offset, length = partition.offset, partition.length
 
-    # we take the sector count from the base vhdx
-    sector_count = virtual_disks[0].virtual_disk_size // virtual_disks[0].logical_sector_size
-
-    with out_path.open("xb") as out:
-        for sector_number in range(sector_count):
-            allocated_vhdx = None
-            for i in range(len(virtual_disks) - 1, -1, -1):
-                if virtual_disks[i].is_sector_allocated(sector_number):
-                    allocated_vhdx = virtual_disks[i]
-                    break
-            if allocated_vhdx is None:
-                raise ValueError(f"No disk was allocated for sector {sector_number}")  # should be impossible
-            out.write(allocated_vhdx.get_sector(sector_number))
+    # uncompressed dumps keep a journal of what has been written so that they can be resumed
+    try:
+        ccl_vhdx.export_to_path(chain, out_path, offset, length,
+                                compression_format=compression_format, write_index=write_index,
+                                progress=ccl_vhdx.StatusLinePrinter(), journal=compression_format is None,
+                                resume=resume)
+    except ccl_vhdx.ExportJournalError as ex:
+        print(f"ERROR: {ex}")
+        exit(1)
 
 
 if __name__ == '__main__':
@@ -69,10 +110,16 @@ if __name__ == '__main__':
         me = pathlib.Path(sys.argv[0]).name
         print("Dumps allocated data from a chain of VHDX files into an image file, attempting to deal with missing/"
               "invalid data")
-        print(f"USAGE: {me} <out_file_path> [vhdx_file 1] [vhdx_file 2] ...")
+        print(f"USAGE: {me} <out_file_path> [vhdx_file 1] [vhdx_file 2] ... [--partition=<index>] "
+              f"[--compress=<gzip|xz> [--index]] [--direct-io] [--resume]")
         print()
-        print("out_file_path: Output file (cannot already exist)")
+        print("out_file_path: Output file (cannot already exist, unless resuming)")
         print("vhdx_file:     One or more VHDX files, ordered parent first")
+        print("--partition=:  Only dump this partition (see vhdx_list_partitions.py for the indices)")
+        print("--compress=:   Compress the output (gzip or xz) in parallel as it is written")
+        print("--index:       Write a member index alongside compressed output (<out_file_path>.idx.json)")
+        print("--resume:      Continue an interrupted uncompressed dump from its journal (<out_file_path>.journal)")
+        print("--direct-io:   Read the VHDX files without filling the page cache (O_DIRECT where supported)")
         print()
         exit(0)
     main(sys.argv[1:])
@@ -23,14 +23,54 @@ import sys
 import pathlib
 import ccl_vhdx
 
-# TODO: define a way for providing fallback metas and possibly the BAT offset?
+# TODO: define a way for providing fallback metas
+
+REGION_ALIGNMENT = 1 << 20
+
+
+def get_default_bat_length(in_path, bat_offset):
+    # the length the disk's metadata calls for, rounded up to the region alignment; failing that (if the metadata
+    # can't be read), the length of a BAT found at this offset by scanning the file
+    vhdx = ccl_vhdx.VhdxFile(in_path, ignore_faults=True, fallback_metas=ccl_vhdx.SENSIBLE_FALLBACK_METAS,
+                             bat_region=(bat_offset, 0))
+    if not vhdx.used_fallback_metas:
+        return -(-(vhdx.bat_entry_count * 8) // REGION_ALIGNMENT) * REGION_ALIGNMENT
+    for candidate in ccl_vhdx.locate_bat_candidates(in_path):
+        if candidate.offset == bat_offset:
+            return candidate.length
+    return None
 
 
 def main(args):
-    in_path = pathlib.Path(args[0])
+    in_path = args[0]
+    bat_offset = None
+    bat_length = None
+    for arg in args[1:]:
+        if arg.startswith("--bat-offset="):
+            bat_offset = int(arg[len("--bat-offset="):], 0)
+        elif arg.startswith("--bat-length="):
+            bat_length = int(arg[len("--bat-length="):], 0)
     print(in_path)
 
-    vhdx = ccl_vhdx.VhdxFile(in_path, ignore_faults=True, fallback_metas=ccl_vhdx.SENSIBLE_FALLBACK_METAS)
+    if bat_offset is not None:
+        if bat_length is None:
+            bat_length = get_default_bat_length(in_path, bat_offset)
+            if bat_length is None:
+                print("ERROR: the BAT length could not be worked out, provide it with --bat-length")
+                exit(1)
+        bat_region = (bat_offset, bat_length)
+    elif "--locate" in args[1:]:
+        candidates = ccl_vhdx.locate_bat_candidates(in_path)
+        if not candidates:
+            print("ERROR: no plausible BAT found")
+            exit(1)
+        print(f"Using located BAT candidate: {candidates[0]}")
+        bat_region = (candidates[0].offset, candidates[0].length)
+    else:
+        bat_region = None
+
+    vhdx = ccl_vhdx.VhdxFile(in_path, ignore_faults=True, fallback_metas=ccl_vhdx.SENSIBLE_FALLBACK_METAS,
+                             bat_region=bat_region)
     bat_offset = vhdx.region_table[ccl_vhdx.guid_to_blob(ccl_vhdx.REGION_GUID_BAT)].offset
     bat_length = vhdx.region_table[ccl_vhdx.guid_to_blob(ccl_vhdx.REGION_GUID_BAT)].length
 
@@ -65,10 +105,14 @@ if __name__ == '__main__':
     if len(sys.argv) < 2:
         me = pathlib.Path(sys.argv[0]).name
         print("Gets information about the BAT, optionally printing an allocation map")
-        print(f"USAGE: {me} <vhdx_file_path> [-m | --map]")
+        print(f"USAGE: {me} <vhdx_file_path> [-m | --map] [--bat-offset=offset [--bat-length=length] | --locate]")
         print()
-        print("vhdx_file_path: Path to the VHDX file")
-        print("-m | --map:     Print an allocation map")
+        print("vhdx_file_path:        Path to the VHDX file")
+        print("-m | --map:            Print an allocation map")
+        print("--bat-offset=offset:   Read the BAT from this file offset rather than the one in the region table")
+        print("--bat-length=length:   Length of the BAT given by --bat-offset (default: what the disk's metadata "
+              "calls for)")
+        print("--locate:              Scan the file for the BAT rather than using the region table")
         print()
         exit(0)
 
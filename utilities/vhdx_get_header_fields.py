@@ -28,7 +28,7 @@ import ccl_vhdx
 
 
 def main(args):
-    in_path = pathlib.Path(args[0])
+    in_path = args[0]
     print(in_path)
 
     try:
@@ -40,7 +40,7 @@ def print_metas(metas):
 
 
 def main(args):
-    in_path = pathlib.Path(args[0])
+    in_path = args[0]
     print(in_path)
 
     metas = None
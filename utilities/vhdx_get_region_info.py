@@ -29,7 +29,7 @@ import ccl_vhdx
 
 
 def main(args):
-    in_path = pathlib.Path(args[0])
+    in_path = args[0]
     print(in_path)
 
     vhdx = None
@@ -0,0 +1,88 @@
+"""
+Copyright 2019, CCL (SOLUTIONS) Group Ltd.
+
+Permission is hereby granted, free of charge, to any person obtaining a copy of this software and associated
+documentation files (the "Software"), to deal in the Software without restriction, including without limitation the
+rights to use, copy, modify, merge, publish, distribute, sublicense, and/or sell copies of the Software, and to permit
+persons to whom the Software is furnished to do so, subject to the following conditions:
+
+The above copyright notice and this permission notice shall be included in all copies or substantial portions of the
+Software.
+
+THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR IMPLIED, INCLUDING BUT NOT LIMITED TO THE
+WARRANTIES OF MERCHANTABILITY, FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE AUTHORS OR
+COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR
+OTHERWISE, ARISING FROM, OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE SOFTWARE.
+"""
+
+__version__ = "0.1.0"
+__description__ = "Hashes the virtual disk of a VHDX file or chain of differencing VHDX files in a single pass"
+__contact__ = "Alex Caithness"
+
+import sys
+import pathlib
+import ccl_vhdx
+
+
+def main(args):
+    algorithms = ccl_vhdx.DEFAULT_HASH_ALGORITHMS
+    piece_size = None
+    is_resilient = False
+    direct_io = False
+    paths = []
+    for arg in args:
+        if arg.startswith("--algorithms="):
+            algorithms = tuple(x.strip() for x in arg.split("=", 1)[1].split(",") if x.strip())
+        elif arg.startswith("--piecewise="):
+            piece_size = int(arg.split("=", 1)[1])
+        elif arg in ("-r", "--resilient"):
+            is_resilient = True
+        elif arg == "--direct-io":
+            direct_io = True
+        else:
+            paths.append(arg)
+
+    for p in paths:
+        if not ccl_vhdx.location_exists(p):
+            print(f"ERROR: \"{p}\" does not exist.")
+            exit(1)
+
+    fallback_metas = ccl_vhdx.SENSIBLE_FALLBACK_METAS if is_resilient else None
+    if len(paths) == 1:
+        disk = ccl_vhdx.VhdxFile(paths[0], ignore_faults=is_resilient, fallback_metas=fallback_metas,
+                                 direct_io=direct_io)
+    else:
+        disk = ccl_vhdx.VhdxChain.from_paths(paths, ignore_faults=is_resilient, fallback_metas=fallback_metas,
+                                             direct_io=direct_io)
+
+    result = ccl_vhdx.hash_virtual_disk(disk, algorithms, piece_size=piece_size,
+                                        progress=ccl_vhdx.StatusLinePrinter())
+
+    for p in paths:
+        print(p)
+    print(f"Bytes hashed: {result.bytes_hashed} ({result.sparse_bytes} sparse; {result.zero_bytes} allocated zeros)")
+    for name, digest in result.digests.items():
+        print(f"{name}: {digest}")
+    if result.pieces is not None:
+        print()
+        print(f"Piecewise ({result.piece_algorithm}):")
+        for offset, length, digest in result.pieces:
+            print(f"{offset}\t{length}\t{digest}")
+    print()
+
+
+if __name__ == '__main__':
+    if len(sys.argv) < 2:
+        me = pathlib.Path(sys.argv[0]).name
+        print("Hashes the virtual disk of a VHDX file (or chain of VHDX files) in a single pass")
+        print(f"USAGE: {me} <vhdx_file 1> [vhdx_file 2] ... [--algorithms=md5,sha1,sha256] [--piecewise=<bytes>] "
+              f"[-r | --resilient] [--direct-io]")
+        print()
+        print("vhdx_file:            One or more VHDX files, ordered parent first")
+        print("--algorithms=:        Comma separated hashlib algorithm names (default: md5,sha1,sha256)")
+        print("--piecewise=:         Also produce md5 hashes of each piece of this many bytes")
+        print("-r | --resilient:     Attempt to deal with invalid/missing data")
+        print("--direct-io:          Read the VHDX files without filling the page cache (O_DIRECT where supported)")
+        print()
+        exit(0)
+    main(sys.argv[1:])
@@ -0,0 +1,79 @@
+"""
+Copyright 2019, CCL (SOLUTIONS) Group Ltd.
+
+Permission is hereby granted, free of charge, to any person obtaining a copy of this software and associated
+documentation files (the "Software"), to deal in the Software without restriction, including without limitation the
+rights to use, copy, modify, merge, publish, distribute, sublicense, and/or sell copies of the Software, and to permit
+persons to whom the Software is furnished to do so, subject to the following conditions:
+
+The above copyright notice and this permission notice shall be included in all copies or substantial portions of the
+Software.
+
+THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR IMPLIED, INCLUDING BUT NOT LIMITED TO THE
+WARRANTIES OF MERCHANTABILITY, FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE AUTHORS OR
+COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR
+OTHERWISE, ARISING FROM, OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE SOFTWARE.
+"""
+
+__version__ = "0.1.0"
+__description__ = "Infers the block size, logical sector size and differencing state of a VHDX file from its BAT"
+__contact__ = "Alex Caithness"
+
+import sys
+import pathlib
+import ccl_vhdx
+
+
+def main(args):
+    in_path = args[0]
+    bat_region = None
+    candidate_limit = 5
+    for arg in args[1:]:
+        if arg.startswith("--limit="):
+            candidate_limit = int(arg[len("--limit="):])
+    if "--locate" in args[1:]:
+        candidates = ccl_vhdx.locate_bat_candidates(in_path)
+        if not candidates:
+            print("ERROR: no plausible BAT found")
+            exit(1)
+        bat_region = (candidates[0].offset, candidates[0].length)
+    print(in_path)
+
+    inference = ccl_vhdx.infer_geometry_for_file(in_path, bat_region=bat_region)
+    best = inference.best
+    if best is None:
+        print("ERROR: the BAT does not fit any geometry")
+        exit(1)
+
+    print(f"BlockSize: {best.block_size}")
+    print(f"LogicalSectorSize: {best.logical_sector_size}")
+    print(f"HasParent: {best.has_parent}")
+    print(f"Chunk ratio: {best.chunk_ratio}")
+    print(f"Score: {best.score:.3f}")
+    print(f"Confidence: {inference.confidence:.3f}")
+    print()
+    print("\t".join(["BlockSize", "LogicalSectorSize", "HasParent", "Score", "No Overlap", "Spacing", "Tight",
+                     "In File", "Sector Bitmap Fit", "Sector Bitmap Evidence"]))
+    for candidate in inference.candidates[:candidate_limit]:
+        print("\t".join(str(x) for x in [
+            candidate.block_size, candidate.logical_sector_size, candidate.has_parent, f"{candidate.score:.3f}",
+            f"{candidate.no_overlap_fraction:.3f}", f"{candidate.spacing_fraction:.3f}",
+            f"{candidate.tight_fraction:.3f}", f"{candidate.in_file_fraction:.3f}",
+            "?" if candidate.sector_bitmap_consistency is None else f"{candidate.sector_bitmap_consistency:.3f}",
+            candidate.sector_bitmap_evidence]))
+    print()
+
+
+if __name__ == '__main__':
+    if len(sys.argv) < 2:
+        me = pathlib.Path(sys.argv[0]).name
+        print("Infers the geometry of a VHDX file (block size, logical sector size and whether it has a parent) from "
+              "its BAT, for when the metadata is missing or damaged")
+        print(f"USAGE: {me} <vhdx_file_path> [--locate] [--limit=count]")
+        print()
+        print("vhdx_file_path: Path to the VHDX file")
+        print("--locate:       Scan the file for the BAT rather than using the region table")
+        print("--limit=count:  Number of candidate geometries to list, best first (default: 5)")
+        print()
+        exit(0)
+    main(sys.argv[1:])
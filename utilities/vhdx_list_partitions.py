@@ -0,0 +1,73 @@
+"""
+Copyright 2019, CCL (SOLUTIONS) Group Ltd.
+
+Permission is hereby granted, free of charge, to any person obtaining a copy of this software and associated
+documentation files (the "Software"), to deal in the Software without restriction, including without limitation the
+rights to use, copy, modify, merge, publish, distribute, sublicense, and/or sell copies of the Software, and to permit
+persons to whom the Software is furnished to do so, subject to the following conditions:
+
+The above copyright notice and this permission notice shall be included in all copies or substantial portions of the
+Software.
+
+THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR IMPLIED, INCLUDING BUT NOT LIMITED TO THE
+WARRANTIES OF MERCHANTABILITY, FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE AUTHORS OR
+COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR
+OTHERWISE, ARISING FROM, OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE SOFTWARE.
+"""
+
+__version__ = "0.1.0"
+__description__ = "Lists the partitions (MBR or GPT) on the virtual disk of a VHDX file or chain of VHDX files"
+__contact__ = "Alex Caithness"
+
+import sys
+import pathlib
+import ccl_vhdx
+
+
+def main(args):
+    is_resilient = "-r" in args or "--resilient" in args
+    paths = [arg for arg in args if arg not in ("-r", "--resilient")]
+    for p in paths:
+        if not ccl_vhdx.location_exists(p):
+            print(f"ERROR: \"{p}\" does not exist.")
+            exit(1)
+
+    fallback_metas = ccl_vhdx.SENSIBLE_FALLBACK_METAS if is_resilient else None
+    if len(paths) == 1:
+        disk = ccl_vhdx.VhdxFile(paths[0], ignore_faults=is_resilient, fallback_metas=fallback_metas)
+    else:
+        disk = ccl_vhdx.VhdxChain.from_paths(paths, ignore_faults=is_resilient, fallback_metas=fallback_metas)
+
+    for p in paths:
+        print(p)
+
+    try:
+        table = ccl_vhdx.read_partition_table(disk)
+    except ccl_vhdx.VhdxPartitionError as e:
+        print(f"ERROR: {e}")
+        exit(1)
+
+    print(f"Partition scheme: {table.scheme}")
+    if table.disk_guid:
+        print(f"Disk GUID: {table.disk_guid}")
+    if table.used_backup_gpt:
+        print("WARNING: Primary GPT was damaged, the backup GPT was used")
+    print()
+    print("\t".join(["Index", "Offset", "Length", "Type", "Name"]))
+    for partition in table:
+        print("\t".join(str(x) for x in [
+            partition.index, partition.offset, partition.length, partition.type_description, partition.name]))
+    print()
+
+
+if __name__ == '__main__':
+    if len(sys.argv) < 2:
+        me = pathlib.Path(sys.argv[0]).name
+        print("Lists the partitions on the virtual disk of a VHDX file (or chain of VHDX files)")
+        print(f"USAGE: {me} <vhdx_file 1> [vhdx_file 2] ... [-r | --resilient]")
+        print()
+        print("vhdx_file:        One or more VHDX files, ordered parent first")
+        print("-r | --resilient: Attempt to deal with invalid/missing data")
+        print()
+        exit(0)
+    main(sys.argv[1:])
@@ -0,0 +1,63 @@
+"""
+Copyright 2019, CCL (SOLUTIONS) Group Ltd.
+
+Permission is hereby granted, free of charge, to any person obtaining a copy of this software and associated
+documentation files (the "Software"), to deal in the Software without restriction, including without limitation the
+rights to use, copy, modify, merge, publish, distribute, sublicense, and/or sell copies of the Software, and to permit
+persons to whom the Software is furnished to do so, subject to the following conditions:
+
+The above copyright notice and this permission notice shall be included in all copies or substantial portions of the
+Software.
+
+THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR IMPLIED, INCLUDING BUT NOT LIMITED TO THE
+WARRANTIES OF MERCHANTABILITY, FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE AUTHORS OR
+COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR
+OTHERWISE, ARISING FROM, OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE SOFTWARE.
+"""
+
+__version__ = "0.1.0"
+__description__ = "Scans a VHDX file with damaged region tables for areas which look like the BAT"
+__contact__ = "Alex Caithness"
+
+import sys
+import pathlib
+import ccl_vhdx
+
+
+def main(args):
+    in_path = args[0]
+    candidate_limit = 10
+    for arg in args[1:]:
+        if arg.startswith("--limit="):
+            candidate_limit = int(arg[len("--limit="):])
+    print(in_path)
+
+    candidates = ccl_vhdx.locate_bat_candidates(in_path, progress=ccl_vhdx.StatusLinePrinter())
+    print(f"BAT candidates found: {len(candidates)}")
+    print()
+    print("\t".join(["Offset", "Length", "Score", "Non-Zero Entries", "In File", "Unique", "Chunk Ratio"]))
+    for candidate in candidates[:candidate_limit]:
+        print("\t".join(str(x) for x in [
+            candidate.offset, candidate.length, f"{candidate.score:.3f}", candidate.nonzero_entry_count,
+            f"{candidate.in_file_fraction:.3f}", f"{candidate.unique_fraction:.3f}",
+            "?" if candidate.chunk_ratio is None else candidate.chunk_ratio]))
+    print()
+
+    if candidates:
+        best = candidates[0]
+        print("To read the file using the best candidate:")
+        print(f"  vhdx_get_bat_info.py \"{in_path}\" --bat-offset={best.offset} --bat-length={best.length}")
+        print()
+
+
+if __name__ == '__main__':
+    if len(sys.argv) < 2:
+        me = pathlib.Path(sys.argv[0]).name
+        print("Scans a VHDX file for areas which look like the BAT, for when the region tables are damaged")
+        print(f"USAGE: {me} <vhdx_file_path> [--limit=count]")
+        print()
+        print("vhdx_file_path: Path to the VHDX file")
+        print("--limit=count:  Number of candidates to list, best first (default: 10)")
+        print()
+        exit(0)
+    main(sys.argv[1:])
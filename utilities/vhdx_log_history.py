@@ -0,0 +1,114 @@
+"""
+Copyright 2019, CCL (SOLUTIONS) Group Ltd.
+
+Permission is hereby granted, free of charge, to any person obtaining a copy of this software and associated
+documentation files (the "Software"), to deal in the Software without restriction, including without limitation the
+rights to use, copy, modify, merge, publish, distribute, sublicense, and/or sell copies of the Software, and to permit
+persons to whom the Software is furnished to do so, subject to the following conditions:
+
+The above copyright notice and this permission notice shall be included in all copies or substantial portions of the
+Software.
+
+THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR IMPLIED, INCLUDING BUT NOT LIMITED TO THE
+WARRANTIES OF MERCHANTABILITY, FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE AUTHORS OR
+COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR
+OTHERWISE, ARISING FROM, OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE SOFTWARE.
+"""
+
+
+__version__ = "0.1.0"
+__description__ = "Lists the entries in the log of a VHDX file and recovers earlier versions of the data they wrote"
+__contact__ = "Alex Caithness"
+
+import sys
+import pathlib
+import ccl_vhdx
+
+
+def main(args):
+    offset = None
+    length = None
+    out_dir = None
+    is_resilient = False
+    paths = []
+    for arg in args:
+        if arg.startswith("--offset="):
+            offset = int(arg.split("=", 1)[1], 0)
+        elif arg.startswith("--length="):
+            length = int(arg.split("=", 1)[1], 0)
+        elif arg.startswith("--out="):
+            out_dir = pathlib.Path(arg.split("=", 1)[1])
+        elif arg in ("-r", "--resilient"):
+            is_resilient = True
+        else:
+            paths.append(arg)
+
+    if len(paths) != 1:
+        print("ERROR: You must provide exactly one VHDX file as input")
+        exit(1)
+    in_path = paths[0]
+    if not ccl_vhdx.location_exists(in_path):
+        print(f"ERROR: \"{in_path}\" does not exist.")
+        exit(1)
+    if (offset is None) != (length is None):
+        print("ERROR: --offset and --length must be given together")
+        exit(1)
+    if out_dir is not None and offset is None:
+        print("ERROR: --out needs a range given with --offset and --length")
+        exit(1)
+
+    vhdx = ccl_vhdx.VhdxFile(in_path, ignore_faults=is_resilient,
+                             fallback_metas=ccl_vhdx.SENSIBLE_FALLBACK_METAS if is_resilient else None)
+    history = ccl_vhdx.read_log_history(vhdx, progress=ccl_vhdx.StatusLinePrinter())
+
+    print(in_path)
+    print(f"Log: {history.log_length} bytes at {history.log_offset}")
+    print(f"Header log GUID: {vhdx.header.log_guid.hex()}")
+    print(f"Valid entries: {len(history.entries)}; logged sectors: {history.sector_count}")
+    print()
+    print("\t".join(["Log offset", "Sequence", "Length", "Tail", "Log GUID", "Active", "Data descriptors",
+                     "Zero descriptors"]))
+    for entry_offset, entry in history.entries:
+        data_count = len(entry.data_descriptors)
+        print("\t".join(str(x) for x in [
+            entry_offset, entry.sequence_number, entry.entry_length, entry.tail, entry.log_guid.hex(),
+            entry_offset in history.active_entry_offsets, data_count, len(entry.descriptors) - data_count]))
+    for rejected in history.rejected_entries:
+        print(f"Rejected entry at log offset {rejected.entry_offset}: {rejected.reason}")
+    print()
+
+    if offset is None:
+        return
+
+    versions = history.get_virtual_versions(vhdx, offset, length)
+    print(f"{len(versions)} logged version(s) of virtual range {offset}-{offset + length}")
+    print("\t".join(["Virtual offset", "Length", "File offset", "Sequence", "Log offset", "Active"]))
+    if out_dir is not None:
+        out_dir.mkdir(parents=True, exist_ok=True)
+    for version in versions:
+        print("\t".join(str(x) for x in [
+            version.virtual_offset, len(version.data), version.file_offset, version.sequence_number,
+            version.entry_offset, version.is_active]))
+        if out_dir is not None:
+            out_path = out_dir / (f"{version.virtual_offset:016x}_seq{version.sequence_number}_"
+                                  f"{version.file_offset:x}.bin")
+            with out_path.open("xb") as out:
+                out.write(version.data)
+    print()
+
+
+if __name__ == '__main__':
+    if len(sys.argv) < 2:
+        me = pathlib.Path(sys.argv[0]).name
+        print("Lists every valid entry in the log of a VHDX file (including entries left over from earlier sessions) "
+              "and recovers the earlier versions of a range of the virtual disk which they hold")
+        print(f"USAGE: {me} <vhdx_file> [--offset=<virtual offset> --length=<bytes>] [--out=<dir>] "
+              f"[-r | --resilient]")
+        print()
+        print("vhdx_file:            The VHDX file whose log is read")
+        print("--offset= --length=:  A range of the virtual disk to list the logged versions of")
+        print("--out=:               Write each logged version of the range to its own file in this directory")
+        print("-r | --resilient:     Attempt to deal with invalid/missing data")
+        print()
+        exit(0)
+    main(sys.argv[1:])
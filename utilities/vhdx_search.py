@@ -0,0 +1,137 @@
+"""
+Copyright 2019, CCL (SOLUTIONS) Group Ltd.
+
+Permission is hereby granted, free of charge, to any person obtaining a copy of this software and associated
+documentation files (the "Software"), to deal in the Software without restriction, including without limitation the
+rights to use, copy, modify, merge, publish, distribute, sublicense, and/or sell copies of the Software, and to permit
+persons to whom the Software is furnished to do so, subject to the following conditions:
+
+The above copyright notice and this permission notice shall be included in all copies or substantial portions of the
+Software.
+
+THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR IMPLIED, INCLUDING BUT NOT LIMITED TO THE
+WARRANTIES OF MERCHANTABILITY, FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE AUTHORS OR
+COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR
+OTHERWISE, ARISING FROM, OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE SOFTWARE.
+"""
+
+__version__ = "0.1.0"
+__description__ = "Searches the virtual disk of a VHDX file or chain for byte patterns, text and regular expressions"
+__contact__ = "Alex Caithness"
+
+import sys
+import re
+import pathlib
+import ccl_vhdx
+
+
+def text_patterns(text: str, encodings):
+    return [text.encode(encoding) for encoding in encodings]
+
+
+def main(args):
+    encodings = ["utf-8"]
+    raw_patterns = []  # (kind, value) as given, turned into patterns once all the arguments are read
+    scope = "allocated"
+    workers = None
+    is_resilient = False
+    direct_io = False
+    paths = []
+    for arg in args:
+        if arg.startswith("--hex="):
+            raw_patterns.append(("hex", arg.split("=", 1)[1]))
+        elif arg.startswith("--text="):
+            raw_patterns.append(("text", arg.split("=", 1)[1]))
+        elif arg.startswith("--regex="):
+            raw_patterns.append(("regex", arg.split("=", 1)[1]))
+        elif arg.startswith("--keywords="):
+            with open(arg.split("=", 1)[1], "r", encoding="utf-8") as f:
+                raw_patterns.extend(("text", line.rstrip("\r\n")) for line in f if line.strip())
+        elif arg == "--utf16":
+            encodings.append("utf-16-le")
+        elif arg.startswith("--scope="):
+            scope = arg.split("=", 1)[1]
+        elif arg.startswith("--workers="):
+            workers = int(arg.split("=", 1)[1])
+        elif arg in ("-r", "--resilient"):
+            is_resilient = True
+        elif arg == "--direct-io":
+            direct_io = True
+        else:
+            paths.append(arg)
+
+    if scope not in ccl_vhdx.SEARCH_SCOPES:
+        print(f"ERROR: scope must be one of: {', '.join(ccl_vhdx.SEARCH_SCOPES)}")
+        exit(1)
+    if not raw_patterns:
+        print("ERROR: nothing to search for")
+        exit(1)
+    for p in paths:
+        if not ccl_vhdx.location_exists(p):
+            print(f"ERROR: \"{p}\" does not exist.")
+            exit(1)
+
+    patterns = []
+    descriptions = []
+    for kind, value in raw_patterns:
+        if kind == "hex":
+            patterns.append(bytes.fromhex(value))
+            descriptions.append(f"hex:{value}")
+        elif kind == "regex":
+            patterns.append(re.compile(value.encode("utf-8"), re.DOTALL))
+            descriptions.append(f"regex:{value}")
+        else:
+            for encoding, pattern in zip(encodings, text_patterns(value, encodings)):
+                patterns.append(pattern)
+                descriptions.append(f"{encoding}:{value}")
+
+    fallback_metas = ccl_vhdx.SENSIBLE_FALLBACK_METAS if is_resilient else None
+    if len(paths) == 1:
+        disk = ccl_vhdx.VhdxFile(paths[0], ignore_faults=is_resilient, fallback_metas=fallback_metas,
+                                 direct_io=direct_io)
+    else:
+        disk = ccl_vhdx.VhdxChain.from_paths(paths, ignore_faults=is_resilient, fallback_metas=fallback_metas,
+                                             direct_io=direct_io)
+
+    for p in paths:
+        print(p)
+    print()
+    print("\t".join(["Pattern", "Virtual Offset", "File", "File Offset", "Kind", "Match (hex)"]))
+    hit_count = 0
+    for hit in ccl_vhdx.search_disk(disk, patterns, scope=scope, workers=workers,
+                                     progress=ccl_vhdx.StatusLinePrinter()):
+        hit_count += 1
+        print("\t".join(str(x) for x in [
+            descriptions[hit.pattern_index],
+            "" if hit.virtual_offset is None else hit.virtual_offset,
+            "" if hit.file_path is None else hit.file_path.name,
+            "" if hit.physical_offset is None else hit.physical_offset,
+            hit.kind, hit.match[:64].hex()]))
+    print()
+    print(f"{hit_count} hits")
+    print()
+
+
+if __name__ == '__main__':
+    if len(sys.argv) < 2:
+        me = pathlib.Path(sys.argv[0]).name
+        print("Searches the virtual disk of a VHDX file (or chain of VHDX files) for byte patterns, text and regular "
+              "expressions, without exporting it first")
+        print(f"USAGE: {me} <vhdx_file 1> [vhdx_file 2] ... [--hex=<hex>] [--text=<text>] [--regex=<regex>] "
+              f"[--keywords=<file>] [--utf16] [--scope=allocated|disk|slack] [--workers=<count>] [-r | --resilient] "
+              f"[--direct-io]")
+        print()
+        print("vhdx_file:            One or more VHDX files, ordered parent first")
+        print("--hex=:               Search for these bytes, given as hex (can be repeated)")
+        print("--text=:              Search for this text, UTF-8 encoded (can be repeated)")
+        print("--regex=:             Search for this regular expression, matched against raw bytes (can be repeated)")
+        print("--keywords=:          Search for each line of this UTF-8 text file")
+        print("--utf16:              Also search for text and keywords encoded as UTF-16LE")
+        print("--scope=:             allocated (default): blocks stored in the file(s); disk: the whole virtual disk;")
+        print("                      slack: unreferenced areas and stale blocks in the file(s)")
+        print("--workers=:           Number of worker processes (default: one per CPU)")
+        print("-r | --resilient:     Attempt to deal with invalid/missing data")
+        print("--direct-io:          Read the VHDX files without filling the page cache (O_DIRECT where supported)")
+        print()
+        exit(0)
+    main(sys.argv[1:])
@@ -0,0 +1,100 @@
+"""
+Copyright 2019, CCL (SOLUTIONS) Group Ltd.
+
+Permission is hereby granted, free of charge, to any person obtaining a copy of this software and associated
+documentation files (the "Software"), to deal in the Software without restriction, including without limitation the
+rights to use, copy, modify, merge, publish, distribute, sublicense, and/or sell copies of the Software, and to permit
+persons to whom the Software is furnished to do so, subject to the following conditions:
+
+The above copyright notice and this permission notice shall be included in all copies or substantial portions of the
+Software.
+
+THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR IMPLIED, INCLUDING BUT NOT LIMITED TO THE
+WARRANTIES OF MERCHANTABILITY, FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE AUTHORS OR
+COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR
+OTHERWISE, ARISING FROM, OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE SOFTWARE.
+"""
+
+
+__version__ = "0.1.0"
+__description__ = "Converts a VHDX file or chain of differencing VHDX files straight to a sparse qcow2 image"
+__contact__ = "Alex Caithness"
+
+import sys
+import pathlib
+import ccl_vhdx
+
+
+def main(args):
+    out_path = pathlib.Path(args[0])
+    is_resilient = False
+    direct_io = False
+    partition_index = None
+    cluster_size = ccl_vhdx.QCOW2_DEFAULT_CLUSTER_SIZE
+    vhdx_paths = []
+    for arg in args[1:]:
+        if arg.startswith("--partition="):
+            partition_index = int(arg.split("=", 1)[1])
+        elif arg.startswith("--cluster-size="):
+            cluster_size = int(arg.split("=", 1)[1])
+        elif arg in ("-r", "--resilient"):
+            is_resilient = True
+        elif arg == "--direct-io":
+            direct_io = True
+        else:
+            vhdx_paths.append(arg)
+
+    if out_path.exists():
+        print(f"ERROR: \"{out_path}\" already exists.")
+        exit(1)
+    for p in vhdx_paths:
+        if not ccl_vhdx.location_exists(p):
+            print(f"ERROR: \"{p}\" does not exist.")
+            exit(1)
+    if not vhdx_paths:
+        print("ERROR: You must provide at least one VHDX file as input")
+        exit(1)
+
+    chain = ccl_vhdx.VhdxChain.from_paths(
+        vhdx_paths, ignore_faults=is_resilient,
+        fallback_metas=ccl_vhdx.SENSIBLE_FALLBACK_METAS if is_resilient else None, direct_io=direct_io)
+    offset, length = 0, chain.virtual_disk_size
+    if partition_index is not None:
+        try:
+            partition = ccl_vhdx.read_partition_table(chain)[partition_index]
+        except (KeyError, ccl_vhdx.VhdxPartitionError):
+            print(f"ERROR: Partition {partition_index} could not be found.")
+            exit(1)
+        if partition.offset + partition.length > chain.virtual_disk_size:
+            print(f"ERROR: Partition {partition_index} runs past the end of the virtual disk "
+                  f"({partition.offset + partition.length} > {chain.virtual_disk_size}).")
+            exit(1)
+        offset, length = partition.offset, partition.length
+
+    try:
+        result = ccl_vhdx.export_to_qcow2(chain, out_path, offset, length, cluster_size=cluster_size,
+                                          progress=ccl_vhdx.StatusLinePrinter())
+    except ValueError as ex:
+        print(f"ERROR: {ex}")
+        exit(1)
+    print(f"Wrote {out_path}: {result.length} bytes virtual; {result.length - result.zero_bytes} bytes stored")
+
+
+if __name__ == '__main__':
+    if len(sys.argv) < 3:
+        me = pathlib.Path(sys.argv[0]).name
+        print("Converts a VHDX file (or chain of differencing VHDX files) straight to a qcow2 image, storing only the "
+              "clusters which are allocated and not zeros")
+        print(f"USAGE: {me} <out_file_path> <vhdx_file 1> [vhdx_file 2] ... [--partition=<index>] "
+              f"[--cluster-size=<bytes>] [-r | --resilient] [--direct-io]")
+        print()
+        print("out_file_path:    Output qcow2 file (cannot already exist)")
+        print("vhdx_file:        One or more VHDX files, ordered parent first")
+        print("--partition=:     Only convert this partition (see vhdx_list_partitions.py for the indices)")
+        print(f"--cluster-size=:  qcow2 cluster size, a power of two from 512 to 2097152 "
+              f"(default {ccl_vhdx.QCOW2_DEFAULT_CLUSTER_SIZE})")
+        print("-r | --resilient: Attempt to deal with invalid/missing data")
+        print("--direct-io:      Read the VHDX files without filling the page cache (O_DIRECT where supported)")
+        print()
+        exit(0)
+    main(sys.argv[1:])
@@ -0,0 +1,109 @@
+"""
+Copyright 2019, CCL (SOLUTIONS) Group Ltd.
+
+Permission is hereby granted, free of charge, to any person obtaining a copy of this software and associated
+documentation files (the "Software"), to deal in the Software without restriction, including without limitation the
+rights to use, copy, modify, merge, publish, distribute, sublicense, and/or sell copies of the Software, and to permit
+persons to whom the Software is furnished to do so, subject to the following conditions:
+
+The above copyright notice and this permission notice shall be included in all copies or substantial portions of the
+Software.
+
+THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR IMPLIED, INCLUDING BUT NOT LIMITED TO THE
+WARRANTIES OF MERCHANTABILITY, FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE AUTHORS OR
+COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR
+OTHERWISE, ARISING FROM, OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE SOFTWARE.
+"""
+
+
+__version__ = "0.1.0"
+__description__ = "Maps where the zero, text and high entropy (encrypted or compressed) data is on a virtual disk"
+__contact__ = "Alex Caithness"
+
+import sys
+import pathlib
+import ccl_vhdx
+
+MAP_LINE_BLOCKS = 64
+
+
+def main(args):
+    sample_length = ccl_vhdx.DEFAULT_TRIAGE_SAMPLE_LENGTH
+    stride = ccl_vhdx.DEFAULT_TRIAGE_STRIDE
+    workers = None
+    as_table = False
+    is_resilient = False
+    direct_io = False
+    paths = []
+    for arg in args:
+        if arg.startswith("--sample="):
+            sample_length = int(arg.split("=", 1)[1])
+        elif arg.startswith("--stride="):
+            stride = int(arg.split("=", 1)[1]) or None
+        elif arg.startswith("--workers="):
+            workers = int(arg.split("=", 1)[1])
+        elif arg == "--table":
+            as_table = True
+        elif arg in ("-r", "--resilient"):
+            is_resilient = True
+        elif arg == "--direct-io":
+            direct_io = True
+        else:
+            paths.append(arg)
+
+    for p in paths:
+        if not ccl_vhdx.location_exists(p):
+            print(f"ERROR: \"{p}\" does not exist.")
+            exit(1)
+    if not paths:
+        print("ERROR: You must provide at least one VHDX file as input")
+        exit(1)
+
+    disk = ccl_vhdx.VhdxChain.from_paths(
+        paths, ignore_faults=is_resilient,
+        fallback_metas=ccl_vhdx.SENSIBLE_FALLBACK_METAS if is_resilient else None, direct_io=direct_io)
+    triage_map = ccl_vhdx.triage_disk(disk, sample_length=sample_length, stride=stride, workers=workers,
+                                      progress=ccl_vhdx.StatusLinePrinter())
+
+    for p in paths:
+        print(p)
+    print(f"Block size: {triage_map.block_size}")
+    for content_class, total in triage_map.class_totals().items():
+        print(f"{content_class}: {total} bytes")
+    print()
+
+    if as_table:
+        print("\t".join(["Block", "Offset", "Length", "Sampled", "Class", "Entropy"] +
+                        [f"{x} fraction" for x in ccl_vhdx.BYTE_CLASSES]))
+        for block in triage_map:
+            print("\t".join(str(x) for x in [
+                block.block_index, block.virtual_offset, block.length, block.sampled_bytes, block.content_class,
+                f"{block.entropy:.3f}"] + [f"{x:.3f}" for x in block.byte_classes]))
+    else:
+        print("Map (. sparse, 0 zero, _ low entropy, t text, b binary, # high entropy):")
+        map_string = triage_map.to_map_string()
+        for start in range(0, len(map_string), MAP_LINE_BLOCKS):
+            print(f"{start * triage_map.block_size:016x}  {map_string[start:start + MAP_LINE_BLOCKS]}")
+    print()
+
+
+if __name__ == '__main__':
+    if len(sys.argv) < 2:
+        me = pathlib.Path(sys.argv[0]).name
+        print("Classifies each block of the virtual disk of a VHDX file (or chain of VHDX files) as sparse, zero, low "
+              "entropy, text, binary or high entropy (encrypted or compressed) by sampling its contents")
+        print(f"USAGE: {me} <vhdx_file 1> [vhdx_file 2] ... [--sample=<bytes>] [--stride=<bytes>] "
+              f"[--workers=<count>] [--table] [-r | --resilient] [--direct-io]")
+        print()
+        print("vhdx_file:            One or more VHDX files, ordered parent first")
+        print(f"--sample=:            Bytes read from each stride of a block "
+              f"(default {ccl_vhdx.DEFAULT_TRIAGE_SAMPLE_LENGTH})")
+        print(f"--stride=:            Distance between samples, 0 to read whole blocks "
+              f"(default {ccl_vhdx.DEFAULT_TRIAGE_STRIDE})")
+        print("--workers=:           Number of worker processes (default: one per CPU)")
+        print("--table:              List every block's entropy and byte classes rather than drawing a map")
+        print("-r | --resilient:     Attempt to deal with invalid/missing data")
+        print("--direct-io:          Read the VHDX files without filling the page cache (O_DIRECT where supported)")
+        print()
+        exit(0)
+    main(sys.argv[1:])
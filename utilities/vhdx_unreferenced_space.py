@@ -0,0 +1,77 @@
+"""
+Copyright 2019, CCL (SOLUTIONS) Group Ltd.
+
+Permission is hereby granted, free of charge, to any person obtaining a copy of this software and associated
+documentation files (the "Software"), to deal in the Software without restriction, including without limitation the
+rights to use, copy, modify, merge, publish, distribute, sublicense, and/or sell copies of the Software, and to permit
+persons to whom the Software is furnished to do so, subject to the following conditions:
+
+The above copyright notice and this permission notice shall be included in all copies or substantial portions of the
+Software.
+
+THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR IMPLIED, INCLUDING BUT NOT LIMITED TO THE
+WARRANTIES OF MERCHANTABILITY, FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE AUTHORS OR
+COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR
+OTHERWISE, ARISING FROM, OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE SOFTWARE.
+"""
+
+__version__ = "0.1.0"
+__description__ = "Maps the physical space of a VHDX file and carves out areas which nothing references"
+__contact__ = "Alex Caithness"
+
+import sys
+import pathlib
+import ccl_vhdx
+
+
+def main(args):
+    in_path = args[0]
+    out_dir_path = None
+    include_stale = "--no-stale" not in args[1:]
+    is_resilient = "-r" in args[1:] or "--resilient" in args[1:]
+    for arg in args[1:]:
+        if not arg.startswith("-"):
+            out_dir_path = pathlib.Path(arg)
+    print(in_path)
+
+    vhdx = ccl_vhdx.VhdxFile(in_path, ignore_faults=is_resilient,
+                             fallback_metas=ccl_vhdx.SENSIBLE_FALLBACK_METAS if is_resilient else None)
+    occupancy = ccl_vhdx.build_occupancy_map(vhdx)
+
+    print(f"File size: {occupancy.file_size}")
+    print(f"Referenced extents: {len(occupancy.extents)}")
+    print(f"Stale payload extents: {len(occupancy.stale_extents)} "
+          f"({sum(x.length for x in occupancy.stale_extents)} bytes)")
+    print(f"Unreferenced gaps: {len(occupancy.gaps)} ({sum(x.length for x in occupancy.gaps)} bytes)")
+    for extent in occupancy.beyond_eof:
+        print(f"WARNING: {extent.kind} extent at {extent.start} (BAT index {extent.detail}) is beyond the end of file")
+    print()
+    print("\t".join(["Offset", "Length", "Kind", "BAT Index"]))
+    for extent in occupancy.iter_unreferenced(include_stale=include_stale):
+        print("\t".join(str(x) for x in [
+            extent.start, extent.length, extent.kind, "" if extent.detail is None else extent.detail]))
+    print()
+
+    if out_dir_path is not None:
+        if out_dir_path.exists():
+            print(f"ERROR: {out_dir_path} already exists")
+            exit(1)
+        written = ccl_vhdx.carve_unreferenced(vhdx, out_dir_path, occupancy, include_stale=include_stale)
+        print(f"{len(written)} non-zero extents written to {out_dir_path}")
+        print()
+
+
+if __name__ == '__main__':
+    if len(sys.argv) < 2:
+        me = pathlib.Path(sys.argv[0]).name
+        print("Lists (and optionally carves out) areas of a VHDX file which are not referenced by the headers, region "
+              "table, log or BAT, along with payload blocks only referenced by stale BAT entries")
+        print(f"USAGE: {me} <vhdx_file_path> [out_dir] [--no-stale] [-r | --resilient]")
+        print()
+        print("vhdx_file_path:   Path to the VHDX file")
+        print("out_dir:          Carve the areas into files in this directory (cannot already exist)")
+        print("--no-stale:       Only include unreferenced gaps, not stale payload blocks")
+        print("-r | --resilient: Attempt to deal with invalid/missing data")
+        print()
+        exit(0)
+    main(sys.argv[1:])
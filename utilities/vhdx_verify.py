@@ -0,0 +1,77 @@
+"""
+Copyright 2019, CCL (SOLUTIONS) Group Ltd.
+
+Permission is hereby granted, free of charge, to any person obtaining a copy of this software and associated
+documentation files (the "Software"), to deal in the Software without restriction, including without limitation the
+rights to use, copy, modify, merge, publish, distribute, sublicense, and/or sell copies of the Software, and to permit
+persons to whom the Software is furnished to do so, subject to the following conditions:
+
+The above copyright notice and this permission notice shall be included in all copies or substantial portions of the
+Software.
+
+THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR IMPLIED, INCLUDING BUT NOT LIMITED TO THE
+WARRANTIES OF MERCHANTABILITY, FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE AUTHORS OR
+COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR
+OTHERWISE, ARISING FROM, OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE SOFTWARE.
+"""
+
+
+__version__ = "0.1.0"
+__description__ = "Runs the structural checks on VHDX files and reports what is wrong with each"
+__contact__ = "Alex Caithness"
+
+import sys
+import json
+import pathlib
+import ccl_vhdx
+
+
+def main(args):
+    as_json = False
+    paths = []
+    for arg in args:
+        if arg == "--json":
+            as_json = True
+        else:
+            paths.append(arg)
+
+    for p in paths:
+        if not ccl_vhdx.location_exists(p):
+            print(f"ERROR: \"{p}\" does not exist.")
+            exit(1)
+
+    any_errors = False
+    for p in paths:
+        report = ccl_vhdx.verify(p, progress=ccl_vhdx.StatusLinePrinter())
+        any_errors = any_errors or report.error_count > 0
+        if as_json:
+            print(json.dumps(report.to_dict()))
+            continue
+
+        print(report.path)
+        print(f"{report.error_count} errors; {report.warning_count} warnings; "
+              f"resilient mode {'needed' if report.needs_resilient_mode else 'not needed'}")
+        if report.findings:
+            print("\t".join(["Severity", "Check", "Offset", "BAT Index", "Message"]))
+        for finding in report.findings:
+            print("\t".join(str(x) if x is not None else "" for x in
+                            [finding.severity, finding.check, finding.offset, finding.bat_index, finding.message]))
+        for check, count in report.finding_counts.items():
+            if count > ccl_vhdx.MAX_FINDINGS_PER_CHECK:
+                print(f"... and {count - ccl_vhdx.MAX_FINDINGS_PER_CHECK} more \"{check}\" findings")
+        print()
+
+    exit(1 if any_errors else 0)
+
+
+if __name__ == '__main__':
+    if len(sys.argv) < 2:
+        me = pathlib.Path(sys.argv[0]).name
+        print("Runs the structural checks on each VHDX file and lists the problems found. Exits with 1 if any file "
+              "has errors (and so needs to be opened in resilient mode)")
+        print(f"USAGE: {me} <vhdx_file 1> [vhdx_file 2] ... [--json]")
+        print()
+        print("--json:           Write one JSON report per line instead of a table")
+        print()
+        exit(0)
+    main(sys.argv[1:])